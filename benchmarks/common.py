@@ -0,0 +1,24 @@
+""" Databases the benchmarks run against, emptied before each run """
+# Collections WordleStats writes to
+STATS_COLLECTIONS = ("user_data", "leaderboards", "chat_members")
+
+
+def reset(db, collections: tuple[str, ...] = STATS_COLLECTIONS):
+    """ Drop the collections of db a benchmark fills, returning db """
+    for name in collections:
+        db[name].drop()
+    return db
+
+
+def get_database(name: str, mongo: str = '', sqlite: str = '', collections: tuple[str, ...] = STATS_COLLECTIONS):
+    """ Database name on MongoDB if mongo is given, on an SQLite file (or :memory:) if sqlite is, else on mongomock """
+    if mongo:
+        from pymongo import MongoClient
+        db = MongoClient(mongo)[name]
+    elif sqlite:
+        from utils.sqlite_store import SQLiteDatabase
+        db = SQLiteDatabase(sqlite)
+    else:
+        import mongomock
+        db = mongomock.MongoClient()[name]
+    return reset(db, collections)
@@ -0,0 +1,88 @@
+""" /globalrank and /globaltop cost for 10,000 to 1,000,000 players, rank index against sorting every average
+
+Run from the repository root with
+    python -m benchmarks.global_rank_bench [--queries N] [--seed S]
+Players with random game counts and averages are loaded into GlobalRank from
+an in-memory list standing in for user_data. Each size reports the load time,
+the mean time of a rank query, a top 10 and a score change, next to ranking
+one player by sorting every average as a request without the index would.
+Every sampled rank and the top 10 are checked against the sorted averages;
+exits with status 1 on any difference.
+"""
+import argparse
+import random
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from classes.GlobalRank import GlobalRank
+
+SIZES = [10_000, 100_000, 1_000_000]
+TOP = 10
+
+
+class ListCollection:
+    """ Just enough of a collection for GlobalRank.rebuild """
+
+    def __init__(self, documents: list[dict]) -> None:
+        self.documents = documents
+
+    def find(self, filter: dict, projection: dict = None):
+        min_games = filter["num_games"]["$gte"]
+        return (document for document in self.documents if document["num_games"] >= min_games)
+
+
+def players(count: int, rng: random.Random) -> list[dict]:
+    return [{"_id": user_id, "num_games": rng.choice([1, 3, 8, 15, 40, 120]),
+             "score_avg": min(max(rng.gauss(4.1, 0.5), 1.0), 7.0)} for user_id in range(1, count + 1)]
+
+
+def mean_us(func, arguments: list) -> float:
+    start = time.perf_counter()
+    for argument in arguments:
+        func(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    print(f"{'players':>9} {'ranked':>8} {'load s':>7} {'rank us':>8} {'top us':>7} {'update us':>10} {'sort ms':>8}")
+    for size in SIZES:
+        documents = players(size, rng)
+        ranks = GlobalRank()
+        start = time.perf_counter()
+        ranked = ranks.rebuild(ListCollection(documents))
+        load = time.perf_counter() - start
+
+        eligible = [document for document in documents if document["num_games"] >= ranks.min_games]
+        buckets = sorted(ranks._bucket(document["score_avg"]) for document in eligible)
+        sample = rng.sample(eligible, min(args.queries, len(eligible)))
+        for document in sample:
+            bucket = ranks._bucket(document["score_avg"])
+            expected = (bisect_left(buckets, bucket) + 1, len(buckets), (len(buckets) - bisect_right(buckets, bucket)) / len(buckets))
+            failures += ranks.rank(document["_id"]) != expected
+        top_buckets = [ranks._bucket(documents[user_id - 1]["score_avg"]) for user_id in ranks.top(TOP)]
+        failures += top_buckets != buckets[:TOP]
+
+        rank_us = mean_us(ranks.rank, [document["_id"] for document in sample])
+        top_us = mean_us(ranks.top, [TOP] * 200)
+        changes = [(document["_id"], {"num_games": document["num_games"] + 1, "score_avg": rng.uniform(2.0, 6.0)})
+                   for document in sample]
+        update_us = mean_us(lambda change: ranks.update(*change), changes)
+        # What a request without the index does: sort every eligible average to place one player
+        start = time.perf_counter()
+        averages = sorted(document["score_avg"] for document in eligible)
+        bisect_left(averages, sample[0]["score_avg"])
+        sort_ms = (time.perf_counter() - start) * 1000
+        print(f"{size:>9} {ranked:>8} {load:>7.2f} {rank_us:>8.2f} {top_us:>7.2f} {update_us:>10.2f} {sort_ms:>8.1f}")
+    print(f"{failures} ranks differ from sorting")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
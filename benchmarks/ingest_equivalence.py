@@ -0,0 +1,133 @@
+""" Randomized check that ingest_score's single pipeline update follows the rules of the original update_stats branches
+
+Run from the repository root with
+    python -m benchmarks.ingest_equivalence [--sequences N] [--shares N] [--seed S] [--mongo <connection string>]
+Each sequence shares random editions for a handful of users across a few
+chats: the same edition again, the next one, a missed day, an older one with
+retroactive updates on or off, and users sharing for the first time. Every
+share is applied by old_update_stats, the branches update_stats used before
+the pipeline, to one database and by WordleStats.ingest_score to another, on
+mongomock unless --mongo is given. The returned (update, update_msg) tuples,
+RetroactiveOff errors, stats fields and chat memberships are compared after
+every share; exits with status 1 on any difference.
+"""
+import argparse
+import math
+import random
+import sys
+import time
+from benchmarks.common import get_database
+from classes.WordleStats import WordleStats
+from classes.Leaderboard import Leaderboard
+from classes.ChatMembers import ChatMembers
+
+FIELDS = ["username", "num_games", "streak", "score_avg", "last_game", "last_active_chat", "toggle_retroactive"]
+USERS = 4
+CHATS = 3
+
+
+def old_update_stats(db, user_id: int, chat_id: int, edition: int, tries: float, username: str) -> tuple[bool, bool]:
+    """ update_stats as it was before ingest_score, without its lock, with chats kept in member_of_chats """
+    user_data = db.find_one({"_id": user_id})
+    if user_data == None:
+        db.insert_one({"_id": user_id, "username": username, "num_games": 1, "streak": 1, "score_avg": tries,
+                       "last_game": edition, "last_active_chat": chat_id, "member_of_chats": [chat_id],
+                       "toggle_retroactive": False, "warning": True, "lock": False})
+        return (True, True)
+
+    num_games, score_avg, last_game = user_data['num_games'], user_data['score_avg'], user_data['last_game']
+    last_game_update = {"last_game": edition}
+    streak_inc = {"streak": 1}
+    streak_reset = {"streak": 1}
+    if edition == last_game:
+        db.update_one({"_id": user_id, "last_active_chat": {"$ne": chat_id}},
+                      {"$set": {"last_active_chat": chat_id}, "$addToSet": {"member_of_chats": chat_id}})
+        return (False, user_data['last_active_chat'] == chat_id)
+    elif edition > last_game:
+        if edition == last_game + 1:
+            streak_reset = {}
+        else:
+            streak_inc = {}
+    else:
+        streak_inc, streak_reset, last_game_update = {}, {}, {}
+        if not user_data['toggle_retroactive']:
+            raise WordleStats.RetroactiveOff
+
+    db.update_one({"_id": user_id}, {
+        "$inc": {"num_games": 1} | streak_inc,
+        "$set": {"score_avg": (score_avg * num_games + tries) / (num_games + 1),
+                 "last_active_chat": chat_id} | streak_reset | last_game_update,
+        "$addToSet": {"member_of_chats": chat_id},
+    })
+    return (True, False)
+
+
+def outcome(func, *args) -> tuple | str:
+    try:
+        return func(*args)
+    except WordleStats.RetroactiveOff:
+        return "RetroactiveOff"
+
+
+def differences(old_db, new_db, user_id: int) -> list[str]:
+    old = old_db["user_data"].find_one({"_id": user_id}) or {}
+    new = new_db["user_data"].find_one({"_id": user_id}) or {}
+    diffs = [f"{field}: {old.get(field)!r} != {new.get(field)!r}" for field in FIELDS
+             if not (old.get(field) == new.get(field)
+                     or field == "score_avg" and math.isclose(old[field], new[field], rel_tol=1e-12))]
+    old_chats = set(old.get("member_of_chats", []))
+    new_chats = {pair["chat_id"] for pair in new_db["chat_members"].find({"user_id": user_id})}
+    if old_chats != new_chats:
+        diffs.append(f"chats: {sorted(old_chats)} != {sorted(new_chats)}")
+    return diffs
+
+
+def run_sequence(rng: random.Random, shares: int, old_db, new_db) -> list[str]:
+    stats = WordleStats(new_db["user_data"], Leaderboard(new_db["leaderboards"]), ChatMembers(new_db["chat_members"]))
+    edition = rng.randint(200, 1500)
+    for share in range(shares):
+        user_id, chat_id = rng.randint(1, USERS), -rng.randint(1, CHATS)
+        last = old_db["user_data"].find_one({"_id": user_id}, {"last_game": 1})
+        if last != None and rng.random() < 0.1:
+            retroactive = rng.random() < 0.5
+            for db in (old_db, new_db):
+                db["user_data"].update_one({"_id": user_id}, {"$set": {"toggle_retroactive": retroactive}})
+        base = last['last_game'] if last != None else edition
+        played = base + rng.choice([0, 0, 1, 1, 1, 2, 5, -1, -3])
+        tries = float(rng.randint(1, 7))
+        username = f"user {user_id}"
+
+        old = outcome(old_update_stats, old_db["user_data"], user_id, chat_id, played, tries, username)
+        new = outcome(stats.ingest_score, user_id, chat_id, played, tries, username)
+        diffs = differences(old_db, new_db, user_id)
+        if old != new:
+            diffs.insert(0, f"returned {old} != {new}")
+        if diffs:
+            return [f"share {share}, user {user_id} in chat {chat_id}, edition {played} (last {base}), tries {tries}"] + diffs
+    return []
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sequences', type=int, default=300)
+    parser.add_argument('--shares', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo', default='', help="MongoDB connection string, mongomock if empty")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    failures = 0
+    for sequence in range(args.sequences):
+        diffs = run_sequence(rng, args.shares, get_database("ingest_old", args.mongo), get_database("ingest_new", args.mongo))
+        if diffs:
+            failures += 1
+            if failures <= 5:
+                print(f"sequence {sequence}:\n  " + "\n  ".join(diffs))
+    print(f"{args.sequences} sequences of {args.shares} shares in {time.perf_counter() - start:.1f} s, "
+          f"{failures} differ")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
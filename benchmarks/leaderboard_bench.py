@@ -0,0 +1,73 @@
+""" Latency of /leaderboard for chats of 10, 100 and 1,000 members
+
+Run from the repository root with
+    python -m benchmarks.leaderboard_bench [--mongo <connection string>]
+Without --mongo an in-memory mongomock database is used.
+"""
+import argparse
+import random
+import time
+from statistics import median
+from benchmarks.common import get_database
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.WordleStats import WordleStats
+
+LATEST_GAME = 500
+
+
+def populate(stats: WordleStats, chat_id: int, members: int) -> None:
+    stats.db.insert_many([{
+        "_id": user_id,
+        "username": f"user{user_id}",
+        "num_games": random.randint(1, 300),
+        "streak": random.randint(0, 50),
+        "score_avg": random.uniform(2.5, 6.0),
+        "last_game": LATEST_GAME - random.randint(0, 3),
+        "last_active_chat": chat_id,
+        "toggle_retroactive": False,
+        "warning": True,
+        "lock": False
+    } for user_id in range(1, members + 1)])
+    stats.members.db.insert_many([{"chat_id": chat_id, "user_id": user_id} for user_id in range(1, members + 1)])
+
+
+def time_ms(func, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return median(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'members':>8} {'rebuild ms':>11} {'view read ms':>13} {'cache hit ms':>13}")
+    for members in (10, 100, 1000):
+        db = get_database('leaderboard_bench', args.mongo)
+        stats = WordleStats(db["user_data"], Leaderboard(db["leaderboards"]), ChatMembers(db["chat_members"]))
+        chat_id = -members
+        populate(stats, chat_id, members)
+
+        def rebuild():
+            stats.boards.drop(chat_id)
+            stats.print_leaderboard(1, chat_id, LATEST_GAME)
+
+        def view_read():
+            stats.boards.invalidate(1, chat_id)
+            stats.print_leaderboard(1, chat_id, LATEST_GAME)
+
+        def cache_hit():
+            stats.print_leaderboard(1, chat_id, LATEST_GAME)
+
+        print(f"{members:>8} {time_ms(rebuild, args.runs):>11.3f} "
+              f"{time_ms(view_read, args.runs):>13.3f} {time_ms(cache_hit, args.runs):>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
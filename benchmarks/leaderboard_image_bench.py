@@ -0,0 +1,86 @@
+""" Leaderboard image render time for 10 to 50 players, and the file_id hit rate of repeated /leaderboard calls
+
+Run from the repository root with
+    python -m benchmarks.leaderboard_image_bench [--requests N] [--change-rate R] [--seed S]
+Each size is rendered 20 times, reporting the median and slowest render and
+the PNG size. Then requests spread over 20 chats call /leaderboard, a share
+change-rate of them right after a new score in that chat, with uploads
+answered by a fake file_id. Every file_id sent again is checked to belong to
+the same leaderboard it was uploaded for; exits with status 1 otherwise.
+"""
+import argparse
+import random
+import sys
+import time
+from statistics import median
+from types import SimpleNamespace
+from classes.LeaderboardRenderer import LeaderboardRenderer
+from utils.messages import leaderboard_text, rank_rows
+
+SIZES = [10, 25, 50]
+CHATS = 20
+
+
+def players(count: int, rng: random.Random) -> list[dict]:
+    return [{"username": f"player {user_id}", "num_games": rng.randint(1, 400), "streak": rng.randint(0, 60),
+             "score_avg": rng.uniform(2.5, 6.0)} for user_id in range(count)]
+
+
+def uploaded(file_id: str) -> SimpleNamespace:
+    """ Just enough of the Message Telegram answers a sendPhoto with """
+    return SimpleNamespace(photo=[SimpleNamespace(file_id=file_id)])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--change-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    renderer = LeaderboardRenderer()
+    print(f"fonts and templates loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"{'players':>8} {'median ms':>10} {'max ms':>7} {'png KiB':>8}")
+    for size in SIZES:
+        rows = rank_rows(players(size, rng))
+        times = []
+        for _ in range(20):
+            start = time.perf_counter()
+            png = renderer.render(rows)
+            times.append(time.perf_counter() - start)
+        print(f"{size:>8} {median(times) * 1000:>10.1f} {max(times) * 1000:>7.1f} {len(png) / 1024:>8.1f}")
+
+    renderer = LeaderboardRenderer()
+    chats = [players(10, rng) for _ in range(CHATS)]
+    shown = {}  # file_id -> leaderboard it was uploaded for
+    failures = 0
+    start = time.perf_counter()
+    for request in range(args.requests):
+        chat = rng.choice(chats)
+        if rng.random() < args.change_rate:
+            player = rng.choice(chat)
+            player["num_games"] += 1
+            player["score_avg"] += (rng.randint(1, 6) - player["score_avg"]) / player["num_games"]
+        text = leaderboard_text(chat)
+        key = renderer.key(text)
+        file_id = renderer.file_id(key)
+        if file_id == None:
+            renderer.render(rank_rows(chat))
+            file_id = f"file{request}"
+            renderer.remember(key, uploaded(file_id))
+            shown[file_id] = text
+        else:
+            failures += shown[file_id] != text
+    elapsed = time.perf_counter() - start
+    stats = renderer.stats()
+    print(f"{args.requests} requests over {CHATS} chats, {args.change_rate:.0%} after a new score: "
+          f"hit rate {stats['hit_rate']:.1%}, {stats['renders']} renders, "
+          f"{elapsed / args.requests * 1000:.2f} ms per request, render p95 {stats['render_p95'] * 1000:.1f} ms")
+    print(f"{failures} file ids sent for a different leaderboard")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+""" Cost per group message of recognising and parsing Wordle Score shares
+
+Run from the repository root with
+    python -m benchmarks.parser_bench [--messages N] [--share-ratio R]
+The corpus mixes ordinary chat lines, commands and Wordle shares, with and
+without a trailing newline. Every share's grid is checked to hold all of its
+rows, the solved row included.
+"""
+import argparse
+import random
+import re
+import time
+from utils.message_handler import SCORE_PATTERN, extract_score, is_score
+
+OLD_PATTERN = r"Wordle\s(?P<edition>\d+)\s(?P<tries>[0-6X])/6\n{2}(?:(?:[🟨🟩⬛️⬜️]+)(?:\r?\n)){1,6}"
+TILES = "⬛🟨🟩"
+CHATTER = [
+    "morning!",
+    "did anyone get today's word?",
+    "that one was brutal 😅",
+    "lol",
+    "Wordle is too hard today",
+    "/leaderboard",
+    "/stats",
+    "see you at dinner",
+    "I got it in 3 but only by luck",
+    "Wordler of the week goes to...",
+]
+
+
+def share(edition: int, tries: int) -> str:
+    rows = ["".join(random.choice(TILES) for _ in range(5)) for _ in range(min(tries, 6) - 1)]
+    rows.append("🟩" * 5 if tries <= 6 else "".join(random.choice(TILES) for _ in range(5)))
+    # Telegram delivers shares without the trailing newline, pasted text may keep it
+    return f"Wordle {edition} {'X' if tries == 7 else tries}/6\n\n" + "\n".join(rows) + random.choice(["", "\n"])
+
+
+def corpus(messages: int, share_ratio: float) -> list[str]:
+    return [share(random.randint(200, 1600), random.randint(1, 7)) if random.random() < share_ratio
+            else random.choice(CHATTER) for _ in range(messages)]
+
+
+def old_path(text: str):
+    # telebot's regexp= filter followed by the re.match in the old extract_score
+    if re.search("^" + OLD_PATTERN, text, re.IGNORECASE):
+        return re.match(OLD_PATTERN, text)
+
+
+def new_path(text: str):
+    if is_score(text):
+        return extract_score(text)
+
+
+def ns_per_message(func, texts: list[str], repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / len(texts)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--share-ratio', type=float, default=0.01)
+    args = parser.parse_args()
+
+    random.seed(0)
+    texts = corpus(args.messages, args.share_ratio)
+    shares = [text for text in texts if extract_score(text) != None]
+    # The old pattern also missed a 1/6 share without its trailing newline
+    assert all(new_path(text) for text in texts if old_path(text))
+    assert len(shares) == sum("/6\n\n" in text for text in texts)
+    for text in shares:
+        m = SCORE_PATTERN.match(text)
+        tries = 6 if m.group('tries') == "X" else int(m.group('tries'))
+        assert len(m.group('grid').split()) == tries, f"grid rows missing from {text!r}"
+
+    print(f"{len(texts)} messages, {len(shares)} shares")
+    print(f"old regexp filter + re.match: {ns_per_message(old_path, texts):8.0f} ns/message")
+    print(f"prefix check + shared match:  {ns_per_message(new_path, texts):8.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
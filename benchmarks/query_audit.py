@@ -0,0 +1,149 @@
+""" Check that every query WordleStats and Leaderboard run is answered from an index
+
+Run from the repository root with
+    python -m benchmarks.query_audit [--mongo <connection string>]
+A scripted session of shares, commands and leaderboards is run while recording
+the filter of every query. Each distinct filter is then explained against a
+MongoDB server, failing on any plan with a COLLSCAN stage. mongomock cannot
+explain queries, so without --mongo each filter is instead checked against the
+collection's indexes: it passes when an equality or range condition on the
+first field of an index narrows it down.
+Exits with status 1 if any query would scan the collection.
+"""
+import argparse
+import sys
+from benchmarks.common import get_database
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.WordleStats import WordleStats
+
+FILTER_METHODS = ["find", "find_one", "find_one_and_update", "update_one", "update_many",
+                  "delete_one", "delete_many", "count_documents"]
+# Conditions an index cannot narrow a scan with
+UNSELECTIVE = {"$ne", "$nin", "$not", "$exists", "$type", "$regex", "$where", "$expr"}
+
+
+class RecordingCollection:
+    """ Collection proxy recording the filter of every query """
+
+    def __init__(self, collection, queries: list) -> None:
+        self._collection = collection
+        self._queries = queries
+        for method in FILTER_METHODS:
+            setattr(self, method, self._recorder(method))
+
+    def _recorder(self, method: str):
+        run = getattr(self._collection, method)
+
+        def record(filter=None, *args, **kwargs):
+            self._queries.append((self._collection.name, method, filter or {}))
+            return run(filter, *args, **kwargs)
+        return record
+
+    def __getattr__(self, name: str):
+        return getattr(self._collection, name)
+
+
+def run_session(stats: WordleStats) -> None:
+    """ Exercise the queries of every user command """
+    for user_id in range(1, 6):
+        for edition in (100, 101, 103):
+            stats.update_stats(user_id, 10 + user_id % 2, edition, 4.0, f"user{user_id}")
+        stats.ingest_score(user_id, 12, 104, 3.0, f"user{user_id}")
+        stats.ingest_score(user_id, 12, 104, 3.0, f"user{user_id}")
+    stats.toggle(1)
+    stats.update_stats(1, 10, 102, 5.0, "user1")
+    stats.check_lock(2)
+    stats.print_stats(2, 11, 105)
+    stats.print_leaderboard(3, 12, 105)
+    stats.print_leaderboard(3, 13, 105)
+    stats.manual_update(4, 10, 'games', 50)
+    stats.manual_update(4, 10, 'average', 4.5)
+    stats.rebuild(5)
+    stats.clear(5)
+
+
+def shape(filter):
+    """ Filter with its values replaced, so queries differing only in ids are audited once """
+    if isinstance(filter, dict):
+        return {key: shape(value) for key, value in filter.items()}
+    if isinstance(filter, list):
+        return [shape(value) for value in filter]
+    return "?"
+
+
+def distinct(queries: list) -> list:
+    """ First query of every (collection, method, filter shape) """
+    seen, shapes = set(), []
+    for name, method, filter in queries:
+        key = (name, method, repr(shape(filter)))
+        if key not in seen:
+            seen.add(key)
+            shapes.append((name, method, filter))
+    return shapes
+
+
+def plan_stages(plan: dict):
+    """ Yield every stage name of an explain plan """
+    yield plan.get("stage")
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            yield from plan_stages(child)
+
+
+def explain_scans(db, name: str, filter: dict) -> bool | None:
+    """ Whether the server plans a COLLSCAN for filter, or None if the database cannot explain """
+    cursor = db[name].find(filter)
+    if not hasattr(cursor, "explain"):
+        return None
+    explanation = cursor.explain()
+    planner = explanation["queryPlanner"]
+    # Newer servers nest the plan of the query shape under queryPlan
+    plan = planner["winningPlan"].get("queryPlan", planner["winningPlan"])
+    return "COLLSCAN" in plan_stages(plan)
+
+
+def index_narrows(filter: dict, leading_fields: set) -> bool:
+    if "$or" in filter and all(index_narrows(branch, leading_fields) for branch in filter["$or"]):
+        return True
+    for field, condition in filter.items():
+        if field not in leading_fields:
+            continue
+        if not isinstance(condition, dict) or not UNSELECTIVE.issuperset(condition):
+            return True
+    return False
+
+
+def index_scans(db, name: str, filter: dict) -> bool:
+    """ Whether no index's first field narrows filter down """
+    leading_fields = {index["key"][0][0] for index in db[name].index_information().values()}
+    return not index_narrows(filter, leading_fields)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    args = parser.parse_args()
+
+    db = get_database('query_audit', args.mongo)
+    queries = []
+    stats = WordleStats(RecordingCollection(db["user_data"], queries),
+                        Leaderboard(RecordingCollection(db["leaderboards"], queries)),
+                        ChatMembers(RecordingCollection(db["chat_members"], queries)))
+    stats.ensure_indexes()
+    run_session(stats)
+
+    audited = distinct(queries)
+    failures = 0
+    for name, method, filter in audited:
+        scans = explain_scans(db, name, filter)
+        if scans == None:
+            scans = index_scans(db, name, filter)
+        failures += scans
+        print(f"{'COLLSCAN' if scans else 'ok':>8}  {name}.{method} {shape(filter)}")
+    print(f"{failures} of {len(audited)} distinct queries scan the collection")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
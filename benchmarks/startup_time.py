@@ -0,0 +1,62 @@
+""" Time to import bot.py, up to the point the web server can bind its port, with its startup phases
+
+Run from the repository root with
+    python -m benchmarks.startup_time [--runs N] [--max-seconds S] [--mongo <connection string>]
+Each run imports bot.py in a fresh interpreter, with placeholder Telegram
+credentials and Telegram requests stubbed out, against an in-memory SQLite
+database unless --mongo is given. The median and slowest import time and the
+median of every phase recorded by metrics.phase are reported; phases after
+"startup" run in the background once the port could be bound. Exits with
+status 1 if the median import time exceeds --max-seconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+CHILD = """
+import json, os, time
+start = time.perf_counter()
+from telebot import apihelper
+apihelper._make_request = lambda *args, **kwargs: True
+import bot
+imported = time.perf_counter() - start
+time.sleep(float(os.environ["WARM_UP_WAIT"]))
+print(json.dumps({"import": imported, "phases": bot.metrics.startup()}))
+os._exit(0)
+"""
+
+
+def run(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=2.0)
+    parser.add_argument('--mongo', default='', help="MongoDB connection string, an in-memory SQLite database if empty")
+    args = parser.parse_args()
+
+    env = os.environ | {"API_KEY": "0:startup", "ADMIN_ID": "0", "WARM_UP_WAIT": "0.5"}
+    if args.mongo:
+        env |= {"STORAGE_BACKEND": "mongo", "MONGODB_CONNECTION": args.mongo}
+    else:
+        env |= {"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": ":memory:", "MONGODB_CONNECTION": "mongodb://unused"}
+    results = [run(env) for _ in range(args.runs)]
+
+    imports = [result["import"] for result in results]
+    print(f"import bot: median {median(imports) * 1000:.0f} ms, max {max(imports) * 1000:.0f} ms over {args.runs} runs")
+    for phase in results[0]["phases"]:
+        times = [result["phases"].get(phase, 0.0) for result in results]
+        print(f"  {phase:<10} {median(times) * 1000:>7.1f} ms")
+    slow = median(imports) > args.max_seconds
+    print(f"median import {'exceeds' if slow else 'within'} {args.max_seconds:.1f} s")
+    sys.exit(1 if slow else 0)
+
+
+if __name__ == "__main__":
+    main()
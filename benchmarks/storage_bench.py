@@ -0,0 +1,114 @@
+""" Same workload on MongoDB and the embedded SQLite engine: identical results, and operations per second
+
+Run from the repository root with
+    python -m benchmarks.storage_bench [--mongo <connection string>] [--sqlite <file>] [--ops N]
+Without --mongo the reference is an in-memory mongomock database, without
+--sqlite the embedded engine runs on an in-memory SQLite database. Every
+operation's result and, at the end, every stored document must match between
+the two; exits with status 1 otherwise.
+"""
+import argparse
+import random
+import sys
+import time
+from benchmarks.common import get_database
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.WordleStats import WordleStats
+
+# Lease fields hold a random token and the time, so they differ between runs
+VOLATILE_FIELDS = {"lock_owner", "lock_expires"}
+COMMANDS = ["ingest", "update", "stats", "leaderboard", "manual", "adjust", "toggle", "rebuild", "clear"]
+WEIGHTS = [40, 20, 10, 10, 5, 3, 4, 3, 1]
+
+
+def workload(ops: int, seed: int) -> list[tuple]:
+    rng = random.Random(seed)
+    latest = 400
+    steps = []
+    for _ in range(ops):
+        if rng.random() < 0.02:
+            latest += 1
+        command = rng.choices(COMMANDS, WEIGHTS)[0]
+        user_id, chat_id = rng.randint(1, 60), -rng.randint(1, 8)
+        edition = latest - rng.choice([0, 0, 0, 1, 2, 5])
+        steps.append((command, user_id, chat_id, edition, float(rng.randint(1, 7)), latest,
+                      rng.choice(['name', 'games', 'streak', 'average']), rng.randint(1, 6)))
+    return steps
+
+
+def run_step(stats: WordleStats, step: tuple):
+    command, user_id, chat_id, edition, tries, latest, field, value = step
+    try:
+        if command == "ingest":
+            return stats.ingest_score(user_id, chat_id, edition, tries, f"user{user_id}", grid=edition)
+        if command == "update":
+            return stats.update_stats(user_id, chat_id, edition, tries, f"user{user_id}", grid=edition)
+        if command == "stats":
+            return stats.print_stats(user_id, chat_id, latest)
+        if command == "leaderboard":
+            return stats.print_leaderboard(user_id, chat_id, latest)
+        if command == "manual":
+            return stats.manual_update(user_id, chat_id, field, value if field != 'name' else f"nick{value}")
+        if command == "adjust":
+            return stats.manual_update(user_id, chat_id, 'adjust', value, 4.0)
+        if command == "toggle":
+            return stats.toggle(user_id)
+        if command == "rebuild":
+            return stats.rebuild(user_id)
+        return stats.clear(user_id)
+    except (WordleStats.UserNotFound, WordleStats.RetroactiveOff, WordleStats.HistoryIncomplete, TypeError) as e:
+        # TypeError: toggle on a user that does not exist
+        return type(e).__name__
+
+
+def documents(db) -> dict:
+    return {name: sorted(({key: value for key, value in document.items() if key not in VOLATILE_FIELDS}
+                          for document in db[name].find()), key=lambda document: repr(document["_id"]))
+            for name in ("user_data", "leaderboards")} | {"chat_members": members(db)}
+
+
+def members(db) -> list[tuple[int, int]]:
+    """ (chat_id, user_id) pairs, whose _id each engine generates differently """
+    return sorted((pair["chat_id"], pair["user_id"]) for pair in db["chat_members"].find())
+
+
+def run(db, steps: list[tuple]) -> tuple[list, float]:
+    stats = WordleStats(db["user_data"], Leaderboard(db["leaderboards"]), ChatMembers(db["chat_members"]))
+    stats.ensure_indexes()
+    start = time.perf_counter()
+    results = [run_step(stats, step) for step in steps]
+    return results, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    parser.add_argument('--sqlite', default=':memory:', help="SQLite database file")
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    steps = workload(args.ops, args.seed)
+    reference = get_database('storage_bench', args.mongo)
+    embedded = get_database('storage_bench', sqlite=args.sqlite)
+
+    expected, reference_seconds = run(reference, steps)
+    actual, embedded_seconds = run(embedded, steps)
+    embedded.flush()
+
+    mismatches = [(i, steps[i], a, b) for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+    for i, step, a, b in mismatches[:5]:
+        print(f"step {i} {step}:\n  reference {a!r}\n  sqlite    {b!r}")
+    same_documents = documents(reference) == documents(embedded)
+
+    print(f"{'backend':>10} {'ops/s':>10}")
+    print(f"{'mongo' if args.mongo else 'mongomock':>10} {len(steps) / reference_seconds:>10.0f}")
+    print(f"{'sqlite':>10} {len(steps) / embedded_seconds:>10.0f}")
+    print(f"{len(mismatches)} of {len(steps)} results differ, stored documents "
+          f"{'match' if same_documents else 'differ'}")
+    sys.exit(0 if not mismatches and same_documents else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+""" Bytes per round trip and allocations per update of user reads for users in 1, 50 and 500 chats
+
+Run from the repository root with
+    python -m benchmarks.user_record_bench [--mongo <connection string>]
+Reply sizes are the BSON size of the returned document. Allocations are the
+peak bytes traced by tracemalloc during a call. Without --mongo an in-memory
+mongomock database is used, whose own copying of the whole document inflates
+the allocation figures; the reply sizes are the same either way.
+"old" reads the whole document into a namedtuple, as get_user_data did before
+per-call-site projections; "new" is the projection update_stats uses. The
+user's chats are stored in chat_members; "legacy B" is the size the document
+had when it held them in a member_of_chats array.
+"""
+import argparse
+import random
+import sys
+import tracemalloc
+from collections import namedtuple
+from bson import encode
+from benchmarks.common import get_database
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.UserData import UserData
+from classes.WordleStats import WordleStats, UPDATE_FIELDS
+from utils.game_history import encode_game
+
+CHAT_COUNTS = [1, 50, 500]
+GAMES = 300
+
+OldUserData = namedtuple(
+    'OldUserData', ['username', 'num_games', 'streak', 'score_avg', 'last_game', 'last_active_chat', 'toggle_retroactive', 'dist', 'recent'])
+
+
+def user_document(user_id: int) -> dict:
+    tries = [random.randint(1, 7) for _ in range(GAMES)]
+    return {
+        "_id": user_id,
+        "username": f"user{user_id}",
+        "score_avg": sum(tries) / GAMES,
+        "num_games": GAMES,
+        "streak": 3,
+        "last_active_chat": -1,
+        "history": "".join(encode_game(edition, t) for edition, t in enumerate(tries, 200)),
+        "dist": [tries.count(t) for t in range(8)],
+        "recent": [float(t) for t in tries[-30:]],
+        "last_grid": 0,
+        "last_game": 200 + GAMES - 1,
+        "toggle_retroactive": False,
+        "warning": True,
+        "lock": False,
+    }
+
+
+def old_read(stats: WordleStats, user_id: int) -> OldUserData:
+    user_data = stats.db.find_one({"_id": user_id}, {"_id": 0})
+    return OldUserData(*(user_data.get(field) for field in OldUserData._fields))
+
+
+def new_read(stats: WordleStats, user_id: int) -> UserData:
+    return stats.get_user_data(user_id, UPDATE_FIELDS)
+
+
+def peak_bytes(func, runs: int = 20) -> float:
+    """ Peak bytes allocated while func runs, averaged over runs """
+    peak = 0
+    for _ in range(runs):
+        tracemalloc.start()
+        func()
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak / runs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    args = parser.parse_args()
+
+    random.seed(0)
+    db = get_database('user_record_bench', args.mongo)
+    stats = WordleStats(db["user_data"], Leaderboard(db["leaderboards"]), ChatMembers(db["chat_members"]))
+    print(f"{'chats':>6} {'legacy B':>9} {'old bytes':>10} {'new bytes':>10} {'old peak B':>11} {'new peak B':>11} "
+          f"{'update peak B':>14} {'record B':>9} {'old record B':>13}")
+    for user_id, chats in enumerate(CHAT_COUNTS, 1):
+        document = user_document(user_id)
+        legacy_bytes = len(encode(document | {"member_of_chats": [-chat for chat in range(1, chats + 1)]}))
+        stats.db.insert_one(document)
+        for chat in range(1, chats + 1):
+            stats.members.add(user_id, -chat)
+        old_bytes = len(encode(stats.db.find_one({"_id": user_id}, {"_id": 0})))
+        new_bytes = len(encode(stats.db.find_one({"_id": user_id}, UserData.projection(UPDATE_FIELDS))))
+        old_peak = peak_bytes(lambda: old_read(stats, user_id))
+        new_peak = peak_bytes(lambda: new_read(stats, user_id))
+        # A same-edition share from the last active chat: one projected read and no write
+        update_peak = peak_bytes(lambda: stats.update_stats(user_id, -1, 200 + GAMES - 1, 4.0, "x"))
+        record = sys.getsizeof(new_read(stats, user_id))
+        old_record = sys.getsizeof(old_read(stats, user_id))
+        print(f"{chats:>6} {legacy_bytes - len(encode({'_id': user_id})):>9} {old_bytes:>10} {new_bytes:>10} {old_peak:>11.0f} {new_peak:>11.0f} "
+              f"{update_peak:>14.0f} {record:>9} {old_record:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+""" Replay synthetic Wordle share traffic through the webhook route: throughput, handler latency and DB operations per update
+
+Run from the repository root with
+    python -m benchmarks.webhook_load [--mongo <connection string>] [--sqlite <file>]
+                                      [--chats N] [--users M] [--updates K] [--days D] [--seed S]
+A seeded mix of Wordle shares with varying editions, tries and grids, chat
+messages, and /stats and /leaderboard commands from M users across N chats is
+POSTed as Telegram Update JSON to the Flask route bot.py serves. The Telegram
+API is stubbed, and the database is an in-memory mongomock database unless
+--mongo or --sqlite is given, with latest_game set to the edition before the
+first one shared. WEBHOOK_WORKERS and the other settings are read
+from the environment as usual; with WEBHOOK_WORKERS=0 handlers run within the
+request. Updates answered with 503 are posted again after RETRY_SECONDS, as
+Telegram would redeliver them. Exits with status 1 if any update fails.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from benchmarks.common import get_database
+from utils.percentiles import percentile
+
+# bot.py reads these at import, placeholders are enough with Telegram stubbed
+os.environ.setdefault('API_KEY', '123456:load-test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('MONGODB_CONNECTION', 'mongodb://localhost')
+
+COLLECTIONS = ["user_data", "leaderboards", "chat_members", "latest_game", "processed_updates"]
+OPERATIONS = ["find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one",
+              "update_many", "replace_one", "delete_one", "delete_many", "count_documents",
+              "aggregate", "bulk_write"]
+KINDS = ["share", "chatter", "stats", "leaderboard"]
+WEIGHTS = [45, 35, 10, 10]
+CHATTER = ["did anyone get today's?", "that was a hard one", "Wordle is brutal today",
+           "lol", "I got it in two!!", "starting word: CRANE", "gm", "who's winning this week?"]
+FIRST_EDITION = 800
+MISS_TILES = "⬛⬜🟨🟩"
+RETRY_SECONDS = 0.01
+
+
+class CountingCollection:
+    """ Collection proxy counting every operation, overall and on the calling thread """
+
+    def __init__(self, collection, counts: Counter, local: threading.local, guard: threading.Lock) -> None:
+        self._collection = collection
+        self._counts = counts
+        self._local = local
+        self._guard = guard
+        for method in OPERATIONS:
+            if hasattr(collection, method):
+                setattr(self, method, self._counter(method))
+
+    def _counter(self, method: str):
+        run = getattr(self._collection, method)
+        key = f"{self._collection.name}.{method}"
+
+        def count(*args, **kwargs):
+            with self._guard:
+                self._counts[key] += 1
+            self._local.ops = getattr(self._local, "ops", 0) + 1
+            return run(*args, **kwargs)
+        return count
+
+    def __getattr__(self, name: str):
+        return getattr(self._collection, name)
+
+
+class CountingDatabase:
+    def __init__(self, db) -> None:
+        self.counts = Counter()
+        self.local = threading.local()
+        self._guard = threading.Lock()
+        self._db = db
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> CountingCollection:
+        if name not in self._collections:
+            self._collections[name] = CountingCollection(self._db[name], self.counts, self.local, self._guard)
+        return self._collections[name]
+
+    def thread_ops(self) -> int:
+        """ Operations run so far on the calling thread """
+        return getattr(self.local, "ops", 0)
+
+
+def stub_telegram() -> list:
+    """ Answer Telegram API calls locally, returning the list of (method, params) called """
+    from telebot import apihelper
+    calls = []
+
+    def make_request(token, method_name, method='get', params=None, files=None, **kwargs):
+        calls.append((method_name, params))
+        params = params or {}
+        if method_name in ("sendMessage", "sendPhoto"):
+            return {"message_id": len(calls), "date": int(time.time()), "text": params.get("text", ""),
+                    "chat": {"id": params.get("chat_id", 0), "type": "group"}}
+        return True
+    apihelper._make_request = make_request
+    return calls
+
+
+def grid(rng: random.Random, tries: str) -> str:
+    """ Emoji grid of a game solved in tries, or of a lost game for X """
+    misses = 6 if tries == "X" else int(tries) - 1
+    rows = []
+    for _ in range(misses):
+        row = "".join(rng.choice(MISS_TILES) for _ in range(5))
+        rows.append(row if row != "🟩" * 5 else "🟨" + "🟩" * 4)
+    if tries != "X":
+        rows.append("🟩" * 5)
+    return "".join(row + "\n" for row in rows)
+
+
+def traffic(updates: int, chats: int, users: int, days: int, seed: int) -> list[dict]:
+    """ Seeded Update dicts, a new Wordle edition every updates / days updates """
+    rng = random.Random(seed)
+    homes = {user: rng.sample(range(1, chats + 1), k=min(chats, rng.choice([1, 1, 1, 2, 3])))
+             for user in range(1, users + 1)}
+    result = []
+    for update_id in range(1, updates + 1):
+        latest = FIRST_EDITION + (update_id - 1) * days // updates
+        user = rng.randint(1, users)
+        chat = -rng.choice(homes[user])
+        kind = rng.choices(KINDS, WEIGHTS)[0]
+        if kind == "share":
+            tries = rng.choice("1234566X" if rng.random() < 0.1 else "23344455")
+            edition = latest - rng.choice([0, 0, 0, 0, 1, 2])
+            text = f"Wordle {edition} {tries}/6\n\n{grid(rng, tries)}"
+        elif kind == "chatter":
+            text = rng.choice(CHATTER)
+        else:
+            text = f"/{kind}"
+        message = {"message_id": update_id, "date": int(time.time()), "text": text,
+                   "from": {"id": user, "is_bot": False, "first_name": f"user{user}"},
+                   "chat": {"id": chat, "type": "group", "title": f"chat{-chat}"}}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        result.append({"update_id": update_id, "kind": kind, "body": json.dumps({"update_id": update_id, "message": message})})
+    return result
+
+
+def time_handlers(bot, database: CountingDatabase, timings: dict) -> None:
+    """ Wrap every registered handler to record its duration and database operations """
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            run = handler['function']
+            samples = timings.setdefault(run.__name__, [])
+
+            def timed(*args, _run=run, _samples=samples, **kwargs):
+                ops = database.thread_ops()
+                start = time.perf_counter()
+                try:
+                    return _run(*args, **kwargs)
+                finally:
+                    _samples.append((time.perf_counter() - start, database.thread_ops() - ops))
+            handler['function'] = timed
+
+
+def replies_made(sender) -> int:
+    """ Messages the handlers sent or left waiting in the sender """
+    stats = sender.stats()
+    return stats["sent"] + stats["failed"] + stats["waiting"]
+
+
+def wait_until_processed(dispatcher, timeout: float = 300) -> None:
+    deadline = time.monotonic() + timeout
+    while dispatcher != None and time.monotonic() < deadline:
+        stats = dispatcher.stats()
+        if stats["processed"] + stats["failed"] >= stats["accepted"]:
+            return
+        time.sleep(0.005)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    parser.add_argument('--sqlite', default='', help="SQLite database file, :memory: for an in-memory one")
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=7, help="Wordle editions the traffic spans")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    db = get_database('webhook_load', args.mongo, args.sqlite, COLLECTIONS)
+    # A bot already running, so /stats and /leaderboard before the first share see a latest edition
+    db["latest_game"].insert_one({"_id": 0, "latest_game": FIRST_EDITION - 1})
+    database = CountingDatabase(db)
+    calls = stub_telegram()
+    import utils.storage
+    utils.storage.get_database = lambda: database
+    import bot
+    if bot.dispatcher == None:
+        # Run handlers within the request rather than on telebot's pool, so the run ends with the last request
+        bot.bot.threaded = False
+
+    timings = {}
+    time_handlers(bot.bot, database, timings)
+    updates = traffic(args.updates, args.chats, args.users, args.days, args.seed)
+    client = bot.server.test_client()
+    route = f"/{bot.API_KEY}"
+    acks, statuses = [], Counter()
+    database.counts.clear()
+    api_calls, replies = len(calls), replies_made(bot.sender)
+
+    start = time.perf_counter()
+    for update in updates:
+        while True:
+            sent = time.perf_counter()
+            response = client.post(route, data=update["body"])
+            acks.append(time.perf_counter() - sent)
+            statuses[response.status_code] += 1
+            if response.status_code != 503:
+                break
+            time.sleep(RETRY_SECONDS)
+    wait_until_processed(bot.dispatcher)
+    seconds = time.perf_counter() - start
+
+    failed = bot.dispatcher.stats()["failed"] if bot.dispatcher != None else 0
+    failed += sum(count for status, count in statuses.items() if status >= 500 and status != 503)
+    kinds = Counter(update["kind"] for update in updates)
+    operations = sum(database.counts.values())
+    acks.sort()
+
+    print(f"{len(updates)} updates ({', '.join(f'{kinds[kind]} {kind}' for kind in KINDS)}) "
+          f"from {args.users} users in {args.chats} chats over {args.days} editions")
+    print(f"throughput {len(updates) / seconds:.0f} updates/s, webhook ack p50 {percentile(acks, 0.5) * 1000:.2f} ms "
+          f"p99 {percentile(acks, 0.99) * 1000:.2f} ms, responses {dict(statuses)}")
+    print(f"\n{'handler':<20} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db ops':>7}")
+    for name, samples in sorted(timings.items()):
+        if not samples:
+            continue
+        durations = sorted(duration for duration, _ in samples)
+        ops = sum(count for _, count in samples) / len(samples)
+        print(f"{name:<20} {len(samples):>6} {percentile(durations, 0.5) * 1000:>8.2f} "
+              f"{percentile(durations, 0.95) * 1000:>8.2f} {percentile(durations, 0.99) * 1000:>8.2f} {ops:>7.2f}")
+    # Replies wait in the sender for Telegram's rate limits, so fewer calls than replies may have been made
+    print(f"\ndb operations per update {operations / len(updates):.2f}, replies per update "
+          f"{(replies_made(bot.sender) - replies) / len(updates):.2f}, "
+          f"telegram calls per update {(len(calls) - api_calls) / len(updates):.2f}")
+    for key, count in database.counts.most_common():
+        print(f"    {key:<40} {count / len(updates):>6.2f}")
+    print(f"{failed} updates failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
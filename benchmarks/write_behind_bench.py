@@ -0,0 +1,157 @@
+""" Shares per second right after a new edition, applied one by one and through write-behind bulk writes
+
+Run from the repository root with
+    python -m benchmarks.write_behind_bench [--mongo <connection string>] [--sqlite <file>]
+                                            [--users N] [--chats N] [--threads N] [--rtt MS] [--cold]
+Users who played yesterday's edition share today's in a burst, some of them
+again in a second chat, from worker threads that each own a share of the users
+as the webhook dispatcher does. Shares are answered once every handler has
+returned, and durable once the write-behind run's final flush is done. Yesterday's shares go through the write-behind instance too, so
+it starts with their records as a dyno running since then would; --cold
+starts it without any. --rtt adds a simulated network round trip to every
+database call. Both runs must leave identical user and leaderboard documents,
+but for the order leaderboard members were added in, which unordered bulk
+writes do not keep across users; exits with status 1 otherwise.
+Without --mongo the embedded SQLite engine is used, in memory unless --sqlite
+is given (mongomock's bulk_write does not accept pymongo 4's requests). Without
+--rtt a round trip to it costs next to nothing, so the gain is far smaller
+than against a MongoDB server.
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from benchmarks.common import get_database, reset
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.WordleStats import WordleStats
+from classes.WriteBehind import WriteBehind
+
+EDITION = 900
+VOLATILE_FIELDS = {"lock_owner", "lock_expires"}
+
+
+class LatentCollection:
+    """ Collection proxy sleeping for a network round trip before every call """
+
+    def __init__(self, collection, rtt: float) -> None:
+        self._collection = collection
+        self._rtt = rtt
+        self.name = collection.name
+
+    def __getattr__(self, name: str):
+        method = getattr(self._collection, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self._rtt)
+            return method(*args, **kwargs)
+        return call
+
+
+def open_stats(db, rtt: float, writes: WriteBehind = None) -> WordleStats:
+    user_data, leaderboards, members = db["user_data"], db["leaderboards"], db["chat_members"]
+    if rtt:
+        user_data, leaderboards, members = (LatentCollection(user_data, rtt), LatentCollection(leaderboards, rtt),
+                                            LatentCollection(members, rtt))
+    return WordleStats(user_data, Leaderboard(leaderboards), ChatMembers(members), writes)
+
+
+def seed(db, stats: WordleStats, users: int, chats: int) -> None:
+    """ Users who all played yesterday, and each chat's materialized leaderboard """
+    reset(db)
+    stats.ensure_indexes()
+    for user_id in range(1, users + 1):
+        stats.ingest_score(user_id, -(user_id % chats + 1), EDITION - 1, 4.0, f"user{user_id}")
+    for chat in range(1, chats + 1):
+        stats.print_leaderboard(chat, -chat, EDITION - 1)
+
+
+def burst(users: int, chats: int, seed: int) -> list[tuple]:
+    rng = random.Random(seed)
+    shares = []
+    for user_id in range(1, users + 1):
+        tries = float(rng.choice("2334445567"))
+        shares.append((user_id, -(user_id % chats + 1), EDITION, tries))
+        if rng.random() < 0.3:
+            shares.append((user_id, -rng.randint(1, chats), EDITION, tries))
+    rng.shuffle(shares)
+    return shares
+
+
+def run(stats: WordleStats, shares: list[tuple], threads: int) -> tuple[float, float]:
+    """ Seconds until every share is answered, and until every share is written """
+    lanes = [[share for share in shares if share[0] % threads == lane] for lane in range(threads)]
+
+    def work(lane: list[tuple]) -> None:
+        for user_id, chat_id, edition, tries in lane:
+            stats.ingest_score(user_id, chat_id, edition, tries, f"user{user_id}")
+
+    workers = [threading.Thread(target=work, args=(lane,)) for lane in lanes]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    answered = time.perf_counter() - start
+    if stats.writes != None:
+        stats.writes.flush()
+    return answered, time.perf_counter() - start
+
+
+def comparable(document: dict) -> dict:
+    document = {key: value for key, value in document.items() if key not in VOLATILE_FIELDS}
+    if "members" in document:
+        document["members"] = sorted(document["members"])
+    return document
+
+
+def documents(db) -> dict:
+    return {name: sorted((comparable(document) for document in db[name].find()),
+                         key=lambda document: repr(document["_id"]))
+            for name in ("user_data", "leaderboards")} | {
+        "chat_members": sorted((pair["chat_id"], pair["user_id"]) for pair in db["chat_members"].find())}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='', help="MongoDB connection string")
+    parser.add_argument('--sqlite', default=':memory:', help="SQLite database file prefix, :memory: for in-memory ones")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rtt', type=float, default=0.0, help="Simulated round trip in milliseconds")
+    parser.add_argument('--cold', action='store_true', help="Start write-behind without any user records")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    shares = burst(args.users, args.chats, args.seed)
+    direct_db, behind_db = (get_database(name, args.mongo, args.sqlite if args.sqlite == ":memory:" else f"{args.sqlite}.{name}")
+                            for name in ("write_behind_bench_direct", "write_behind_bench_behind"))
+    direct = open_stats(direct_db, args.rtt / 1000)
+    writes = WriteBehind()
+    behind = open_stats(behind_db, args.rtt / 1000, writes)
+    seed(direct_db, open_stats(direct_db, 0), args.users, args.chats)
+    seed(behind_db, open_stats(behind_db, 0, writes), args.users, args.chats)
+    writes.flush()
+    if args.cold:
+        writes.forget()
+    seeded = writes.stats()
+    direct_answered, direct_durable = run(direct, shares, args.threads)
+    behind_answered, behind_durable = run(behind, shares, args.threads)
+    writes.stop()
+
+    same = documents(direct_db) == documents(behind_db)
+    stats = {key: value - seeded[key] for key, value in writes.stats().items()}
+    print(f"{len(shares)} shares from {args.users} users in {args.chats} chats on {args.threads} threads, "
+          f"{args.rtt:g} ms round trips, {'cold' if args.cold else 'warm'} records")
+    print(f"{'path':>14} {'answered/s':>11} {'durable/s':>10}")
+    print(f"{'per message':>14} {len(shares) / direct_answered:>11.0f} {len(shares) / direct_durable:>10.0f}")
+    print(f"{'write-behind':>14} {len(shares) / behind_answered:>11.0f} {len(shares) / behind_durable:>10.0f}")
+    print(f"{stats['written']} writes in {stats['bulk_writes']} bulk writes over {stats['flushes']} flushes, "
+          f"stored documents {'match' if same else 'differ'}")
+    sys.exit(0 if same else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,47 @@
+import time
+# Taken before any other import, so the startup breakdown covers them
+BOOT = time.perf_counter()
+import logging
 import telebot
 import os
+import requests
+import signal
+import sys
+import tempfile
+import threading
+from functools import partial
 from telebot import types
 from decouple import config
 from flask import Flask, request
 from classes.WordleStats import WordleStats
-from utils.load_mongo_db import get_database
+from utils.storage import get_database, ping
 from handlers.global_db_handler import GlobalDB
-from utils.messages import START_TEXT, HELP_TEXT, NO_DATA_MSG, INVALID_AVG
-from utils.message_handler import extract_command
+from handlers.update_dispatcher import UpdateDispatcher
+from handlers.update_dedup import UpdateDedup
+from handlers.message_sender import MessageSender
+from handlers.metrics import metrics
+from utils.messages import START_TEXT, HELP_TEXT, NO_DATA_MSG, INVALID_AVG, RANKS_NOT_READY, SUMMARY_UNAVAILABLE
+from utils.message_handler import extract_command, is_score
+from utils.user_transfer import file_format
+
+logger = logging.getLogger(__name__)
+phase_start = metrics.phase("imports", BOOT)
 
 API_KEY = config('API_KEY')
 ADMIN_ID = int(config('ADMIN_ID'))
-bot = telebot.TeleBot(API_KEY)
-bot.set_my_commands([
+# With webhook workers, handlers run on the dispatcher's threads instead of telebot's pool
+WEBHOOK_WORKERS = config('WEBHOOK_WORKERS', default=4, cast=int)
+WEBHOOK_QUEUE_SIZE = config('WEBHOOK_QUEUE_SIZE', default=100, cast=int)
+# Heroku kills a dyno 30 seconds after SIGTERM
+SHUTDOWN_TIMEOUT = config('SHUTDOWN_TIMEOUT', default=20.0, cast=float)
+# Register the command menu and warm up the database after the port is bound, Heroku allows 60 seconds to bind it
+DEFER_STARTUP = config('DEFER_STARTUP', default=True, cast=bool)
+bot = telebot.TeleBot(API_KEY, threaded=WEBHOOK_WORKERS == 0)
+COMMANDS = [
     telebot.types.BotCommand("/stats", "show your stats"),
     telebot.types.BotCommand("/leaderboard", "show chat leaderboard"),
+    telebot.types.BotCommand("/globalrank", "show your rank among all players"),
+    telebot.types.BotCommand("/globaltop", "show the best players across all chats"),
     telebot.types.BotCommand("/clear", "clear your data"),
     telebot.types.BotCommand("/name", "change display name"),
     telebot.types.BotCommand("/games", "change total games"),
@@ -24,38 +51,65 @@ bot.set_my_commands([
         "/adjust", "calculate score average with old data"),
     telebot.types.BotCommand(
         "/toggleretroactive", "toggle retroactive stats updates for older games"),
+    telebot.types.BotCommand(
+        "/dailysummary", "toggle a daily post of the chat's results"),
     telebot.types.BotCommand("/help", "show help message"),
-])
+]
 
 server = Flask(__name__)
+phase_start = metrics.phase("app", phase_start)
+
+# Before the MongoDB client is created, so its commands are timed per handler
+metrics.listen_to_mongo()
+database = get_database()
+score_db = GlobalDB(database)
+dedup = UpdateDedup(database["processed_updates"])
+# Replies are queued and sent within Telegram's rate limits by the sender's threads
+sender = MessageSender(bot)
+score_db.start_summaries(sender)
+phase_start = metrics.phase("services", phase_start)
+
+
+@metrics.updates
+def process_updates(updates: list[telebot.types.Update]) -> None:
+    """ Process updates, dropping redeliveries before any handler runs """
+    bot.process_new_updates(
+        [update for update in updates if not dedup.seen(update.update_id)])
 
-score_db = GlobalDB(get_database())
+
+dispatcher = UpdateDispatcher(process_updates, WEBHOOK_WORKERS,
+                              WEBHOOK_QUEUE_SIZE) if WEBHOOK_WORKERS else None
 
 # --------------------------------------------------------------USER FUNCTIONS
 
 
 @bot.message_handler(commands=['greet'])
+@metrics.handler
 def greet(message):
-    bot.send_message(message.chat.id, "sup hello")
+    sender.send_message(message.chat.id, "sup hello")
 
 
 @bot.message_handler(commands=['start'])
+@metrics.handler
 def send_welcome(message):
-    bot.send_message(message.chat.id, START_TEXT)
+    sender.send_message(message.chat.id, START_TEXT)
 
 
 @bot.message_handler(commands=['help'])
+@metrics.handler
 def send_help(message):
-    bot.send_message(message.chat.id, HELP_TEXT, parse_mode="MarkdownV2")
+    sender.send_message(message.chat.id, HELP_TEXT, parse_mode="MarkdownV2")
 
 
-@bot.message_handler(regexp='^Wordle\s(?P<edition>\d+)\s(?P<tries>[0-6X])/6\n{2}(?:(?:[🟨🟩⬛️⬜️]+)(?:\r?\n)){1,6}')
+@bot.message_handler(func=metrics.filter("is_score", lambda message: is_score(message.text)))
+@metrics.handler
 def add_score(message):
     """ Update user's data when message matches Wordle Score share regex pattern """
-    score_db.add_score(message=message, bot=bot)
+    score_db.add_score(message=message, bot=sender)
 
 
 @bot.message_handler(commands=['stats', 'leaderboard'])
+@metrics.handler
 def print_scores(message):
     """ Print user's stats or chat's leaderboard upon command """
     try:
@@ -63,16 +117,41 @@ def print_scores(message):
         command = extract_command(command)
         err_msg = "your stats" if command == 'stats' else "the chat's leaderboard"
 
+        if command == 'leaderboard' and score_db.renderer != None:
+            key, photo = score_db.leaderboard_photo(
+                chat_id=message.chat.id, user_id=message.from_user.id)
+            # Once uploaded, the same leaderboard is sent again by file_id
+            sender.send_photo(message.chat.id, photo,
+                              on_sent=partial(score_db.renderer.remember, key))
+            return
         res = score_db.print_scores(
             chat_id=message.chat.id, user_id=message.from_user.id, cmd=command)
-        bot.send_message(message.chat.id, res, parse_mode="MarkdownV2")
+        sender.send_message(message.chat.id, res, parse_mode="MarkdownV2")
     except WordleStats.UserNotFound:
         no_update_msg = NO_DATA_MSG + \
             f" After being added, you will then be able to print {err_msg}."
-        bot.reply_to(message, no_update_msg)
+        sender.reply_to(message, no_update_msg)
+
+
+@bot.message_handler(commands=['globalrank', 'globaltop'])
+@metrics.handler
+def print_global(message):
+    """ Print user's rank among all players or the best players across all chats """
+    try:
+        command = extract_command(message.text)
+        res = score_db.print_global(user_id=message.from_user.id, cmd=command)
+        if command == 'globaltop':
+            sender.send_message(message.chat.id, res, parse_mode="MarkdownV2")
+        else:
+            sender.reply_to(message, res)
+    except WordleStats.RanksNotReady:
+        sender.reply_to(message, RANKS_NOT_READY)
+    except WordleStats.UserNotFound:
+        sender.reply_to(message, NO_DATA_MSG)
 
 
 @ bot.message_handler(commands=['clear'])
+@metrics.handler
 def clear(message):
     """ Clear database upon command """
     warning_text = f"Are you sure you want to delete your data?\n\n⚠ *WARNING:*\n This will cause you to *permanently* lose your data\!"
@@ -80,13 +159,14 @@ def clear(message):
     markup.add(types.InlineKeyboardButton(
         text='Yes', callback_data=message.from_user.id),
         types.InlineKeyboardButton(text='Cancel', callback_data='no'))
-    bot.reply_to(message,
+    sender.reply_to(message,
                  warning_text,
                  reply_markup=markup,
                  parse_mode="MarkdownV2")
 
 
 @ bot.callback_query_handler(func=lambda call: True)
+@metrics.handler
 def handle_query(call):
     remove_markup = bot.edit_message_reply_markup(inline_message_id=call.inline_message_id,
                                                   message_id=call.message.message_id,
@@ -94,7 +174,7 @@ def handle_query(call):
                                                   reply_markup=types.InlineKeyboardMarkup())
     try:
         if call.data == 'no':
-            bot.send_message(call.message.chat.id, "Clear aborted.")
+            sender.send_message(call.message.chat.id, "Clear aborted.")
             remove_markup
         else:
             # print(call.from_user.id)
@@ -102,13 +182,13 @@ def handle_query(call):
             # print(user_id)
             if user_id == call.from_user.id:
                 score_db.clear_data(user_id)
-                bot.send_message(call.message.chat.id,
+                sender.send_message(call.message.chat.id,
                                  "Cleared user database.")
                 remove_markup
     except WordleStats.UserNotFound:
         username = call.from_user.username
         name = call.from_user.first_name if username == None else "@" + username
-        bot.send_message(
+        sender.send_message(
             call.message.chat.id,
             f"You have no data stored to clear, {name}! Share your Wordle results to add yourself to the database.")
         remove_markup
@@ -117,6 +197,7 @@ def handle_query(call):
 
 
 @ bot.message_handler(commands=['name', 'games', 'streak', 'average'])
+@metrics.handler
 def manual_set(message):
     """ Allow user to manually set data """
     msg = message.text.split(None, 1)
@@ -132,13 +213,13 @@ def manual_set(message):
         )
         msg = f"Successfully updated your {command} to *{input}*\!" if command != 'average' else f"Successfully updated your {command} to *{float(input):.3f}*\!"
         msg = msg.replace(".", "\.")
-        bot.reply_to(message, msg, parse_mode="MarkdownV2")
+        sender.reply_to(message, msg, parse_mode="MarkdownV2")
     except WordleStats.InvalidAvg:
-        bot.reply_to(message, INVALID_AVG)
+        sender.reply_to(message, INVALID_AVG)
     except WordleStats.UserNotFound:
         no_update_msg = NO_DATA_MSG + \
             " After being added, you will then be able to update your user data."
-        bot.reply_to(message, no_update_msg)
+        sender.reply_to(message, no_update_msg)
     except (ValueError, IndexError):
         if command == 'streak' or command == 'games':
             value_type = "whole number "
@@ -146,11 +227,12 @@ def manual_set(message):
             value_type = "numerical "
         else:
             value_type = ""
-        bot.reply_to(
+        sender.reply_to(
             message, f"Expected a single {value_type}value after /{command}!")
 
 
 @ bot.message_handler(commands=['adjust'])
+@metrics.handler
 def cumulative_set(message):
     """ Allow user to cumulatively adjust data """
     try:
@@ -165,114 +247,279 @@ def cumulative_set(message):
         )
         msg = f"Successfully updated your games and average to *{new_games}* and *{new_avg:.3f}*\!".replace(
             ".", "\.")
-        bot.reply_to(message, msg, parse_mode="MarkdownV2")
+        sender.reply_to(message, msg, parse_mode="MarkdownV2")
     except WordleStats.InvalidAvg:
-        bot.reply_to(message, INVALID_AVG)
+        sender.reply_to(message, INVALID_AVG)
     except WordleStats.UserNotFound:
         no_update_msg = NO_DATA_MSG + \
             " After being added, you will then be able to update your user data."
-        bot.reply_to(message, no_update_msg)
+        sender.reply_to(message, no_update_msg)
     except ValueError:
-        bot.reply_to(
+        sender.reply_to(
             message, f"Expected two numerical values after /adjust! e.g. /adjust 4.5 20. See /help for explanation of the example.")
 
 
 @ bot.message_handler(commands=['toggleretroactive'])
+@metrics.handler
 def toggle_retroactive(message):
     toggle_state = score_db.toggle_retroactive(message.from_user.id)
     if toggle_state:
         msg = "You are now able to have Wordle results for older games update your stats \(except streak\)\."
     else:
         msg = "Sharing Wordle results for older games will not factor into your stats\."
-    bot.reply_to(
+    sender.reply_to(
         message, f"Retroactive updates for you is now set to *{toggle_state}*\. {msg}", parse_mode="MarkdownV2")
     
 @ bot.message_handler(commands=['togglewarning'])
-def toggle_retroactive(message):
+@metrics.handler
+def toggle_warning(message):
     toggle_state = score_db.toggle_warning(message.from_user.id)
     if toggle_state:
         msg = "Warnings are turned *on*\. Sharing older games do not affect your stats, and you WILL receive a notification when you do so\."
     else:
         msg = "Warnings are now *muted*\. Sharing older games do not affect your stats, and you will NOT receive a notification when you do so\. Use /togglewarning to turn warnings back on\."
-    bot.reply_to(
+    sender.reply_to(
         message, msg, parse_mode="MarkdownV2")
 
+@ bot.message_handler(commands=['dailysummary'])
+@metrics.handler
+def toggle_summary(message):
+    toggle_state = score_db.toggle_summary(message.chat.id)
+    if toggle_state == None:
+        sender.reply_to(message, SUMMARY_UNAVAILABLE)
+    elif toggle_state:
+        sender.reply_to(message, "This chat will get each day's Wordle results once the next Wordle is out.")
+    else:
+        sender.reply_to(message, "This chat will no longer get daily Wordle results.")
+
 # --------------------------------------------------------------DEBUG FUNCTIONS
 
 
 @ bot.message_handler(commands=['adminuser'])
+@metrics.handler
 def manual_score(message):
     """ Allow admin to add test user so as to test bot in Telegram """
     id = message.from_user.id
     _, user_id, user_name, message_text = message.text.split(None, 3)
     if id == ADMIN_ID and user_id != 0:
-        score_db.add_score(message, bot, True, int(
+        score_db.add_score(message, sender, True, int(
             user_id), user_name, message_text)
 
 
 @ bot.message_handler(commands=['admingame'])
-def restart(message):
+@metrics.handler
+def set_latest_game(message):
     """ Allow admin to manually set latest game """
     id = message.from_user.id
     _, latest_game, *_ = message.text.split()
     if id == ADMIN_ID:
         score_db.set_latest_game(int(latest_game))
-        bot.reply_to(
+        sender.reply_to(
             message, "Successfuly updated global latest game variable!")
 
 
 @ bot.message_handler(commands=['adminclear'])
-def restart(message):
+@metrics.handler
+def clear_debug(message):
     """ Allow admin to clear debug users """
     id = message.from_user.id
     if id == ADMIN_ID:
         score_db.clear_debug(ADMIN_ID)
-        bot.reply_to(
+        sender.reply_to(
             message, "Successfuly cleared debug chat database!")
 
 
 @ bot.message_handler(commands=['admincheck'])
-def restart(message):
+@metrics.handler
+def check_latest_game(message):
     """ Allow admin to clear debug users """
     id = message.from_user.id
     if id == ADMIN_ID:
-        bot.reply_to(
+        sender.reply_to(
             message, f"Latest game in the database is *{score_db.get_latest_game()}*\!", parse_mode="MarkdownV2")
 
 @ bot.message_handler(commands=['adminlock'])
+@metrics.handler
 def test_lock(message):
     """ Test lock feature """
     id = message.from_user.id
     if id == ADMIN_ID:
         score_db.test_lock(id)
-        bot.reply_to(
+        sender.reply_to(
             message, "Successfuly retrieved user data with write=True!")
         
 @ bot.message_handler(commands=['admintoggle'])
+@metrics.handler
 def toggle_lock(message):
     """ Test lock feature """
     id = message.from_user.id
     if id == ADMIN_ID:
         new_state = score_db.toggle_lock(id)
-        bot.reply_to(
+        sender.reply_to(
             message, f"Successfuly toggled lock to {new_state}!")
         
 @ bot.message_handler(commands=['adminchecklock'])
+@metrics.handler
 def check_lock(message):
     """ Test lock feature """
     id = message.from_user.id
     if id == ADMIN_ID:
         state = score_db.check_lock(id)
-        bot.reply_to(
+        sender.reply_to(
             message, f"Lock is currently set to {state}!")
 
+@ bot.message_handler(commands=['adminrebuild'])
+@metrics.handler
+def rebuild_stats(message):
+    """ Allow admin to recompute a user's stats from their game history """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        _, user_id, *_ = message.text.split()
+        try:
+            stats = score_db.rebuild_stats(int(user_id))
+        except WordleStats.UserNotFound:
+            sender.reply_to(message, "No game history stored for this user!")
+            return
+        except WordleStats.HistoryIncomplete:
+            sender.reply_to(message, "This user has games from before their history was kept, their stats were left as they are!")
+            return
+        sender.reply_to(
+            message, f"Rebuilt stats from history: {stats['num_games']} games, streak {stats['streak']}, average {stats['score_avg']:.3f}")
+
+@ bot.message_handler(commands=['adminlocks'])
+@metrics.handler
+def lock_stats(message):
+    """ Show lock wait-time and contention counters """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        stats = score_db.lock_stats()
+        sender.reply_to(
+            message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['admindedup'])
+@metrics.handler
+def dedup_stats(message):
+    """ Show how many redelivered updates were dropped """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        stats = dedup.stats()
+        sender.reply_to(
+            message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['adminqueue'])
+@metrics.handler
+def queue_stats(message):
+    """ Show webhook queue depth and processing latency """
+    id = message.from_user.id
+    if id == ADMIN_ID and dispatcher != None:
+        stats = dispatcher.stats()
+        sender.reply_to(
+            message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['adminsender'])
+@metrics.handler
+def sender_stats(message):
+    """ Show outbound message counters, throttling and send latency """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        stats = sender.stats()
+        sender.reply_to(
+            message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['adminwrites'])
+@metrics.handler
+def write_stats(message):
+    """ Show buffered write counters when write-behind is on """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        stats = score_db.write_stats()
+        if stats != None:
+            sender.reply_to(
+                message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['adminimages'])
+@metrics.handler
+def image_stats(message):
+    """ Show leaderboard image render times and file_id cache hit rate when images are on """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        stats = score_db.image_stats()
+        if stats != None:
+            sender.reply_to(
+                message, "\n".join(f"{key}: {value}" for key, value in stats.items()))
+
+@ bot.message_handler(commands=['adminimport'])
+@metrics.handler
+def import_stats(message):
+    """ Set user stats from a CSV or NDJSON file, sent as a document the command replies to; 'check' only validates it """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        document = message.reply_to_message.document if message.reply_to_message != None else None
+        if document == None:
+            sender.reply_to(message, "Reply to a .csv or .ndjson document with /adminimport [check]")
+            return
+        check = message.text.split()[1:2] == ["check"]
+        # Streamed line by line, Bot API downloads are capped at 20MB; use utils/user_transfer.py for larger files
+        with requests.get(bot.get_file_url(document.file_id), stream=True, timeout=60) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8-sig"
+            report = score_db.import_stats(response.iter_lines(decode_unicode=True),
+                                           file_format(document.file_name or ""), check)
+        sender.reply_to(message, str(report))
+
+@ bot.message_handler(commands=['adminexport'])
+@metrics.handler
+def export_stats(message):
+    """ Send every user's stats as a CSV document, or NDJSON with 'ndjson' """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        format = "ndjson" if message.text.split()[1:2] == ["ndjson"] else "csv"
+        # Spooled to disk rather than held in memory
+        with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as file:
+            score_db.export_stats(file, format)
+            file.seek(0)
+            bot.send_document(message.chat.id, (f"user_data.{format}", file.buffer),
+                              reply_to_message_id=message.message_id)
+
+@ bot.message_handler(commands=['adminperf'])
+@metrics.handler
+def perf_stats(message):
+    """ Show the handlers and database commands taking the most time """
+    id = message.from_user.id
+    if id == ADMIN_ID:
+        sender.reply_to(message, metrics.summary())
+
 @server.route(f'/{API_KEY}', methods=['POST'])
 def get_updates():
     # retrieve the message in JSON and then transform it to Telegram object
-    bot.process_new_updates(
-        [telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
+    update = telebot.types.Update.de_json(request.stream.read().decode("utf-8"))
+    if dispatcher == None:
+        process_updates([update])
+    elif not dispatcher.submit(update):
+        # Full or shutting down, Telegram retries the update later
+        return "busy", 503
     return "!", 200
 
+@server.route("/health")
+def health():
+    """ Health probe, failing while MongoDB cannot be reached """
+    latency = ping()
+    if latency == None:
+        return "mongodb unreachable", 503
+    return f"ok {latency * 1000:.1f} ms", 200
+
+@server.route("/metrics")
+def prometheus_metrics():
+    """ Handler, database and Telegram metrics in Prometheus' text format """
+    gauges = {"sender": sender.stats(), "dedup": dedup.stats(), "members": score_db.member_stats()}
+    if score_db.renderer != None:
+        gauges["leaderboard_images"] = score_db.image_stats()
+    if score_db.summaries != None:
+        gauges["daily_summary"] = score_db.summary_stats()
+    if dispatcher != None:
+        gauges["webhook"] = dispatcher.stats()
+    return metrics.render(gauges), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 @server.route("/")
 def webhook():
     bot.remove_webhook()
@@ -281,5 +528,41 @@ def webhook():
     return "!", 200
 
 
+def warm_up() -> None:
+    """ Blocking Telegram and database round trips, kept off the path to binding the port """
+    start = time.perf_counter()
+    try:
+        bot.set_my_commands(COMMANDS)
+    except Exception:
+        logger.exception("Failed to register the bot commands")
+    start = metrics.phase("commands", start)
+    score_db.warm_up()
+    metrics.phase("warm_up", start)
+
+
+metrics.phase("handlers", phase_start)
+metrics.phase("startup", BOOT)
+if DEFER_STARTUP:
+    threading.Thread(target=warm_up, daemon=True).start()
+else:
+    warm_up()
+
+
+def shutdown(signum, frame):
+    """ Heroku sends SIGTERM before stopping the dyno: finish the queued updates, flush their writes and send their replies """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    if dispatcher != None:
+        dispatcher.stop(SHUTDOWN_TIMEOUT)
+    if score_db.writes != None:
+        try:
+            score_db.writes.stop()
+        except Exception:
+            logger.exception("Failed to flush buffered writes on shutdown")
+    # Replies get whatever is left of the timeout, those still rate limited then are dropped
+    sender.stop(max(deadline - time.monotonic(), 0))
+    sys.exit(0)
+
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, shutdown)
     server.run(host="0.0.0.0", port=int(os.environ.get('PORT', 8443)))
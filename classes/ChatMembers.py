@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+from decouple import config
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+# (chat_id, user_id) pairs known to be stored, so joining a chat again costs no round trip
+MEMBERS_CACHE_SIZE = config('MEMBERS_CACHE_SIZE', default=100000, cast=int)
+MIGRATE_BATCH = 1000
+
+
+class ChatMembers:
+    """
+    Class storing which users belong to which chats, one document per pair.
+
+    Pairs live in their own collection under a unique (chat_id, user_id) index
+    rather than in an array on the user document, so a user in hundreds of
+    chats neither grows their document nor has it rewritten on every command.
+    Pairs already stored are remembered in a bounded in-process LRU and never
+    written again; a pair another process removes stays cached here until it
+    is evicted. migrated is False until member_of_chats arrays left on user
+    documents have been moved here, while the pairs are still incomplete.
+
+    Attributes
+    ----------
+    chat_id: int
+        Telegram chat id
+    user_id: int
+        Telegram user id
+    """
+
+    def __init__(self, db, cache_size: int = MEMBERS_CACHE_SIZE, migrated: bool = True) -> None:
+        self.db = db
+        self.cache_size = cache_size
+        self.migrated = migrated
+        self._seen = OrderedDict()  # (chat_id, user_id) -> None, least recently used first
+        self._guard = threading.Lock()
+        self._counters = {
+            "cached": 0,
+            "upserts": 0,
+            "joined": 0,
+        }
+
+    def ensure_indexes(self) -> None:
+        """ Index the pairs uniquely, and by user for removal """
+        self.db.create_index([("chat_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+        self.db.create_index("user_id")
+
+    # --------------------------------------------------CACHE
+    def _cached(self, key: tuple[int, int]) -> bool:
+        with self._guard:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                self._counters["cached"] += 1
+                return True
+            return False
+
+    def _remember(self, key: tuple[int, int]) -> None:
+        with self._guard:
+            self._seen[key] = None
+            if len(self._seen) > self.cache_size:
+                self._seen.popitem(last=False)
+
+    # --------------------------------------------------WRITES
+    def add(self, user_id: int, chat_id: int, writes=None) -> bool:
+        """ Add user_id to chat_id, or queue it on writes, returning whether they were not a member before """
+        key = (chat_id, user_id)
+        if self._cached(key):
+            return False
+        pair = {"chat_id": chat_id, "user_id": user_id}
+        if writes != None:
+            writes.update_one(self.db, user_id, pair, {"$setOnInsert": pair}, upsert=True)
+            joined = True
+        else:
+            try:
+                joined = self.db.update_one(pair, {"$setOnInsert": pair}, upsert=True).upserted_id != None
+            except DuplicateKeyError:
+                # Upserted by another worker at the same time
+                joined = False
+        self._remember(key)
+        with self._guard:
+            self._counters["upserts"] += 1
+            self._counters["joined"] += joined
+        return joined
+
+    def remove(self, user_ids: list[int]) -> None:
+        """ Remove users from every chat """
+        self.db.delete_many({"user_id": {"$in": user_ids}})
+        removed = set(user_ids)
+        with self._guard:
+            for key in [key for key in self._seen if key[1] in removed]:
+                del self._seen[key]
+
+    # --------------------------------------------------READS
+    def members(self, chat_id: int) -> list[int]:
+        return [pair["user_id"] for pair in self.db.find({"chat_id": chat_id}, {"_id": 0, "user_id": 1})]
+
+    def stats(self) -> dict:
+        with self._guard:
+            return dict(self._counters, size=len(self._seen))
+
+    # --------------------------------------------------MIGRATION
+    def migrate(self, user_data) -> int:
+        """ Move the member_of_chats arrays of user documents into pairs, returning how many users were moved """
+        # Idempotent, so a migration interrupted by a restart is simply run again
+        moved = 0
+        while True:
+            users = list(user_data.find({"member_of_chats": {"$exists": True}},
+                                        {"member_of_chats": 1}).limit(MIGRATE_BATCH))
+            if not users:
+                self.migrated = True
+                return moved
+            pairs = [UpdateOne({"chat_id": chat_id, "user_id": user["_id"]},
+                               {"$setOnInsert": {"chat_id": chat_id, "user_id": user["_id"]}}, upsert=True)
+                     for user in users for chat_id in set(user["member_of_chats"] or [])]
+            if pairs:
+                self.db.bulk_write(pairs, ordered=False)
+            user_data.update_many({"_id": {"$in": [user["_id"] for user in users]}},
+                                  {"$unset": {"member_of_chats": ""}})
+            moved += len(users)
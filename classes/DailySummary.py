@@ -0,0 +1,140 @@
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable
+from decouple import config
+from pymongo import ASCENDING
+
+DAILY_SUMMARY = config('DAILY_SUMMARY', default=False, cast=bool)
+# Summaries are spread out at this rate, leaving the rest of Telegram's limits to replies
+DAILY_SUMMARY_PER_SECOND = config('DAILY_SUMMARY_PER_SECOND', default=1.0, cast=float)
+# Results are only read for the edition that just ended
+DAILY_RESULTS_TTL = config('DAILY_RESULTS_TTL_SECONDS', default=3 * 86400, cast=int)
+SUMMARY_STREAK_BATCH = 1000
+
+
+def streak_at(streak: int, last_game: int, edition: int) -> int:
+    """ Streak a player had on edition, given their streak as of last_game, 0 if it cannot be told """
+    if last_game == edition:
+        return streak
+    # A streak reaching back past edition covers it; otherwise the games in between are not known here
+    return streak - (last_game - edition) if last_game > edition and streak > last_game - edition else 0
+
+
+class DailySummary:
+    """
+    Class posting each Wordle edition's results to the chats that opted in.
+
+    Every share is recorded in results, one document per edition, chat and
+    player. Once an edition ends, a single aggregation groups its results by
+    chat for all opted-in chats at once, and run, from a background thread,
+    sends one summary per chat at DAILY_SUMMARY_PER_SECOND. Each chat is claimed by
+    moving its posted checkpoint forward before its summary is sent, so a
+    restart, or another process running the same edition, never posts twice.
+
+    Attributes
+    ----------
+    _id: int
+        Telegram chat id, in chats
+    enabled: bool
+        Whether the chat gets summaries
+    posted: int
+        Last edition summarised, or the one before the chat opted in
+    """
+
+    def __init__(self, results, chats, per_second: float = DAILY_SUMMARY_PER_SECOND) -> None:
+        self.results = results
+        self.chats = chats
+        self.per_second = per_second
+        self._running = set()  # editions being summarised by this process
+        self._guard = threading.Lock()
+        self._counters = {
+            "editions": 0,
+            "posted": 0,
+            "claimed_elsewhere": 0,
+        }
+
+    def ensure_indexes(self) -> None:
+        self.results.create_index([("edition", ASCENDING), ("chat_id", ASCENDING)])
+        self.results.create_index("shared", expireAfterSeconds=DAILY_RESULTS_TTL)
+
+    # --------------------------------------------------RECORDING
+    def record(self, edition: int, chat_id: int, user_id: int, username: str, tries: float, writes=None) -> None:
+        """ Record a share, keeping the first one of an edition in each chat """
+        result = {"edition": edition, "chat_id": chat_id, "user_id": user_id,
+                  "username": username, "tries": tries, "shared": datetime.now(timezone.utc)}
+        filter = {"_id": f"{edition}:{chat_id}:{user_id}"}
+        if writes != None:
+            writes.update_one(self.results, user_id, filter, {"$setOnInsert": result}, upsert=True)
+        else:
+            self.results.update_one(filter, {"$setOnInsert": result}, upsert=True)
+
+    def toggle(self, chat_id: int, latest_game: int) -> bool:
+        """ Opt chat_id in or out, returning the new state; a chat opting in is summarised from the current edition on """
+        chat = self.chats.find_one({"_id": chat_id}, {"enabled": 1})
+        enabled = chat == None or not chat['enabled']
+        update = {"$set": {"enabled": enabled}}
+        if enabled:
+            update["$max"] = {"posted": latest_game - 1}
+        self.chats.update_one({"_id": chat_id}, update, upsert=True)
+        return enabled
+
+    # --------------------------------------------------SUMMARIES
+    def pending(self, edition: int) -> list[dict]:
+        """ Results of edition grouped by opted-in chat not yet summarised, best tries first """
+        chat_ids = [chat['_id'] for chat in self.chats.find({"enabled": True, "posted": {"$lt": edition}}, {"_id": 1})]
+        if not chat_ids:
+            return []
+        return list(self.results.aggregate([
+            {"$match": {"edition": edition, "chat_id": {"$in": chat_ids}}},
+            {"$sort": {"tries": 1, "username": 1}},
+            {"$group": {"_id": "$chat_id",
+                        "players": {"$push": {"user_id": "$user_id", "username": "$username", "tries": "$tries"}}}},
+        ]))
+
+    def streaks(self, user_data, edition: int, user_ids: list[int]) -> dict[int, int]:
+        """ Streak of each player on edition """
+        streaks = {}
+        for start in range(0, len(user_ids), SUMMARY_STREAK_BATCH):
+            for user in user_data.find({"_id": {"$in": user_ids[start:start + SUMMARY_STREAK_BATCH]}},
+                                       {"streak": 1, "last_game": 1}):
+                streaks[user['_id']] = streak_at(user['streak'], user['last_game'], edition)
+        return streaks
+
+    def claim(self, chat_id: int, edition: int) -> bool:
+        """ Move chat_id's checkpoint to edition, False if it was already there or the chat opted out """
+        return self.chats.update_one({"_id": chat_id, "enabled": True, "posted": {"$lt": edition}},
+                                     {"$set": {"posted": edition}}).modified_count == 1
+
+    def run(self, edition: int, user_data, send: Callable[[int, int, list[tuple[str, float, int]]], None]) -> int:
+        """ Send edition's summary to every opted-in chat through send(chat_id, edition, players), returning how many were sent """
+        with self._guard:
+            if edition in self._running:
+                return 0
+            self._running.add(edition)
+        try:
+            groups = self.pending(edition)
+            streaks = self.streaks(user_data, edition,
+                                   list({player['user_id'] for group in groups for player in group['players']}))
+            sent = 0
+            for group in groups:
+                if sent:
+                    time.sleep(1 / self.per_second)
+                if not self.claim(group['_id'], edition):
+                    with self._guard:
+                        self._counters["claimed_elsewhere"] += 1
+                    continue
+                send(group['_id'], edition, [(player['username'], player['tries'], streaks.get(player['user_id'], 0))
+                                             for player in group['players']])
+                sent += 1
+            with self._guard:
+                self._counters["editions"] += 1
+                self._counters["posted"] += sent
+            return sent
+        finally:
+            with self._guard:
+                self._running.discard(edition)
+
+    def stats(self) -> dict:
+        with self._guard:
+            return dict(self._counters)
@@ -0,0 +1,159 @@
+import threading
+from decouple import config
+
+# Players with fewer games are left out of global ranks, so one lucky game does not top them
+GLOBAL_MIN_GAMES = config('GLOBAL_MIN_GAMES', default=10, cast=int)
+# Seconds between rebuilds from the database, which pick up changes made by other processes
+GLOBAL_RANK_REFRESH = config('GLOBAL_RANK_REFRESH', default=3600.0, cast=float)
+GLOBAL_TOP_SIZE = config('GLOBAL_TOP_SIZE', default=10, cast=int)
+# Score averages are ranked in buckets of RANK_STEP between MIN_AVG and MAX_AVG, one Fenwick tree node each
+MIN_AVG = 1.0
+MAX_AVG = 7.0
+RANK_STEP = 0.001
+
+
+class GlobalRank:
+    """
+    Class ranking every player with at least min_games games by score average.
+
+    Averages are rounded to RANK_STEP and counted per bucket in a Fenwick tree,
+    so ranks, percentiles and the global top are answered in O(log n) without
+    sorting user_data. Players in the same bucket share a rank. Changes are
+    applied as WordleStats writes them, and the whole index is rebuilt from
+    the database every GLOBAL_RANK_REFRESH seconds, taking in the changes
+    other processes made.
+
+    Attributes
+    ----------
+    min_games: int
+        Games a player needs to be ranked
+    """
+
+    def __init__(self, min_games: int = GLOBAL_MIN_GAMES) -> None:
+        self.min_games = min_games
+        self._size = round((MAX_AVG - MIN_AVG) / RANK_STEP) + 1
+        self._guard = threading.Lock()
+        self._tree = [0] * (self._size + 1)  # 1-based Fenwick tree of players per bucket
+        self._bucket_of = {}  # user_id -> bucket
+        self._players = {}  # bucket -> set of user ids
+        self._changes = None  # user_id -> row, changes made while a rebuild reads the database
+        self.ready = False
+
+    def _bucket(self, score_avg: float) -> int:
+        return min(max(round((score_avg - MIN_AVG) / RANK_STEP), 0), self._size - 1)
+
+    # --------------------------------------------------TREE
+    def _add(self, bucket: int, delta: int) -> None:
+        i = bucket + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, bucket: int) -> int:
+        """ Players in buckets up to and including bucket """
+        total, i = 0, bucket + 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _kth(self, k: int) -> int:
+        """ Bucket of the k-th best player, k from 1 """
+        position, step = 0, 1 << self._size.bit_length()
+        while step:
+            if position + step <= self._size and self._tree[position + step] < k:
+                position += step
+                k -= self._tree[position]
+            step >>= 1
+        return position
+
+    # --------------------------------------------------CHANGES
+    def _place(self, user_id: int, bucket: int | None) -> None:
+        old = self._bucket_of.pop(user_id, None)
+        if old != None:
+            self._add(old, -1)
+            players = self._players[old]
+            players.discard(user_id)
+            if not players:
+                del self._players[old]
+        if bucket != None:
+            self._bucket_of[user_id] = bucket
+            self._add(bucket, 1)
+            self._players.setdefault(bucket, set()).add(user_id)
+
+    def _row_bucket(self, row: dict | None) -> int | None:
+        if row == None or row.get('num_games', 0) < self.min_games or row.get('score_avg') == None:
+            return None
+        return self._bucket(row['score_avg'])
+
+    def update(self, user_id: int, row: dict | None) -> None:
+        """ Rank user_id by the num_games and score_avg of row, or unrank them if row is None """
+        bucket = self._row_bucket(row)
+        with self._guard:
+            self._place(user_id, bucket)
+            if self._changes != None:
+                self._changes[user_id] = row
+
+    def remove(self, user_id: int) -> None:
+        self.update(user_id, None)
+
+    def rebuild(self, user_data) -> int:
+        """ Reload every ranked player from user_data, returning how many there are """
+        with self._guard:
+            self._changes = {}
+        buckets = {}
+        try:
+            for user in user_data.find({"num_games": {"$gte": self.min_games}}, {"num_games": 1, "score_avg": 1}):
+                bucket = self._row_bucket(user)
+                if bucket != None:
+                    buckets[user['_id']] = bucket
+        except BaseException:
+            with self._guard:
+                self._changes = None
+            raise
+        with self._guard:
+            # Changes applied during the read are newer than what it returned
+            for user_id, row in self._changes.items():
+                bucket = self._row_bucket(row)
+                if bucket == None:
+                    buckets.pop(user_id, None)
+                else:
+                    buckets[user_id] = bucket
+            self._changes = None
+            counts = [0] * (self._size + 1)
+            for bucket in buckets.values():
+                counts[bucket + 1] += 1
+            # Linear-time Fenwick construction from the counts
+            for i in range(1, self._size + 1):
+                parent = i + (i & -i)
+                if parent <= self._size:
+                    counts[parent] += counts[i]
+            self._tree = counts
+            self._bucket_of = buckets
+            self._players = {}
+            for user_id, bucket in buckets.items():
+                self._players.setdefault(bucket, set()).add(user_id)
+            self.ready = True
+            return len(buckets)
+
+    # --------------------------------------------------QUERIES
+    def rank(self, user_id: int) -> tuple[int, int, float] | None:
+        """ (rank, ranked players, share of them with a worse average) of user_id, None if unranked """
+        with self._guard:
+            bucket = self._bucket_of.get(user_id)
+            if bucket == None:
+                return None
+            total = len(self._bucket_of)
+            better = self._prefix(bucket - 1) if bucket > 0 else 0
+            worse = total - self._prefix(bucket)
+            return (better + 1, total, worse / total)
+
+    def top(self, limit: int) -> list[int]:
+        """ User ids of the limit best players, best first, ties by user id """
+        result = []
+        with self._guard:
+            limit = min(limit, len(self._bucket_of))
+            while len(result) < limit:
+                bucket = self._kth(len(result) + 1)
+                result += sorted(self._players[bucket])[:limit - len(result)]
+        return result
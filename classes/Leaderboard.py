@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+from pymongo import UpdateMany
+
+LEADERBOARD_CACHE_TTL = config('LEADERBOARD_CACHE_TTL', default=60.0, cast=float)
+# Number of members shown on a leaderboard, 0 to show everyone
+LEADERBOARD_SIZE = config('LEADERBOARD_SIZE', default=0, cast=int)
+
+# Invalidations remembered to check renders against; a render older than all of them is not cached
+CHANGES_KEPT = 10000
+
+ROW_FIELDS = ["username", "num_games", "streak", "score_avg", "last_game"]
+
+
+def leaderboard_row(user_data: dict) -> dict:
+    """ Leaderboard fields of a user document """
+    return {key: user_data[key] for key in ROW_FIELDS}
+
+
+class Leaderboard:
+    """Class storing materialized per-chat leaderboards.
+
+    Each chat has one document holding the leaderboard fields of its members,
+    kept up to date whenever a member's stats change, so printing a leaderboard
+    is a single read by ``_id``. Rendered leaderboards are cached per process and
+    invalidated whenever one of the chat's members changes. A render is only
+    stored if neither the chat nor any of its members was invalidated since its
+    view was read, so a share landing in between is never hidden. Changes made by other processes are
+    not seen by this cache: they show once the render is LEADERBOARD_CACHE_TTL
+    seconds old or the edition moves on.
+
+    Attributes
+    ----------
+    _id: int
+        Telegram chat id
+    members: list[int]
+        User ids of the chat members
+    rows: dict[str, dict]
+        Leaderboard fields (see ROW_FIELDS) keyed by user id
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._guard = threading.Lock()
+        self._rendered = {}  # chat_id -> (latest_game, time.monotonic(), members, text)
+        self._chats_of = {}  # user_id -> chat ids whose rendered leaderboard shows the user
+        self._generation = 0  # bumped by every invalidation
+        # ("chat", chat_id) or ("user", user_id) -> generation it was last invalidated at, oldest first
+        self._changed = OrderedDict()
+        self._forgotten = 0  # latest generation dropped from _changed
+
+    def ensure_indexes(self) -> None:
+        """ Index members, which sync and remove filter on """
+        self.db.create_index("members")
+
+    # --------------------------------------------------CACHE
+    def invalidate(self, user_id: int, chat_id: int = None) -> None:
+        """ Drop rendered leaderboards showing user_id, along with chat_id's """
+        with self._guard:
+            chats = self._chats_of.pop(user_id, set())
+            if chat_id != None:
+                chats.add(chat_id)
+            # A user's change also reaches chats whose render is under way, so the user is marked too
+            self._changed_now([("user", user_id)] + [("chat", chat) for chat in chats])
+            for chat in chats:
+                self._rendered.pop(chat, None)
+
+    def _changed_now(self, keys: list[tuple[str, int]]) -> None:
+        self._generation += 1
+        for key in keys:
+            self._changed[key] = self._generation
+            self._changed.move_to_end(key)
+        while len(self._changed) > CHANGES_KEPT:
+            self._forgotten = self._changed.popitem(last=False)[1]
+
+    def generation(self) -> int:
+        """ Invalidation count, read before a view is and given to store along with its render """
+        with self._guard:
+            return self._generation
+
+    def cached(self, chat_id: int, latest_game: int, user_id: int) -> str | None:
+        """ Rendered leaderboard of chat_id, unless it is stale or user_id still has to join it """
+        with self._guard:
+            entry = self._rendered.get(chat_id)
+        if entry == None:
+            return None
+        rendered_for, rendered_at, members, text = entry
+        if (rendered_for != latest_game or user_id not in members
+                or time.monotonic() - rendered_at >= LEADERBOARD_CACHE_TTL):
+            return None
+        return text
+
+    def store(self, chat_id: int, latest_game: int, members: list[int], text: str, generation: int) -> None:
+        """ Cache the render of a view read at generation, unless the chat or one of its members was invalidated since """
+        with self._guard:
+            if generation < self._forgotten or self._changed.get(("chat", chat_id), 0) > generation:
+                return
+            if any(self._changed.get(("user", user_id), 0) > generation for user_id in members):
+                return
+            self._rendered[chat_id] = (latest_game, time.monotonic(), set(members), text)
+            for user_id in members:
+                self._chats_of.setdefault(user_id, set()).add(chat_id)
+
+    # --------------------------------------------------VIEW
+    def get(self, chat_id: int) -> dict | None:
+        return self.db.find_one({"_id": chat_id})
+
+    def build(self, chat_id: int, user_data: list[dict], persist: bool = True) -> dict:
+        """ Materialize chat_id's leaderboard from its members' user documents, only in memory unless persist """
+        view = {
+            "members": [user["_id"] for user in user_data],
+            "rows": {str(user["_id"]): leaderboard_row(user) for user in user_data},
+        }
+        if persist:
+            self.db.update_one({"_id": chat_id}, {"$set": view}, upsert=True)
+        return view
+
+    def sync(self, user_id: int, chat_id: int | None, row: dict, writes=None) -> None:
+        """ Write user_id's row into chat_id's leaderboard and every other leaderboard they belong to, or queue it on writes """
+        # Chats without a materialized leaderboard are skipped; they are built on first read
+        filter = {"$or": [{"_id": chat_id}, {"members": user_id}]} if chat_id != None else {"members": user_id}
+        update = {"$addToSet": {"members": user_id},
+                  "$set": {f"rows.{user_id}": row}}
+        if writes == None:
+            self.db.update_many(filter, update)
+        else:
+            writes.update_many(self.db, user_id, filter, update)
+        self.invalidate(user_id, chat_id)
+
+    def sync_rows(self, rows: dict[int, dict]) -> None:
+        """ Write the rows of many users, keyed by user id, into the leaderboards they belong to in one bulk write """
+        if not rows:
+            return
+        self.db.bulk_write([UpdateMany({"members": user_id}, {"$set": {f"rows.{user_id}": row}})
+                            for user_id, row in rows.items()], ordered=False)
+        for user_id in rows:
+            self.invalidate(user_id)
+
+    def remove(self, user_id: int) -> None:
+        self.db.update_many({"members": user_id},
+                            {"$pull": {"members": user_id},
+                             "$unset": {f"rows.{user_id}": ""}})
+        self.invalidate(user_id)
+
+    def drop(self, chat_id: int) -> None:
+        self.db.delete_one({"_id": chat_id})
+        with self._guard:
+            self._changed_now([("chat", chat_id)])
+            self._rendered.pop(chat_id, None)
+
+    def drop_all(self) -> None:
+        """ Drop every leaderboard, each is built again on its next read """
+        self.db.delete_many({})
+        with self._guard:
+            self._generation += 1
+            self._forgotten = self._generation
+            self._rendered.clear()
+            self._chats_of.clear()
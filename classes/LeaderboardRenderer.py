@@ -0,0 +1,213 @@
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict, deque
+from decouple import config
+from utils.percentiles import percentile
+
+# Pillow is optional, leaderboards are sent as text without it; it is only imported once images are on
+Image = ImageDraw = ImageFont = None
+
+LEADERBOARD_IMAGES = config('LEADERBOARD_IMAGES', default=False, cast=bool)
+LEADERBOARD_FONT = config('LEADERBOARD_FONT', default='DejaVuSans.ttf')
+LEADERBOARD_BOLD_FONT = config('LEADERBOARD_BOLD_FONT', default='DejaVuSans-Bold.ttf')
+IMAGE_CACHE_SIZE = config('IMAGE_CACHE_SIZE', default=1000, cast=int)
+# Telegram rejects photos whose width and height add up to more than 10000 pixels
+IMAGE_ROWS = config('IMAGE_ROWS', default=50, cast=int)
+
+WIDTH = 720
+PADDING = 24
+HEADER_HEIGHT = 52
+ROW_HEIGHT = 44
+BACKGROUND = (18, 18, 19)
+STRIPE = (30, 30, 32)
+HEADER = (58, 58, 60)
+TEXT = (255, 255, 255)
+MUTED = (129, 131, 132)
+GREEN = (106, 170, 100)
+YELLOW = (201, 180, 88)
+FLAME = (245, 124, 40)
+FLAME_CORE = (250, 204, 70)
+# Left edge of each column, and the average bar's extent
+RANK_X, NAME_X, GAMES_X, STREAK_X, AVG_X, BAR_X = 24, 72, 300, 400, 500, 580
+BAR_WIDTH = WIDTH - PADDING - BAR_X
+NAME_WIDTH = GAMES_X - NAME_X - 16
+
+
+def load_pillow() -> bool:
+    """ Import Pillow into this module, returning whether it is installed """
+    global Image, ImageDraw, ImageFont
+    if Image == None:
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+        except ImportError:
+            return False
+    return True
+
+
+def load_font(path: str, size: int):
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+class LeaderboardRenderer:
+    """
+    Class drawing chat leaderboards as PNG images, with the Telegram file_id of each image sent.
+
+    Fonts, the header and the streak flame are prepared once, and every image
+    is encoded into the same buffer, so a render only draws the rows. Images
+    are keyed by a hash of the leaderboard they show: once one has been
+    uploaded, sending the same leaderboard again, to any chat, reuses its
+    file_id instead of rendering and uploading it again.
+
+    Attributes
+    ----------
+    cache_size: int
+        Number of file ids kept, least recently used first out
+    max_rows: int
+        Players drawn at most, the best ones
+    """
+
+    def __init__(self, cache_size: int = IMAGE_CACHE_SIZE, max_rows: int = IMAGE_ROWS) -> None:
+        if not load_pillow():
+            raise ImportError("Leaderboard images need Pillow, install it with pip install Pillow")
+        self.cache_size = cache_size
+        self.max_rows = max_rows
+        self._file_ids = OrderedDict()  # content hash -> file_id
+        self._guard = threading.Lock()
+        # Fonts are not safe to share between threads, renders are rare enough to take turns
+        self._rendering = threading.Lock()
+        self._buffer = io.BytesIO()
+        self._font = load_font(LEADERBOARD_FONT, 20)
+        self._bold = load_font(LEADERBOARD_BOLD_FONT, 20)
+        self._header = self._draw_header()
+        self._flame = self._draw_flame(22)
+        self._renders = deque(maxlen=1000)  # seconds, most recent renders
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "renders": 0,
+            "uploads": 0,
+        }
+
+    @staticmethod
+    def available() -> bool:
+        return load_pillow()
+
+    # --------------------------------------------------TEMPLATES
+    def _draw_header(self):
+        header = Image.new("RGB", (WIDTH, HEADER_HEIGHT), HEADER)
+        draw = ImageDraw.Draw(header)
+        middle = HEADER_HEIGHT // 2
+        for x, label in ((RANK_X, "#"), (NAME_X, "Name"), (GAMES_X, "Games"),
+                         (STREAK_X, "Streak"), (AVG_X, "Avg."), (BAR_X, "")):
+            draw.text((x, middle), label, font=self._bold, fill=TEXT, anchor="lm")
+        return header
+
+    @staticmethod
+    def _draw_flame(size: int):
+        """ Streak flame, drawn four times larger and scaled down to smooth its edges """
+        scale = 4
+        flame = Image.new("RGBA", (size * scale, size * scale), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(flame)
+        s = size * scale
+        draw.polygon([(s * 0.5, 0), (s * 0.85, s * 0.45), (s * 0.9, s * 0.7), (s * 0.7, s * 0.95),
+                      (s * 0.3, s * 0.95), (s * 0.1, s * 0.7), (s * 0.2, s * 0.4), (s * 0.35, s * 0.55)], fill=FLAME)
+        draw.ellipse([s * 0.32, s * 0.5, s * 0.68, s * 0.95], fill=FLAME_CORE)
+        return flame.resize((size, size), Image.LANCZOS)
+
+    # --------------------------------------------------RENDERING
+    def _fit(self, name: str) -> str:
+        """ name, shortened with an ellipsis to fit the name column """
+        if self._font.getlength(name) <= NAME_WIDTH:
+            return name
+        while name and self._font.getlength(name + "…") > NAME_WIDTH:
+            name = name[:-1]
+        return name + "…"
+
+    def render(self, rows: list[dict]) -> bytes:
+        """ PNG of rows with username, num_games, streak and score_avg, in the order given """
+        rows = rows[:self.max_rows]
+        with self._rendering:
+            start = time.perf_counter()
+            image = Image.new("RGB", (WIDTH, HEADER_HEIGHT + ROW_HEIGHT * len(rows) + PADDING // 2), BACKGROUND)
+            image.paste(self._header, (0, 0))
+            draw = ImageDraw.Draw(image)
+            for i, row in enumerate(rows):
+                top = HEADER_HEIGHT + ROW_HEIGHT * i
+                middle = top + ROW_HEIGHT // 2
+                if i % 2:
+                    draw.rectangle([0, top, WIDTH, top + ROW_HEIGHT - 1], fill=STRIPE)
+                draw.text((RANK_X, middle), str(i + 1), font=self._bold, fill=GREEN if i == 0 else MUTED, anchor="lm")
+                draw.text((NAME_X, middle), self._fit(str(row['username']).strip()), font=self._font, fill=TEXT, anchor="lm")
+                draw.text((GAMES_X, middle), str(row['num_games']), font=self._font, fill=TEXT, anchor="lm")
+                streak = row['streak']
+                draw.text((STREAK_X, middle), str(streak), font=self._font, fill=TEXT, anchor="lm")
+                if streak > 1:
+                    offset = int(self._font.getlength(str(streak))) + 6
+                    image.paste(self._flame, (STREAK_X + offset, middle - self._flame.height // 2), self._flame)
+                draw.text((AVG_X, middle), "%.3f" % row['score_avg'], font=self._font, fill=TEXT, anchor="lm")
+                # Full for an average of 1, empty for 7
+                filled = round(BAR_WIDTH * min(max((7 - row['score_avg']) / 6, 0), 1))
+                draw.rounded_rectangle([BAR_X, middle - 7, BAR_X + BAR_WIDTH, middle + 7], radius=7, fill=HEADER)
+                if filled:
+                    draw.rounded_rectangle([BAR_X, middle - 7, BAR_X + filled, middle + 7], radius=7,
+                                           fill=GREEN if row['score_avg'] <= 4 else YELLOW)
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            # Fastest zlib level: the image is uploaded once, then sent again by file_id
+            image.save(self._buffer, format="PNG", compress_level=1)
+            png = self._buffer.getvalue()
+            seconds = time.perf_counter() - start
+        with self._guard:
+            self._counters["renders"] += 1
+            self._renders.append(seconds)
+        return png
+
+    # --------------------------------------------------FILE IDS
+    @staticmethod
+    def key(leaderboard: str) -> str:
+        """ Cache key of the leaderboard an image shows, given as its text rendering """
+        return hashlib.sha1(leaderboard.encode("utf-8")).hexdigest()
+
+    def file_id(self, key: str) -> str | None:
+        """ file_id of an image already uploaded for key """
+        with self._guard:
+            file_id = self._file_ids.get(key)
+            if file_id == None:
+                self._counters["misses"] += 1
+                return None
+            self._file_ids.move_to_end(key)
+            self._counters["hits"] += 1
+            return file_id
+
+    def remember(self, key: str, message) -> None:
+        """ Keep the file_id of the photo message sent for key """
+        if message == None or not getattr(message, "photo", None):
+            return
+        with self._guard:
+            if key not in self._file_ids:
+                self._counters["uploads"] += 1
+            # The largest size Telegram made of the photo
+            self._file_ids[key] = message.photo[-1].file_id
+            self._file_ids.move_to_end(key)
+            if len(self._file_ids) > self.cache_size:
+                self._file_ids.popitem(last=False)
+
+    def stats(self) -> dict:
+        """ Cache counters and render time percentiles in seconds """
+        with self._guard:
+            renders = sorted(self._renders)
+            counters = dict(self._counters)
+            cached = len(self._file_ids)
+
+        lookups = counters["hits"] + counters["misses"]
+        return counters | {
+            "cached": cached,
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+            "render_p50": percentile(renders, 0.5),
+            "render_p95": percentile(renders, 0.95),
+        }
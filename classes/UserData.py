@@ -0,0 +1,53 @@
+from utils.game_history import DIST_SIZE
+
+# Defaults for fields added after the first users were stored
+FIELD_DEFAULTS = {
+    "dist": lambda: [0] * DIST_SIZE,
+    "recent": list,
+}
+
+
+class UserData:
+    """Record of the user fields a caller fetched.
+
+    Only the fields in the projection are read from the database; reading a
+    field that was not fetched raises AttributeError instead of silently
+    returning a default.
+
+    Attributes
+    ----------
+    username: str
+        Telegram user first name
+    num_games: int
+        Total number of games played
+    streak: int
+        Current running Wordle streak
+    score_avg: float
+        Total average score
+    last_game: int
+        Last Wordle edition played
+    last_active_chat: int
+        Last active chat
+    toggle_retroactive: bool
+        State of user-allowed retroactive updates
+    dist: list[int]
+        Number of games by tries, index 7 being X
+    recent: list[float]
+        Tries of the last 30 games counted in the stats
+    """
+    __slots__ = ("username", "num_games", "streak", "score_avg", "last_game",
+                 "last_active_chat", "toggle_retroactive", "dist", "recent")
+
+    def __init__(self, user_data: dict, fields: tuple[str, ...]) -> None:
+        for field in fields:
+            value = user_data.get(field)
+            if value == None:
+                value = FIELD_DEFAULTS[field]() if field in FIELD_DEFAULTS else user_data[field]
+            setattr(self, field, value)
+
+    @staticmethod
+    def projection(fields: tuple[str, ...]) -> dict:
+        return {"_id": 0} | {field: 1 for field in fields}
+
+    def asdict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__ if hasattr(self, field)}
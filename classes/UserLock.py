@@ -0,0 +1,176 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from decouple import config
+
+# Longer than the timeout, so a waiter gives up before it could take over the lease of a live holder
+LOCK_LEASE = config('LOCK_LEASE_SECONDS', default=20.0, cast=float)
+LOCK_TIMEOUT = config('LOCK_TIMEOUT_SECONDS', default=15.0, cast=float)
+LOCK_DISTRIBUTED = config('LOCK_DISTRIBUTED', default=True, cast=bool)
+
+
+def lease_free(now: float) -> dict:
+    """ Filter matching documents whose lock is free or whose lease has run out """
+    # A legacy lock without lock_expires is given one by the first waiter, see UserLock._take_lease
+    return {"$or": [{"lock": {"$ne": True}},
+                    {"lock_expires": {"$lt": now}}]}
+
+
+class UserLock:
+    """Per-user lock manager serialising read-modify-write updates of user data.
+
+    Threads in the same process wait on a per-user ``threading.Lock`` instead of
+    polling the database. When ``distributed`` is set, the holder also takes a
+    lease on the user document (``lock``, ``lock_owner``, ``lock_expires``) so
+    that workers on other dynos are excluded too. Leases expire on their own, so
+    a crashed worker can never leave a user locked forever; a legacy ``lock``
+    without an expiry expires one lease after a waiter first finds it. The
+    lease must outlast the timeout, so a waiter gives up before it could take
+    over the lease of a holder that is still running.
+
+    Attributes
+    ----------
+    db: Collection
+        User data collection holding the lease fields
+    lease: float
+        Seconds before an unreleased lease expires
+    timeout: float
+        Maximum seconds to wait for a lock before raising ``UserLock.Timeout``
+    distributed: bool
+        Whether to take Mongo leases in addition to in-process locks
+    """
+
+    class Timeout(Exception):
+        """Raised when a user lock could not be acquired within the timeout"""
+        pass
+
+    def __init__(self, db, lease: float = LOCK_LEASE, timeout: float = LOCK_TIMEOUT,
+                 distributed: bool = LOCK_DISTRIBUTED) -> None:
+        if distributed and lease <= timeout:
+            raise ValueError(f"lock lease ({lease} s) must be longer than the lock timeout ({timeout} s)")
+        self.db = db
+        self.lease = lease
+        self.timeout = timeout
+        self.distributed = distributed
+        self._guard = threading.Lock()
+        self._locks = {}  # user_id -> [threading.Lock, number of users]
+        self._counters = {
+            "acquired": 0,
+            "contended": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    # --------------------------------------------------IN-PROCESS LOCKS
+    def _local_lock(self, user_id: int) -> threading.Lock:
+        with self._guard:
+            entry = self._locks.setdefault(user_id, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _drop_local_lock(self, user_id: int) -> None:
+        with self._guard:
+            entry = self._locks[user_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    # --------------------------------------------------MONGO LEASES
+    def _take_lease(self, user_id: int, token: str, deadline: float) -> bool:
+        """ Take the document lease, backing off between attempts. Returns False if the user does not exist """
+        delay = 0.01
+        checked = False
+        while True:
+            now = time.time()
+            res = self.db.find_one_and_update(
+                {"_id": user_id} | lease_free(now),
+                {"$set": {"lock": True,
+                          "lock_owner": token,
+                          "lock_expires": now + self.lease}},
+                projection={"_id": 1}
+            )
+            if res != None:
+                return True
+            # The user is looked up once, and again before giving up in case it was deleted meanwhile
+            if not checked or now >= deadline:
+                held = self.db.find_one({"_id": user_id}, {"lock": 1, "lock_expires": 1})
+                if held == None:
+                    return False
+                if held.get('lock') == True and 'lock_expires' not in held:
+                    # A legacy lock: its holder is long gone, but it waits a lease like any other
+                    self.db.update_one({"_id": user_id, "lock_expires": {"$exists": False}},
+                                       {"$set": {"lock_expires": now + self.lease}})
+                checked = True
+            if now >= deadline:
+                raise self.Timeout
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, 0.5)
+
+    def _release_lease(self, user_id: int, token: str) -> None:
+        self.db.update_one({"_id": user_id, "lock_owner": token},
+                           {"$set": {"lock": False},
+                            "$unset": {"lock_owner": "", "lock_expires": ""}})
+
+    # --------------------------------------------------METHODS
+    def _record_wait(self, waited: float, contended: bool) -> None:
+        with self._guard:
+            self._counters["acquired"] += 1
+            self._counters["contended"] += contended
+            self._counters["wait_seconds_total"] += waited
+            self._counters["wait_seconds_max"] = max(
+                self._counters["wait_seconds_max"], waited)
+
+    def _record_timeout(self) -> None:
+        with self._guard:
+            self._counters["timeouts"] += 1
+
+    @contextmanager
+    def hold(self, user_id: int):
+        """ Hold the lock for user_id for the duration of the with block """
+        start = time.monotonic()
+        deadline = time.time() + self.timeout
+        local_lock = self._local_lock(user_id)
+        try:
+            contended = not local_lock.acquire(blocking=False)
+            if contended and not local_lock.acquire(timeout=self.timeout):
+                self._record_timeout()
+                raise self.Timeout
+            try:
+                token = None
+                if self.distributed:
+                    token = uuid.uuid4().hex
+                    try:
+                        if not self._take_lease(user_id, token, deadline):
+                            # No document to lease yet, so the in-process lock is all we hold
+                            token = None
+                    except self.Timeout:
+                        self._record_timeout()
+                        raise
+                self._record_wait(time.monotonic() - start, contended)
+                try:
+                    yield
+                finally:
+                    if token != None:
+                        self._release_lease(user_id, token)
+            finally:
+                local_lock.release()
+        finally:
+            self._drop_local_lock(user_id)
+
+    def is_locked(self, user_id: int, user_data: dict) -> bool:
+        """ Whether user_id is held in this process or by a live lease on user_data """
+        with self._guard:
+            entry = self._locks.get(user_id)
+            if entry != None and entry[0].locked():
+                return True
+        expires = user_data.get('lock_expires')
+        # A legacy lock without an expiry holds until a waiter gives it one
+        return bool(user_data.get('lock')) and (expires == None or expires >= time.time())
+
+    def stats(self) -> dict:
+        """ Snapshot of wait-time and contention counters """
+        with self._guard:
+            return dict(self._counters, held=sum(
+                1 for lock, _ in self._locks.values() if lock.locked()))
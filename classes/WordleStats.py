@@ -1,16 +1,103 @@
-from typing import Any
-from utils.messages import user_stats
-from collections import namedtuple
-from tabulate import tabulate
-import pandas as pd
+from typing import Any, Iterable, Iterator
+from utils.messages import user_stats, user_distribution, leaderboard_text, rank_rows, global_rank_text, unranked_text
+from utils.game_history import encode_game, rebuild_stats, distribution_stats, DIST_SIZE, RECENT_GAMES
+from classes.UserLock import UserLock
+from classes.Leaderboard import Leaderboard, ROW_FIELDS, LEADERBOARD_SIZE, leaderboard_row
+from classes.UserData import UserData
+from classes.ChatMembers import ChatMembers
+from classes.GlobalRank import GlobalRank, GLOBAL_TOP_SIZE
+from classes.WriteBehind import WriteBehind
+from utils.user_transfer import ImportReport, ImportedStats, batched, TRANSFER_BATCH
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 
 
 def streak_check(chat_latest_game: int) -> dict:
     return {"last_game": {"$lte": chat_latest_game - 2}}
 
 
-def member_of_chat(chat_id: int) -> dict:
-    return {"$addToSet": {"member_of_chats": chat_id}}
+def current_streak(streak: int, last_game: int, chat_latest_game: int) -> int:
+    """ Streak as of chat_latest_game, expired once a game was missed whether or not it was written back """
+    return 0 if last_game <= chat_latest_game - 2 else streak
+
+
+# Only needed by expire_streaks
+SWEEP_INDEX = [("last_game", ASCENDING)]
+# Chat queries used before membership moved to ChatMembers
+LEGACY_INDEX = "member_of_chats_1_last_game_1"
+
+# Fields ingest_score reads back, and write-behind keeps in memory
+INGEST_FIELDS = ROW_FIELDS + ["last_active_chat", "toggle_retroactive"]
+# Fields each caller of get_user_data reads, history is never needed
+UPDATE_FIELDS = ("last_game", "last_active_chat", "toggle_retroactive")
+STATS_FIELDS = ("username", "num_games", "streak", "score_avg", "last_game", "dist", "recent")
+
+
+def row_projection() -> dict:
+    return {"_id": 0} | {key: 1 for key in ROW_FIELDS}
+
+
+def adjust_update(games: int, average: float) -> list[dict]:
+    """ Aggregation pipeline adding games played elsewhere to the stats, as /adjust does """
+    num_games = {"$ifNull": ["$num_games", 0]}
+    # Both fields read the document as it was before the stage, whatever their order
+    return [{"$set": {
+        "score_avg": {"$divide": [{"$add": [{"$multiply": [{"$ifNull": ["$score_avg", 0]}, num_games]}, average * games]},
+                                  {"$add": [num_games, games]}]},
+        "num_games": {"$add": [num_games, games]},
+    }}]
+
+
+def import_update(row: ImportedStats) -> dict:
+    """ Update setting the stats of an import row, with the defaults of a new user for the fields it leaves out """
+    stats = {"num_games": row.games, "score_avg": row.average}
+    for key, value in (("username", row.username), ("streak", row.streak), ("last_game", row.last_game)):
+        if value != None:
+            stats[key] = value
+    defaults = {"username": str(row.user_id), "streak": 0, "last_game": 0, "last_active_chat": None,
+                "toggle_retroactive": False, "warning": True, "lock": False}
+    return {"$set": stats, "$setOnInsert": {key: value for key, value in defaults.items() if key not in stats}}
+
+
+def score_update(chat_id: int, edition: int, tries: float, username: str, grid: int = 0) -> list[dict]:
+    """ Aggregation pipeline applying a Wordle score with the same rules as update_stats """
+    num_games = {"$ifNull": ["$num_games", 0]}
+    last_game = {"$ifNull": ["$last_game", -1]}
+    return [
+        {"$set": {
+            # _skip: same edition, _blocked: older edition with retroactive updates off
+            "_skip": {"$or": [{"$eq": [edition, "$last_game"]},
+                              {"$and": [{"$lt": [edition, "$last_game"]},
+                                        {"$ne": ["$toggle_retroactive", True]}]}]},
+            "_blocked": {"$and": [{"$lt": [edition, "$last_game"]},
+                                  {"$ne": ["$toggle_retroactive", True]}]},
+        }},
+        # Every expression of a $set stage reads the stage's input document, as the SQLite engine does too,
+        # so field order does not matter and _skip and _blocked need the stage before
+        {"$set": {
+            "username": {"$ifNull": ["$username", {"$literal": username}]},
+            "score_avg": {"$cond": ["$_skip", "$score_avg",
+                                    {"$divide": [{"$add": [{"$multiply": [{"$ifNull": ["$score_avg", 0]}, num_games]}, tries]},
+                                                 {"$add": [num_games, 1]}]}]},
+            "num_games": {"$cond": ["$_skip", "$num_games", {"$add": [num_games, 1]}]},
+            "streak": {"$cond": [{"$eq": [edition, {"$add": ["$last_game", 1]}]}, {"$add": ["$streak", 1]},
+                                 {"$cond": [{"$gt": [edition, last_game]}, 1, "$streak"]}]},
+            "last_active_chat": {"$cond": ["$_blocked", "$last_active_chat", chat_id]},
+            "history": {"$cond": ["$_skip", "$history",
+                                  {"$concat": [{"$ifNull": ["$history", ""]}, encode_game(edition, tries)]}]},
+            "dist": {"$cond": ["$_skip", "$dist",
+                               {"$map": {"input": list(range(DIST_SIZE)), "as": "tries",
+                                         "in": {"$add": [{"$arrayElemAt": [{"$ifNull": ["$dist", [0] * DIST_SIZE]}, "$$tries"]},
+                                                         {"$cond": [{"$eq": ["$$tries", int(tries)]}, 1, 0]}]}}}]},
+            "recent": {"$cond": ["$_skip", "$recent",
+                                 {"$slice": [{"$concatArrays": [{"$ifNull": ["$recent", []]}, [tries]]}, -RECENT_GAMES]}]},
+            "last_grid": {"$cond": [{"$gt": [edition, last_game]}, grid, "$last_grid"]},
+            "last_game": {"$max": ["$last_game", edition]},
+            "toggle_retroactive": {"$ifNull": ["$toggle_retroactive", False]},
+            "warning": {"$ifNull": ["$warning", True]},
+            "lock": {"$ifNull": ["$lock", False]},
+        }},
+        {"$project": {"_skip": 0, "_blocked": 0}},
+    ]
 
 
 class WordleStats:
@@ -30,27 +117,75 @@ class WordleStats:
         Last Wordle edition played
     last_active_chat: int
         Last active chat
-    members_of_chat: list[int]
-        List of chats that user is apart of
     toggle_retroactive: bool
         State of user-allowed retroactive updates
     toggle_warnings: bool
         State of warning notifications for attempted retroactive updates
+    history: str
+        Packed (edition, tries) of every game counted in the stats, see utils/game_history.py
+    dist: list[int]
+        Number of games by tries, index 7 being X
+    recent: list[float]
+        Tries of the last 30 games counted in the stats
+    last_grid: int
+        Packed emoji grid of the last game, see utils/message_handler.py
+    lock: bool
+        Whether a worker holds the lease on this user's data
+    lock_owner: str
+        Token of the worker holding the lease
+    lock_expires: float
+        Unix time after which the lease is considered abandoned
     """
 
-    def __init__(self, db):
+    def __init__(self, db, boards: Leaderboard, members: ChatMembers, writes: WriteBehind = None,
+                 ranks: GlobalRank = None):
         self.db = db
+        self.boards = boards
+        # Chats each user belongs to, kept out of the user document
+        self.members = members
+        # Global ranks by score average, kept up to date by sync if set
+        self.ranks = ranks
+        self.locks = UserLock(db)
+        # Score writes are queued here instead of being applied by ingest_score, if set
+        self.writes = writes
+
+    def settle(self, user_id: int = None) -> None:
+        """ Apply queued writes before user data is read or written another way, which outdates user_id's record (every record if None) """
+        if self.writes != None:
+            self.writes.flush()
+            self.writes.forget(user_id)
+
+    def sync(self, user_id: int, chat_id: int | None, row: dict, writes: WriteBehind = None) -> None:
+        """ Propagate user_id's leaderboard row to their leaderboards and global rank """
+        self.boards.sync(user_id, chat_id, row, writes)
+        if self.ranks != None:
+            self.ranks.update(user_id, row)
+
+    def ensure_indexes(self, streak_sweep: bool = False) -> None:
+        """ Create the indexes chat queries rely on, a no-op for those that already exist """
+        if streak_sweep:
+            self.db.create_index(SWEEP_INDEX)
+        self.boards.ensure_indexes()
+        self.members.ensure_indexes()
+
+    def migrate_members(self) -> int:
+        """ Move member_of_chats arrays left on user documents into ChatMembers, then drop the index on them """
+        moved = self.members.migrate(self.db)
+        if moved:
+            # Leaderboards built before then may miss members whose pairs were not moved yet
+            self.boards.drop_all()
+        if LEGACY_INDEX in self.db.index_information():
+            self.db.drop_index(LEGACY_INDEX)
+        return moved
 
     def check_lock(self, user_id: int) -> bool:
-        user_data = self.db.find_one({"_id": user_id})
+        self.settle(user_id)
+        user_data = self.db.find_one({"_id": user_id},
+                                     {"lock": 1, "lock_expires": 1})
         if user_data == None:
             raise self.UserNotFound
         else:
-            return user_data['lock']
-        
-
-    UserData = namedtuple(
-        'UserData', ['username', 'num_games', 'streak', 'score_avg', 'last_game', 'last_active_chat', 'toggle_retroactive'])
+            return self.locks.is_locked(user_id, user_data)
 
     class InvalidAvg(Exception):
         """Raised when the score avg inputted is higher than 7.0"""
@@ -60,6 +195,14 @@ class WordleStats:
         """Raised when the user is not found in user base"""
         pass
 
+    class HistoryIncomplete(Exception):
+        """Raised when the user has more games than their history records, so their stats cannot be rebuilt from it"""
+        pass
+
+    class RanksNotReady(Exception):
+        """Raised when global ranks are disabled or still being loaded"""
+        pass
+
     class RetroactiveOff(Exception):
         """
         Raised when the user tries to update the database with an old Wordle result
@@ -69,36 +212,23 @@ class WordleStats:
     # --------------------------------------------------USER METHODS
     def toggle(self, user_id: int, retroactive: bool = True) -> bool:
         setting = 'toggle_retroactive' if retroactive else 'warning'
+        self.settle(user_id)
         old_state = self.db.find_one({"_id": user_id})[setting]
         new_state = not old_state
         self.db.update_one({"_id": user_id},
                            {"$set": {setting: new_state}})
         return new_state
 
-    def get_user_data(self, user_id: int, write: bool) -> UserData:
-        # Used in update_stats and manual_update
-        if write:
-            user_data = self.db.find_one_and_update(
-                {"_id": user_id},
-                {"$set": {"lock": True}},
-                projection={"_id": 0}
-            )
-        else:
-            user_data = self.db.find_one({"_id": user_id}, {"_id": 0})
+    def get_user_data(self, user_id: int, fields: tuple[str, ...] = UserData.__slots__) -> UserData:
+        """ Fetch only the given fields of the user """
+        # Callers updating the data must hold self.locks for user_id
+        user_data = self.db.find_one({"_id": user_id}, UserData.projection(fields))
         if user_data == None:
             raise self.UserNotFound
         else:
-            return self.UserData(
-                user_data['username'],
-                user_data['num_games'],
-                user_data['streak'],
-                user_data['score_avg'],
-                user_data['last_game'],
-                user_data['last_active_chat'],
-                user_data['toggle_retroactive']
-            )
-
-    def insert_user_data(self, user_id: int, username: str, edition: int, tries: float, chat_id: int) -> None:
+            return UserData(user_data, fields)
+
+    def insert_user_data(self, user_id: int, username: str, edition: int, tries: float, chat_id: int, grid: int = 0) -> None:
         user_data = {
             "_id": user_id,
             "username": username,
@@ -107,14 +237,19 @@ class WordleStats:
             "score_avg": tries,
             "last_game": edition,
             "last_active_chat": chat_id,
-            "member_of_chats": [chat_id],
             "toggle_retroactive": False,
             "warning": True,
-            "lock": False
+            "lock": False,
+            "history": encode_game(edition, tries),
+            "dist": [int(i == int(tries)) for i in range(DIST_SIZE)],
+            "recent": [tries],
+            "last_grid": grid
         }
         self.db.insert_one(user_data)
+        self.members.add(user_id, chat_id)
+        self.sync(user_id, chat_id, leaderboard_row(user_data))
 
-    def update_stats(self, user_id: int, chat_id: int, edition: int, tries: int, username: str) -> tuple[bool, bool]:
+    def update_stats(self, user_id: int, chat_id: int, edition: int, tries: int, username: str, grid: int = 0) -> tuple[bool, bool]:
         """ 
         Update or insert user stats based on Wordle score
 
@@ -123,6 +258,7 @@ class WordleStats:
             chat_id (int): Telegram chat id
             edition (int): Wordle edition
             tries (int): Wordle tries
+            grid (int): Packed emoji grid
 
         Returns:
             tuple containing
@@ -130,61 +266,129 @@ class WordleStats:
             - update (bool): Whether update has persisted
             - update_msg (bool): Whether to send message (message content dependent on update)
         """
-        try:
-            while (self.check_lock(user_id)):
-                pass
-            _, num_games, _, score_avg, last_game, last_active_chat, retroactive_updates = self.get_user_data(
-                user_id, write=True)
-
-            last_game_update = {"last_game": edition}
-            streak_inc = {"streak": 1}
-            streak_reset = {"streak": 1}
-            if edition == last_game:
-                self.db.update_one({"_id": user_id,
-                                    "last_active_chat": {"$ne": chat_id}},
-                                   {"$set": {"last_active_chat": chat_id}} | member_of_chat(chat_id))
-                return (False, last_active_chat == chat_id)
-            elif edition > last_game:
-                if edition == last_game + 1:
-                    # consecutive day
-                    streak_reset = {}
-                else:
-                    # missed a day
-                    streak_inc = {}
-            else:
-                streak_inc, streak_reset, last_game_update = {}, {}, {}
-                if not retroactive_updates:
+        self.settle(user_id)
+        with self.locks.hold(user_id):
+            try:
+                user_data = self.get_user_data(user_id, UPDATE_FIELDS)
+                last_game, last_active_chat = user_data.last_game, user_data.last_active_chat
+
+                if edition == last_game:
+                    res = self.db.find_one_and_update({"_id": user_id,
+                                                       "last_active_chat": {"$ne": chat_id}},
+                                                      {"$set": {"last_active_chat": chat_id}},
+                                                      projection=row_projection())
+                    if res != None:
+                        self.members.add(user_id, chat_id)
+                        self.sync(user_id, chat_id, res)
+                    return (False, last_active_chat == chat_id)
+                elif edition < last_game and not user_data.toggle_retroactive:
                     raise self.RetroactiveOff
 
-            new_avg = (score_avg * num_games +
-                       tries)/(num_games + 1)
-            # print(new_avg)
-            # print(streak_inc)
-            # print(streak_reset)
-            update = {
-                "$inc": {"num_games": 1} | streak_inc,
-                "$set": {"score_avg": new_avg,
-                         "last_active_chat": chat_id} | streak_reset | last_game_update
-            } | member_of_chat(chat_id)
-            self.db.update_one({"_id": user_id}, update)
-            return (True, False)
-        except self.UserNotFound:
-            self.insert_user_data(
-                user_id=user_id,
-                username=username,
-                edition=edition,
-                tries=tries,
-                chat_id=chat_id
-            )
-            return (True, True)
-        finally:
-            self.db.update_one({"_id": user_id},
-                               {"$set": {"lock": False}})
+                # Streak, average and per-game fields are applied by the same pipeline as ingest_score
+                res = self.db.find_one_and_update({"_id": user_id},
+                                                  score_update(chat_id, edition, tries, username, grid),
+                                                  projection=row_projection(),
+                                                  return_document=ReturnDocument.AFTER)
+                self.members.add(user_id, chat_id)
+                self.sync(user_id, chat_id, res)
+                return (True, False)
+            except self.UserNotFound:
+                self.insert_user_data(
+                    user_id=user_id,
+                    username=username,
+                    edition=edition,
+                    tries=tries,
+                    chat_id=chat_id,
+                    grid=grid
+                )
+                return (True, True)
+
+    def ingest_score(self, user_id: int, chat_id: int, edition: int, tries: float, username: str, grid: int = 0) -> tuple[bool, bool]:
+        """
+        Update or insert user stats based on Wordle score in a single round trip
+
+        Applies the same rules as update_stats with one pipeline update, so no lock is needed.
+
+        Returns:
+            tuple containing
+
+            - update (bool): Whether update has persisted
+            - update_msg (bool): Whether to send message (message content dependent on update)
+        """
+        if self.writes != None:
+            return self._ingest_behind(user_id, chat_id, edition, tries, username, grid)
+        user_data = self.db.find_one_and_update(
+            {"_id": user_id},
+            score_update(chat_id, edition, tries, username, grid),
+            projection={"_id": 0} | {key: 1 for key in INGEST_FIELDS},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        update, update_msg, row = self.score_result(user_data, chat_id, edition, tries, username)
+        self.members.add(user_id, chat_id)
+        if row != None:
+            self.sync(user_id, chat_id, row)
+        return (update, update_msg)
+
+    def _ingest_behind(self, user_id: int, chat_id: int, edition: int, tries: float, username: str, grid: int = 0) -> tuple[bool, bool]:
+        """ ingest_score answered from the user's record in memory, its writes queued on self.writes """
+        user_data = self.writes.record(user_id)
+        if user_data == None:
+            if self.writes.waiting(user_id):
+                # The record was evicted, the database is only up to date once the user's writes are applied
+                self.writes.flush()
+            user_data = self.db.find_one({"_id": user_id}, {"_id": 0} | {key: 1 for key in INGEST_FIELDS})
+        update, update_msg, row = self.score_result(user_data, chat_id, edition, tries, username)
+
+        # The pipeline is applied as is, so the database follows the same rules whatever the record says
+        self.writes.update_one(self.db, user_id, {"_id": user_id},
+                               score_update(chat_id, edition, tries, username, grid), upsert=True)
+        self.members.add(user_id, chat_id, self.writes)
+        if row != None:
+            self.sync(user_id, chat_id, row, self.writes)
+        self.writes.remember(user_id, (row or leaderboard_row(user_data)) | {
+            "last_active_chat": chat_id,
+            "toggle_retroactive": user_data != None and user_data['toggle_retroactive'],
+        })
+        return (update, update_msg)
+
+    def score_result(self, user_data: dict | None, chat_id: int, edition: int, tries: float, username: str) -> tuple[bool, bool, dict | None]:
+        """
+        Outcome of score_update given the user's INGEST_FIELDS before it
+
+        Returns:
+            tuple containing
+
+            - update (bool): Whether update has persisted
+            - update_msg (bool): Whether to send message (message content dependent on update)
+            - row (dict | None): Leaderboard row to sync, None if the leaderboards are unchanged
+        """
+        if user_data == None:
+            return (True, True, {"username": username,
+                                 "num_games": 1,
+                                 "streak": 1,
+                                 "score_avg": tries,
+                                 "last_game": edition})
+
+        # Mirror the pipeline to get the leaderboard row without reading the document back
+        row = leaderboard_row(user_data)
+        last_game, num_games = row['last_game'], row['num_games']
+        if edition == last_game:
+            # Possibly a new chat for this user
+            new_chat = user_data['last_active_chat'] != chat_id
+            return (False, not new_chat, row if new_chat else None)
+        elif edition > last_game:
+            row['streak'] = row['streak'] + 1 if edition == last_game + 1 else 1
+            row['last_game'] = edition
+        elif not user_data['toggle_retroactive']:
+            raise self.RetroactiveOff
+        row['score_avg'] = (row['score_avg'] * num_games + tries)/(num_games + 1)
+        row['num_games'] = num_games + 1
+        return (True, False, row)
 
     def manual_update(self, user_id: int, chat_id: int, cmd: str, input: Any, input_avg: Any = 0) -> None | tuple[int, float]:
-        while (self.check_lock(user_id)):
-            pass
-        try:
+        self.settle(user_id)
+        with self.locks.hold(user_id):
             attr_dict = {
                 'name': (str, "username"),
                 'games': (int, "num_games"),
@@ -196,97 +400,192 @@ class WordleStats:
                 if cmd == 'average' and float(input) > 7.0:
                     raise self.InvalidAvg
                 change_type, key = attr_dict[cmd]
-                res = self.db.update_one(
-                    {"_id": user_id}, {"$set": {key: change_type(input)}} | member_of_chat(chat_id))
+                res = self.db.find_one_and_update(
+                    {"_id": user_id}, {"$set": {key: change_type(input)}},
+                    projection=row_projection(),
+                    return_document=ReturnDocument.AFTER)
             else:
-                user_data = self.get_user_data(user_id, write=True)
-                score_avg = user_data.score_avg
-                num_games = user_data.num_games
                 old_games = int(input)
                 old_avg = float(input_avg)
                 if old_avg > 7.0:
                     raise self.InvalidAvg
-
-                new_games = num_games + old_games
-                new_avg = ((old_avg * old_games) +
-                           (score_avg * num_games)) / new_games
-                res = self.db.update_one(
-                    {"_id": user_id},
-                    {"$set": {"score_avg": float(new_avg),
-                              "num_games": int(new_games)}} 
-                    | member_of_chat(chat_id)
+                # A single atomic update, adding to the stats whatever other writes they get meanwhile
+                res = self.db.find_one_and_update(
+                    {"_id": user_id}, adjust_update(old_games, old_avg),
+                    projection=row_projection(),
+                    return_document=ReturnDocument.AFTER
                 )
-                return (new_games, new_avg)
+                if res == None:
+                    raise self.UserNotFound
+                self.members.add(user_id, chat_id)
+                self.sync(user_id, chat_id, res)
+                return (res["num_games"], res["score_avg"])
 
-            if res.matched_count == 0:
+            if res == None:
                 raise self.UserNotFound
-        finally:
-            self.db.update_one({"_id": user_id},
-                               {"$set": {"lock": False}})
+            self.members.add(user_id, chat_id)
+            self.sync(user_id, chat_id, res)
 
     def print_stats(self, user_id: int, chat_id: int, chat_latest_game: int) -> str:
-        while (self.check_lock(user_id)):
-            pass
-        self.insert_chat_member(user_id, chat_id)
-        self.db.update_one({"_id": user_id} | streak_check(chat_latest_game),
-                           {"$set": {"streak": 0}})
-        user_data = self.get_user_data(user_id, write=False)
-
-        if user_data.streak > 1:
+        self.settle(user_id)
+        # A plain read unless the user has to join the chat, streaks are expired below without writing
+        user_data = self.get_user_data(user_id, STATS_FIELDS)
+        if self.members.add(user_id, chat_id):
+            with self.locks.hold(user_id):
+                user_data = self.get_user_data(user_id, STATS_FIELDS)
+                self.sync(user_id, chat_id, leaderboard_row(user_data.asdict()))
+
+        streak = current_streak(user_data.streak, user_data.last_game, chat_latest_game)
+        if streak > 1:
             streak_status = " 🔥"
         else:
             streak_status = ""
-        streak = str(user_data.streak) + streak_status
+        streak = str(streak) + streak_status
         stats_msg = (
             f"Stats for *{user_data.username}*:\n\n"
             + user_stats(user_data.username, user_data.num_games,
                          streak, user_data.score_avg)
         )
+        # Users from before the distribution was kept have none until their next game
+        if sum(user_data.dist) > 0:
+            stats_msg += "\n\n" + user_distribution(user_data.dist, **distribution_stats(user_data.dist, user_data.recent),
+                                                     num_games=user_data.num_games)
         return stats_msg
 
+    def rebuild(self, user_id: int) -> dict:
+        """ Recompute stats from the user's game history, discarding manual changes to games, streak and average """
+        self.settle(user_id)
+        with self.locks.hold(user_id):
+            user_data = self.db.find_one({"_id": user_id}, {"history": 1, "num_games": 1})
+            if user_data == None or not user_data.get('history'):
+                raise self.UserNotFound
+            stats = rebuild_stats(user_data['history'])
+            # Games counted before history was kept, or added by /adjust or an import, would be lost
+            if user_data['num_games'] > stats['num_games']:
+                raise self.HistoryIncomplete
+            res = self.db.find_one_and_update({"_id": user_id}, {"$set": stats},
+                                              projection=row_projection(),
+                                              return_document=ReturnDocument.AFTER)
+            self.sync(user_id, None, res)
+            return stats
+
+    def bulk_import(self, rows: Iterable[ImportedStats], report: ImportReport, batch_size: int = TRANSFER_BATCH) -> None:
+        """ Set the stats of many users to the values given, creating those not stored yet, one unordered bulk write per batch """
+        # Each row is one atomic update setting absolute values, so neither locks nor order are needed, and importing twice is a no-op
+        self.settle()
+        report.applied = True
+        for batch in batched(rows, batch_size):
+            res = self.db.bulk_write([UpdateOne({"_id": row.user_id}, import_update(row), upsert=True)
+                                      for row in batch], ordered=False)
+            report.matched += res.matched_count
+            report.modified += res.modified_count
+            report.created += res.upserted_count
+            user_ids = list({row.user_id for row in batch})
+            rows = self.db.find({"_id": {"$in": user_ids}}, {key: 1 for key in ROW_FIELDS})
+            rows = {row.pop("_id"): row for row in rows}
+            self.boards.sync_rows(rows)
+            if self.ranks != None:
+                for user_id, row in rows.items():
+                    self.ranks.update(user_id, row)
+
+    def export_users(self, chat_latest_game: int) -> Iterator[dict]:
+        """ Stream every user's stats in natural order, unsorted so that no backend has to hold them all """
+        self.settle()
+        users = self.db.find({}, {"username": 1, "num_games": 1, "score_avg": 1,
+                                  "streak": 1, "last_game": 1})
+        # Streaks as /stats shows them, whether or not the expired ones were written back
+        return (user | {"streak": current_streak(user['streak'], user['last_game'], chat_latest_game)}
+                for user in users)
+
     def clear(self, user_id: int) -> None:
+        self.settle(user_id)
         res = self.db.delete_one({"_id": user_id})
         if res.deleted_count == 0:
             raise self.UserNotFound
+        self.members.remove([user_id])
+        self.boards.remove(user_id)
+        if self.ranks != None:
+            self.ranks.remove(user_id)
+
+    def expire_streaks(self, chat_latest_game: int) -> int:
+        """ Write back the streaks that expired before chat_latest_game, returning how many """
+        self.settle()
+        res = self.db.update_many(streak_check(chat_latest_game) | {"streak": {"$gt": 0}},
+                                  {"$set": {"streak": 0}})
+        return res.modified_count
 
     # --------------------------------------------------CHAT METHODS
     def get_chat_data(self, chat_id: int) -> list[dict]:
-        res = list(self.db.find({"member_of_chats": chat_id},
-                                {"_id": 0,
-                                 "username": 1,
-                                 "num_games": 1,
-                                 "streak": 1,
-                                 "score_avg": 1}))
-        if res == []:
-            raise self.UserNotFound
-        else:
-            return res
-
-    def insert_chat_member(self, user_id: int, chat_id: int) -> None:
-        self.db.update_one({"_id": user_id}, member_of_chat(chat_id))
+        """ Leaderboard fields of the chat's members, fetched by _id once their ids are known """
+        user_ids = self.members.members(chat_id)
+        if not user_ids:
+            return []
+        return list(self.db.find({"_id": {"$in": user_ids}},
+                                 {key: 1 for key in ROW_FIELDS}))
 
     def print_leaderboard(self, user_id: int, chat_id: int, chat_latest_game: int) -> str:
-        def check_chat_lock(chat_id: int) -> bool:
-            cursor = self.db.find({"member_of_chats": chat_id})
-            res = False
-            for elem in cursor:
-                res = res or elem['lock']
-            return res
-                
-        while (check_chat_lock(chat_id)):
-            pass
-        
-        self.insert_chat_member(user_id, chat_id)
-        self.db.update_many({"member_of_chats": chat_id} | streak_check(chat_latest_game),
-                            {"$set": {"streak": 0}})
-        chat_data = self.get_chat_data(chat_id)
-
-        leaderboard_df = pd.DataFrame.from_records(chat_data)
-        leaderboard_df.columns = ['Name', 'Gms', '🔥', 'Avg.']
-        leaderboard_df['Avg.'] = leaderboard_df['Avg.'].apply(
-            lambda x: f"{x:.3f}".replace(".", "\."))
-
-        leaderboard_df = leaderboard_df.sort_values(
-            by=['Avg.']).reset_index(drop=True)
-        leaderboard_df.index += 1
-        return f"`{tabulate(leaderboard_df, headers='keys')}`"
+        leaderboard = self.boards.cached(chat_id, chat_latest_game, user_id)
+        if leaderboard != None:
+            return leaderboard
+
+        generation = self.boards.generation()
+        view = self._chat_view(user_id, chat_id)
+        leaderboard = leaderboard_text(self._chat_rows(view['rows'].values(), chat_latest_game), LEADERBOARD_SIZE)
+        self.boards.store(chat_id, chat_latest_game, view['members'], leaderboard, generation)
+        return leaderboard
+
+    def leaderboard_rows(self, user_id: int, chat_id: int, chat_latest_game: int, limit: int = 0) -> list[dict]:
+        """ Rows of the chat's leaderboard as print_leaderboard shows them, best first, at most limit if given """
+        view = self._chat_view(user_id, chat_id)
+        limit = min(LEADERBOARD_SIZE or limit, limit or LEADERBOARD_SIZE)
+        return rank_rows(self._chat_rows(view['rows'].values(), chat_latest_game), limit)
+
+    def _chat_view(self, user_id: int, chat_id: int) -> dict:
+        """ Materialized leaderboard of the chat, which user_id joins if they have played """
+        self.settle(user_id)
+        view = self.boards.get(chat_id)
+        if view == None:
+            # Kept out of the database while members are migrated, as the chat's members may still be incomplete;
+            # checked before they are read, so a view read mid-migration is never stored
+            persist = self.members.migrated
+            view = self.boards.build(chat_id, self.get_chat_data(chat_id), persist)
+        if user_id not in view['members']:
+            user_data = self.db.find_one({"_id": user_id}, row_projection())
+            if user_data != None and self.members.add(user_id, chat_id):
+                self.sync(user_id, chat_id, user_data)
+                view['members'].append(user_id)
+                view['rows'][str(user_id)] = user_data
+        if view['rows'] == {}:
+            raise self.UserNotFound
+        return view
+
+    def _chat_rows(self, rows: Iterable[dict], chat_latest_game: int) -> list[dict]:
+        # Streaks of members who missed the latest games have expired, whether or not it has been written back
+        return [{"username": row['username'],
+                 "num_games": row['num_games'],
+                 "streak": current_streak(row['streak'], row['last_game'], chat_latest_game),
+                 "score_avg": row['score_avg']} for row in rows]
+
+    # --------------------------------------------------GLOBAL METHODS
+    def print_global_rank(self, user_id: int) -> str:
+        if self.ranks == None or not self.ranks.ready:
+            raise self.RanksNotReady
+        rank = self.ranks.rank(user_id)
+        if rank != None:
+            return global_rank_text(*rank, self.ranks.min_games)
+        user_data = self.db.find_one({"_id": user_id}, {"num_games": 1})
+        if user_data == None:
+            raise self.UserNotFound
+        return unranked_text(user_data['num_games'], self.ranks.min_games)
+
+    def print_global_top(self, chat_latest_game: int, limit: int = GLOBAL_TOP_SIZE) -> str:
+        """ Leaderboard of the limit best players across every chat """
+        if self.ranks == None or not self.ranks.ready:
+            raise self.RanksNotReady
+        user_ids = self.ranks.top(limit)
+        if not user_ids:
+            raise self.UserNotFound
+        if self.writes != None:
+            self.writes.flush()
+        rows = self.db.find({"_id": {"$in": user_ids}}, {key: 1 for key in ROW_FIELDS})
+        return leaderboard_text(self._chat_rows(rows, chat_latest_game), limit)
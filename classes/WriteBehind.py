@@ -0,0 +1,184 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+WRITE_BEHIND = config('WRITE_BEHIND', default=False, cast=bool)
+WRITE_BEHIND_SECONDS = config('WRITE_BEHIND_SECONDS', default=0.2, cast=float)
+WRITE_BEHIND_BATCH = config('WRITE_BEHIND_BATCH', default=500, cast=int)
+WRITE_BEHIND_RECORDS = config('WRITE_BEHIND_RECORDS', default=10000, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """Buffer of score writes applied to MongoDB in unordered bulk writes.
+
+    Writes are queued with the user they belong to and flushed every ``interval``
+    seconds, or as soon as ``batch`` writes are waiting. A flush applies them in
+    rounds holding at most one write per user and collection, each round one
+    unordered ``bulk_write`` per collection, so a user's writes are still applied
+    in the order they were queued. Writes that fail are retried on the next
+    flush, ahead of every write queued after them. Score pipelines skip an
+    edition that was already counted, so only a retroactive share whose bulk
+    write failed without a reply (after pymongo's own retry) can be counted twice.
+
+    The records of users whose score was last ingested are kept alongside, so
+    that shares can be answered without a round trip. Anything reading or writing
+    user data another way must call ``flush`` first, and ``forget`` the users it
+    changed.
+
+    Attributes
+    ----------
+    interval: float
+        Seconds between flushes
+    batch: int
+        Number of waiting writes that triggers a flush
+    """
+
+    def __init__(self, interval: float = WRITE_BEHIND_SECONDS, batch: int = WRITE_BEHIND_BATCH,
+                 records: int = WRITE_BEHIND_RECORDS) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.max_records = records
+        self._guard = threading.Condition()
+        # One flush at a time, so a flush never overtakes the writes of the one before
+        self._flushing = threading.Lock()
+        self._pending = []  # (collection, user_id, write model), in the order queued
+        self._waiting = {}  # user_id -> number of their writes not applied yet
+        self._records = OrderedDict()  # user_id -> record, least recently used first
+        self._stopped = False
+        self._counters = {
+            "queued": 0,
+            "written": 0,
+            "flushes": 0,
+            "bulk_writes": 0,
+            "failed_flushes": 0,
+        }
+        self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    # --------------------------------------------------RECORDS
+    def record(self, user_id: int) -> dict | None:
+        with self._guard:
+            record = self._records.get(user_id)
+            if record != None:
+                self._records.move_to_end(user_id)
+            return record
+
+    def remember(self, user_id: int, record: dict) -> None:
+        with self._guard:
+            self._records[user_id] = record
+            self._records.move_to_end(user_id)
+            if len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+
+    def forget(self, user_id: int = None) -> None:
+        """ Drop user_id's record, or every record """
+        with self._guard:
+            if user_id == None:
+                self._records.clear()
+            else:
+                self._records.pop(user_id, None)
+
+    # --------------------------------------------------WRITES
+    def _queue(self, collection, user_id: int, model) -> None:
+        with self._guard:
+            self._pending.append((collection, user_id, model))
+            self._waiting[user_id] = self._waiting.get(user_id, 0) + 1
+            self._counters["queued"] += 1
+            if len(self._pending) >= self.batch:
+                self._guard.notify()
+
+    def waiting(self, user_id: int) -> bool:
+        """ Whether user_id has writes not applied yet """
+        with self._guard:
+            return user_id in self._waiting
+
+    def update_one(self, collection, user_id: int, filter: dict, update: dict | list[dict], upsert: bool = False) -> None:
+        self._queue(collection, user_id, UpdateOne(filter, update, upsert=upsert))
+
+    def update_many(self, collection, user_id: int, filter: dict, update: dict | list[dict]) -> None:
+        self._queue(collection, user_id, UpdateMany(filter, update))
+
+    def flush(self) -> None:
+        """ Apply every write queued so far, raising PyMongoError if some could not be """
+        with self._flushing:
+            with self._guard:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            # The i-th write of a user to a collection goes into round i
+            rounds, seen = [], {}
+            for collection, user_id, model in pending:
+                key = (collection.name, user_id)
+                index = seen.get(key, 0)
+                seen[key] = index + 1
+                if index == len(rounds):
+                    rounds.append({})
+                rounds[index].setdefault(collection.name, (collection, []))[1].append((user_id, model))
+
+            for done, writes in enumerate(rounds):
+                for name in list(writes):
+                    collection, models = writes[name]
+                    try:
+                        collection.bulk_write([model for _, model in models], ordered=False)
+                        failed = []
+                    except BulkWriteError as e:
+                        failed = sorted({error["index"] for error in e.details.get("writeErrors", [])})
+                        error = e
+                    except PyMongoError as e:
+                        # Whether any of them were applied is unknown
+                        failed = list(range(len(models)))
+                        error = e
+                    applied = [models[i] for i in sorted(set(range(len(models))) - set(failed))]
+                    writes[name] = (collection, [models[i] for i in failed])
+                    with self._guard:
+                        self._counters["bulk_writes"] += 1
+                        self._counters["written"] += len(applied)
+                        for user_id, _ in applied:
+                            self._waiting[user_id] -= 1
+                            if not self._waiting[user_id]:
+                                del self._waiting[user_id]
+                    if failed:
+                        # Requeued ahead of anything queued during the flush
+                        retry = [(collection, user_id, model) for later in rounds[done:]
+                                 for collection, models in later.values() for user_id, model in models]
+                        with self._guard:
+                            self._pending = retry + self._pending
+                            self._counters["failed_flushes"] += 1
+                        raise error
+            with self._guard:
+                self._counters["flushes"] += 1
+
+    def _flush_periodically(self) -> None:
+        while True:
+            with self._guard:
+                if not self._stopped and len(self._pending) < self.batch:
+                    self._guard.wait(self.interval)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except PyMongoError:
+                logger.exception("Failed to flush buffered writes, retrying in %s seconds", self.interval)
+                time.sleep(self.interval)
+
+    def stop(self) -> None:
+        """ Flush the writes still waiting and stop flushing in the background """
+        with self._guard:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._guard.notify()
+        self._thread.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._guard:
+            return self._counters | {"waiting": len(self._pending), "records": len(self._records)}
@@ -1,11 +1,34 @@
-import os
-import jsonpickle
-from typing import Any
-from telebot import TeleBot, types
-from utils.messages import added_text
+import logging
+import threading
+import time
+from typing import Any, Iterable, TextIO
+from decouple import config
+from telebot import types
+from utils.messages import added_batch_text, daily_summary_text
 from classes.WordleStats import WordleStats
+from classes.UserLock import UserLock
+from classes.Leaderboard import Leaderboard
+from classes.ChatMembers import ChatMembers
+from classes.GlobalRank import GlobalRank, GLOBAL_RANK_REFRESH
+from classes.LeaderboardRenderer import LeaderboardRenderer, LEADERBOARD_IMAGES
+from classes.DailySummary import DailySummary, DAILY_SUMMARY
+from classes.WriteBehind import WriteBehind, WRITE_BEHIND
+from handlers.message_sender import MessageSender
 from utils.message_handler import extract_score
-from pymongo import collection
+from utils.game_history import distribution_stats, DIST_SIZE
+from utils.user_transfer import ImportReport, import_stats, format_rows
+from utils.storage import Database
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+FAST_INGEST = config('FAST_INGEST', default=True, cast=bool)
+LATEST_GAME_TTL = config('LATEST_GAME_TTL', default=30.0, cast=float)
+ENSURE_INDEXES = config('ENSURE_INDEXES', default=True, cast=bool)
+# Streaks are expired when read, the sweep only persists them once per edition
+STREAK_SWEEP = config('STREAK_SWEEP', default=False, cast=bool)
+INDEX_RETRY_SECONDS = 30
+
+logger = logging.getLogger(__name__)
 
 
 class GlobalDB:
@@ -15,30 +38,157 @@ class GlobalDB:
     Attributes
     ----------
     latest_game: int
-        Latest game globally for streak purposes
+        Latest game globally for streak purposes, 0 before any has been shared
     global_data: WordleStats
         Class containing methods to interact with and update database
     """
 
-    def __init__(self, db: collection.Collection) -> None:
+    def __init__(self, db: Database) -> None:
         self._latest_game = db["latest_game"]
-        self.global_data = WordleStats(db["user_data"])
+        # (latest_game, time.monotonic() when read from the database)
+        self._latest_cache = None
+        # Shares are answered from memory and written in bulk every few hundred milliseconds
+        self.writes = WriteBehind() if WRITE_BEHIND and FAST_INGEST else None
+        self.global_data = WordleStats(db["user_data"], Leaderboard(db["leaderboards"]),
+                                       ChatMembers(db["chat_members"], migrated=False), self.writes, GlobalRank())
+        # Each edition's results are posted to the chats that opted in once the next edition is shared
+        self.summaries = DailySummary(db["daily_results"], db["daily_summaries"]) if DAILY_SUMMARY else None
+        self._summary_sender = None
+        self.renderer = None
+        if LEADERBOARD_IMAGES:
+            if LeaderboardRenderer.available():
+                # Fonts and templates are loaded once here, not per /leaderboard
+                self.renderer = LeaderboardRenderer()
+            else:
+                logger.warning("LEADERBOARD_IMAGES is set but Pillow is not installed, sending text leaderboards")
+        threading.Thread(target=self._refresh_ranks, daemon=True).start()
+        # Whether or not indexes are managed here, leaderboards are only persisted once it is done
+        threading.Thread(target=self._migrate_members, daemon=True).start()
+        if ENSURE_INDEXES:
+            # In the background, so startup does not wait for MongoDB to be reachable
+            threading.Thread(target=self._ensure_indexes, daemon=True).start()
+
+    def _ensure_indexes(self) -> None:
+        while True:
+            try:
+                self.global_data.ensure_indexes(STREAK_SWEEP)
+                if self.summaries != None:
+                    self.summaries.ensure_indexes()
+                return
+            except PyMongoError:
+                logger.exception("Failed to create indexes, retrying in %s seconds", INDEX_RETRY_SECONDS)
+                time.sleep(INDEX_RETRY_SECONDS)
+
+    def _migrate_members(self) -> None:
+        while True:
+            try:
+                moved = self.global_data.migrate_members()
+                if moved:
+                    logger.info("Moved the chats of %s users to chat_members", moved)
+                return
+            except PyMongoError:
+                logger.exception("Failed to migrate chat members, retrying in %s seconds", INDEX_RETRY_SECONDS)
+                time.sleep(INDEX_RETRY_SECONDS)
+
+    def _refresh_ranks(self) -> None:
+        """ Load global ranks, then reload them every GLOBAL_RANK_REFRESH seconds """
+        while True:
+            try:
+                self.global_data.ranks.rebuild(self.global_data.db)
+            except PyMongoError:
+                logger.exception("Failed to load global ranks, retrying in %s seconds", INDEX_RETRY_SECONDS)
+                time.sleep(INDEX_RETRY_SECONDS)
+                continue
+            time.sleep(GLOBAL_RANK_REFRESH)
+
+    def warm_up(self) -> None:
+        """ Connect to the database and import what /stats needs, so the first requests after startup do not wait for them """
+        try:
+            self._latest_game.find_one({"_id": 0})
+        except PyMongoError:
+            logger.exception("Failed to reach the database while warming up")
+        distribution_stats([1] * DIST_SIZE, [1.0])
+
+    def _cache_latest_game(self, edition: int) -> None:
+        self._latest_cache = (edition, time.monotonic())
 
     # --------------------------------------------------GETTERS
     @property
     def latest_game(self) -> int:
-        return self._latest_game.find_one({"_id": 0})['latest_game']
+        cache = self._latest_cache
+        if cache != None and time.monotonic() - cache[1] < LATEST_GAME_TTL:
+            return cache[0]
+        latest = self._latest_game.find_one({"_id": 0})
+        # 0 until a Wordle has been shared
+        edition = latest['latest_game'] if latest != None else 0
+        self._cache_latest_game(edition)
+        return edition
 
     # --------------------------------------------------SETTERS
     @latest_game.setter
     def latest_game(self, edition: int) -> None:
-        if edition > self.latest_game:
-            self._latest_game.replace_one({"_id": 0},
-                                          {"latest_game": edition},
-                                          upsert=True)
+        # The cached value never runs ahead of the database, so anything it already covers needs no write
+        cache = self._latest_cache
+        if cache != None and edition <= cache[0]:
+            return
+        res = self._latest_game.find_one_and_update({"_id": 0},
+                                                    {"$max": {"latest_game": edition}},
+                                                    upsert=True,
+                                                    return_document=ReturnDocument.BEFORE)
+        previous = res['latest_game'] if res != None else edition
+        self._cache_latest_game(max(previous, edition))
+        # Only the update that moved the edition forward sweeps, so each edition is swept once across dynos
+        if STREAK_SWEEP and edition > previous:
+            threading.Thread(target=self.global_data.expire_streaks, args=(edition,), daemon=True).start()
+        if edition > previous:
+            self.summarise(edition - 1)
+
+    # --------------------------------------------------DAILY SUMMARIES
+    def start_summaries(self, bot: MessageSender) -> None:
+        """ Send daily summaries through bot from now on, catching up on the edition that last ended """
+        if self.summaries == None:
+            return
+        self._summary_sender = bot
+        # Chats already summarised are skipped by their checkpoint
+        threading.Thread(target=self._run_summaries, daemon=True).start()
+
+    def summarise(self, edition: int) -> None:
+        """ Post edition's results to the opted-in chats in the background """
+        if self.summaries == None or self._summary_sender == None:
+            return
+        threading.Thread(target=self._run_summaries, args=(edition,), daemon=True).start()
+
+    def _run_summaries(self, edition: int = None) -> None:
+        """ Send edition's summaries, by default those of the edition before the latest one """
+        try:
+            if edition == None:
+                if self.latest_game == 0:
+                    # Nothing shared yet
+                    return
+                edition = self.latest_game - 1
+            if self.writes != None:
+                # Shares still queued are part of the results
+                self.writes.flush()
+            sent = self.summaries.run(edition, self.global_data.db, self._send_summary)
+            if sent:
+                logger.info("Sent the summary of Wordle %s to %s chats", edition, sent)
+        except Exception:
+            logger.exception("Failed to send the summary of Wordle %s", edition)
+
+    def _send_summary(self, chat_id: int, edition: int, players: list[tuple[str, float, int]]) -> None:
+        self._summary_sender.send_message(chat_id, daily_summary_text(edition, players))
+
+    def toggle_summary(self, chat_id: int) -> bool | None:
+        """ Opt the chat in or out of daily summaries, None if they are disabled """
+        if self.summaries == None:
+            return None
+        return self.summaries.toggle(chat_id, self.latest_game)
+
+    def summary_stats(self) -> dict | None:
+        return self.summaries.stats() if self.summaries != None else None
 
     # --------------------------------------------------METHODS
-    def add_score(self, message: types.Message, bot: TeleBot, debug: bool = False, id: int = 1, name: str = "", txt: str = "") -> None:
+    def add_score(self, message: types.Message, bot: MessageSender, debug: bool = False, id: int = 1, name: str = "", txt: str = "") -> None:
         """ Add Wordle score to user database """
         try:
             chat_id = message.chat.id
@@ -46,20 +196,28 @@ class GlobalDB:
             username = message.from_user.first_name if not debug else name
             text = message.text if not debug else txt
 
-            edition, tries = extract_score(text)
+            score = extract_score(text)
+            if score == None:
+                return
+            edition, tries, grid = score
             self.latest_game = edition
 
-            update, update_msg = self.global_data.update_stats(
+            update_func = self.global_data.ingest_score if FAST_INGEST else self.global_data.update_stats
+            update, update_msg = update_func(
                 user_id=user_id,
                 chat_id=chat_id,
                 edition=edition,
                 tries=tries,
-                username=username
+                username=username,
+                grid=grid
             )
+            if self.summaries != None:
+                self.summaries.record(edition, chat_id, user_id, username, tries, self.writes)
 
             if update_msg and update:
-                bot.send_message(chat_id, added_text(
-                    username=username, init_score=tries), parse_mode="MarkdownV2")
+                # Confirmations for one chat arriving in a burst are sent as one message
+                bot.send_coalesced(chat_id, "added", (username, tries),
+                                   added_batch_text, parse_mode="MarkdownV2")
             elif update_msg and not update:
                 bot.reply_to(message,
                             f"Today's Wordle has already been computed into your average\!",
@@ -69,6 +227,9 @@ class GlobalDB:
             if warning_state:
                 bot.reply_to(message,
                             "/toggleretroactive is OFF so results for older games do not affect your stats! Use /togglewarning to turn off this warning.")
+        except UserLock.Timeout:
+            bot.reply_to(message,
+                         "Your stats are busy being updated elsewhere, please share your result again in a moment!")
 
     def print_scores(self, chat_id: int, user_id: int, cmd: str) -> str:
         """ Send pretty printed requested stats """
@@ -77,6 +238,24 @@ class GlobalDB:
 
         return print_func(user_id=user_id, chat_id=chat_id, chat_latest_game=self.latest_game)
 
+    def leaderboard_photo(self, chat_id: int, user_id: int) -> tuple[str, str | bytes]:
+        """ Cache key of the chat's leaderboard image, with its file_id if it was sent before or else the PNG """
+        chat_latest_game = self.latest_game
+        # The text leaderboard comes from the render cache, so an unchanged leaderboard hashes without a query
+        key = self.renderer.key(self.global_data.print_leaderboard(
+            user_id=user_id, chat_id=chat_id, chat_latest_game=chat_latest_game))
+        file_id = self.renderer.file_id(key)
+        if file_id != None:
+            return key, file_id
+        rows = self.global_data.leaderboard_rows(user_id, chat_id, chat_latest_game, self.renderer.max_rows)
+        return key, self.renderer.render(rows)
+
+    def print_global(self, user_id: int, cmd: str) -> str:
+        """ User's global rank, or the global top for globaltop """
+        if cmd == 'globaltop':
+            return self.global_data.print_global_top(self.latest_game)
+        return self.global_data.print_global_rank(user_id)
+
     def update_data(self, chat_id: int, user_id: int, input: Any, command: str, input_avg: Any = 0) -> None | tuple[int, float]:
         return self.global_data.manual_update(
             user_id=user_id,
@@ -103,19 +282,54 @@ class GlobalDB:
     def set_latest_game(self, latest_game: int) -> None:
         self._latest_game.replace_one({"_id": 0},
                                       {"latest_game": latest_game})
+        # Other processes pick this up once their cache expires
+        self._cache_latest_game(latest_game)
         
     def clear_debug(self, admin_id: int) -> None:
-        self.global_data.db.delete_many({"member_of_chats": admin_id, "_id": {"$ne": admin_id}})
+        self.global_data.settle()
+        debug_users = [user_id for user_id in self.global_data.members.members(admin_id) if user_id != admin_id]
+        self.global_data.db.delete_many({"_id": {"$in": debug_users}})
+        self.global_data.members.remove(debug_users)
+        # Debug users may have shared in other chats too, so they leave every leaderboard and the global ranks
+        for user_id in debug_users:
+            self.global_data.boards.remove(user_id)
+            if self.global_data.ranks != None:
+                self.global_data.ranks.remove(user_id)
+        self.global_data.boards.drop(admin_id)
         
     def test_lock(self, admin_id: int) -> str:
-        self.global_data.get_user_data(admin_id, write=True)
+        self.global_data.get_user_data(admin_id)
         
     def toggle_lock(self, admin_id: int) -> str:
-        old_state = self.global_data.db.find_one({"_id": admin_id})['lock']
-        new_state = not old_state
+        # Simulates a crashed worker: the lease is left behind and expires by itself
+        new_state = not self.global_data.check_lock(admin_id)
+        lease = {"lock": True, "lock_owner": "admin",
+                 "lock_expires": time.time() + self.global_data.locks.lease}
         self.global_data.db.update_one({"_id": admin_id},
-                           {"$set": {"lock": new_state}})
+                           {"$set": lease if new_state else {"lock": False}})
         return new_state
     
+    def rebuild_stats(self, user_id: int) -> dict:
+        return self.global_data.rebuild(user_id)
+
     def check_lock(self, admin_id: int) -> str:
         return self.global_data.check_lock(admin_id)
+
+    def lock_stats(self) -> dict:
+        return self.global_data.locks.stats()
+
+    def import_stats(self, lines: Iterable[str], format: str, check: bool = False) -> ImportReport:
+        """ Validate a CSV or NDJSON file of user stats, and apply it unless check is set """
+        return import_stats(self.global_data, lines, format, check)
+
+    def export_stats(self, file: TextIO, format: str) -> None:
+        file.writelines(format_rows(self.global_data.export_users(self.latest_game), format))
+
+    def image_stats(self) -> dict | None:
+        return self.renderer.stats() if self.renderer != None else None
+
+    def member_stats(self) -> dict:
+        return self.global_data.members.stats()
+
+    def write_stats(self) -> dict | None:
+        return self.writes.stats() if self.writes != None else None
@@ -0,0 +1,307 @@
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable
+from decouple import config
+from telebot import TeleBot, types
+from telebot.apihelper import ApiTelegramException
+from handlers.metrics import metrics
+from utils.percentiles import percentile
+
+SEND_WORKERS = config('SEND_WORKERS', default=2, cast=int)
+# Telegram allows about 20 messages a minute in a group, 1 a second in a private chat and 30 a second overall
+SEND_CHAT_PER_MINUTE = config('SEND_CHAT_PER_MINUTE', default=20, cast=float)
+SEND_PRIVATE_PER_SECOND = config('SEND_PRIVATE_PER_SECOND', default=1, cast=float)
+SEND_CHAT_BURST = config('SEND_CHAT_BURST', default=3, cast=float)
+SEND_CHAT_BUCKETS = config('SEND_CHAT_BUCKETS', default=10000, cast=int)
+SEND_GLOBAL_PER_SECOND = config('SEND_GLOBAL_PER_SECOND', default=30, cast=float)
+SEND_COALESCE_SECONDS = config('SEND_COALESCE_SECONDS', default=1.0, cast=float)
+SEND_MAX_RETRIES = config('SEND_MAX_RETRIES', default=5, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Token bucket allowing bursts of capacity messages, refilled at rate tokens a second """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """ Seconds until a token is available """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """ Whether the bucket has refilled, so a new one would behave the same """
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class Outgoing:
+    """ Message waiting to be sent, with the items of a coalesced message """
+    __slots__ = ("chat_id", "text", "photo", "reply_to", "kwargs", "key", "items", "render",
+                 "on_sent", "created", "not_before", "retries")
+
+    def __init__(self, chat_id: int, text: str = None, reply_to: types.Message = None, kwargs: dict = None,
+                 key: str = None, render: Callable[[list], str] = None, not_before: float = 0.0,
+                 photo: str | bytes = None, on_sent: Callable[[types.Message], None] = None) -> None:
+        self.chat_id = chat_id
+        self.text = text
+        self.photo = photo
+        self.reply_to = reply_to
+        self.kwargs = kwargs or {}
+        self.key = key
+        self.items = []
+        self.render = render
+        self.on_sent = on_sent
+        self.created = time.monotonic()
+        self.not_before = not_before
+        self.retries = 0
+
+
+class MessageSender:
+    """
+    Class sending bot messages off the request path, within Telegram's rate limits.
+
+    Messages are queued per chat and sent in order by a pool of sender threads.
+    A chat is only sent to by one thread at a time, and each send takes a token
+    from the chat's bucket and from the global bucket. Private chats (positive
+    ids) and groups are refilled at their own rates, and the buckets of idle
+    chats are forgotten once refilled, keeping about max_chats of them. A 429
+    answer pauses the chat for the retry_after Telegram asks for. Coalesced
+    messages with the same key that are waiting for one chat are sent as a
+    single message.
+
+    Attributes
+    ----------
+    bot: TeleBot
+        Bot used to send the messages
+    workers: int
+        Number of sender threads, 0 to send in the calling thread
+    """
+
+    def __init__(self, bot: TeleBot, workers: int = SEND_WORKERS,
+                 chat_per_minute: float = SEND_CHAT_PER_MINUTE,
+                 global_per_second: float = SEND_GLOBAL_PER_SECOND,
+                 coalesce_seconds: float = SEND_COALESCE_SECONDS,
+                 private_per_second: float = SEND_PRIVATE_PER_SECOND,
+                 chat_burst: float = SEND_CHAT_BURST,
+                 max_chats: int = SEND_CHAT_BUCKETS) -> None:
+        self.bot = bot
+        self.chat_per_minute = chat_per_minute
+        self.private_per_second = private_per_second
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.coalesce_seconds = coalesce_seconds
+        self._global = TokenBucket(global_per_second, global_per_second)
+        self._chats = OrderedDict()  # chat id -> TokenBucket, least recently sent to first
+        self._pending = {}  # chat id -> deque of Outgoing, the head is removed once sent
+        self._sending = set()  # chats whose head is being sent
+        self._ready = []  # heap of (time, seq, chat id), one entry per chat that is neither empty nor being sent to
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._latencies = deque(maxlen=1000)  # seconds from queued to sent, most recent messages
+        self._counters = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "coalesced": 0,
+            "throttled": 0,
+            "retry_after": 0,
+        }
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # ------------------------------------------------------------------QUEUEING
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        """ Queue a message, taking the same arguments as TeleBot.send_message """
+        self._queue(Outgoing(chat_id, text, kwargs=kwargs))
+
+    def reply_to(self, message: types.Message, text: str, **kwargs) -> None:
+        """ Queue a reply, taking the same arguments as TeleBot.reply_to """
+        self._queue(Outgoing(message.chat.id, text, reply_to=message, kwargs=kwargs))
+
+    def send_photo(self, chat_id: int, photo: str | bytes, on_sent: Callable[[types.Message], None] = None, **kwargs) -> None:
+        """ Queue a photo, given as a file_id or image bytes, calling on_sent with the message once it is sent """
+        self._queue(Outgoing(chat_id, photo=photo, kwargs=kwargs, on_sent=on_sent))
+
+    def send_coalesced(self, chat_id: int, key: str, item, render: Callable[[list], str], **kwargs) -> None:
+        """ Queue item, merged with the waiting items of the same key for the chat and sent as render(items) """
+        if not self._threads:
+            self.send_message(chat_id, render([item]), **kwargs)
+            return
+        with self._cond:
+            chat = self._pending.get(chat_id, ())
+            # The head of a chat being sent to has already been rendered
+            start = 1 if chat_id in self._sending else 0
+            for i in range(start, len(chat)):
+                waiting = chat[i]
+                if waiting.key == key:
+                    waiting.items.append(item)
+                    self._counters["coalesced"] += 1
+                    return
+            outgoing = Outgoing(chat_id, kwargs=kwargs, key=key, render=render,
+                                not_before=time.monotonic() + self.coalesce_seconds)
+            outgoing.items.append(item)
+            self._queue(outgoing)
+
+    def _queue(self, outgoing: Outgoing) -> None:
+        if not self._threads:
+            while (retry_after := self._send(outgoing)):
+                time.sleep(retry_after)
+            return
+        # The condition's lock is reentrant, send_coalesced calls this while holding it
+        with self._cond:
+            self._counters["queued"] += 1
+            chat = self._pending.get(outgoing.chat_id)
+            if chat == None:
+                chat = self._pending[outgoing.chat_id] = deque()
+            chat.append(outgoing)
+            if len(chat) == 1 and outgoing.chat_id not in self._sending:
+                self._schedule(outgoing.chat_id, outgoing.not_before)
+
+    def _schedule(self, chat_id: int, at: float) -> None:
+        # Caller holds self._cond
+        self._seq += 1
+        heapq.heappush(self._ready, (at, self._seq, chat_id))
+        self._cond.notify()
+
+    # ------------------------------------------------------------------SENDING
+
+    def _next(self) -> Outgoing | None:
+        """ Wait for the next message whose chat and the global bucket both have a token """
+        with self._cond:
+            while True:
+                if not self._ready:
+                    if self._stopping:
+                        return None
+                    self._cond.wait()
+                    continue
+                at, _, chat_id = self._ready[0]
+                now = time.monotonic()
+                if at > now:
+                    self._cond.wait(at - now)
+                    continue
+                heapq.heappop(self._ready)
+                bucket = self._bucket(chat_id, now)
+                wait = max(bucket.delay(now), self._global.delay(now))
+                if wait > 0:
+                    self._counters["throttled"] += 1
+                    self._schedule(chat_id, now + wait)
+                    continue
+                bucket.take()
+                self._global.take()
+                # The chat stays off the heap until this message is sent, keeping its messages in order
+                self._sending.add(chat_id)
+                return self._pending[chat_id][0]
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        # Caller holds self._cond
+        bucket = self._chats.get(chat_id)
+        if bucket != None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        rate = self.private_per_second if chat_id > 0 else self.chat_per_minute / 60
+        bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        # A full bucket of a chat with nothing waiting is the same as a new one, the oldest stay when none can go
+        while len(self._chats) > self.max_chats:
+            oldest, idle = next(iter(self._chats.items()))
+            if oldest in self._pending or not idle.full(now):
+                break
+            del self._chats[oldest]
+        return bucket
+
+    def _work(self) -> None:
+        while True:
+            outgoing = self._next()
+            if outgoing == None:
+                return
+            retry_after = self._send(outgoing)
+            with self._cond:
+                self._sending.discard(outgoing.chat_id)
+                chat = self._pending[outgoing.chat_id]
+                if retry_after:
+                    self._schedule(outgoing.chat_id, time.monotonic() + retry_after)
+                    continue
+                chat.popleft()
+                if chat:
+                    self._schedule(outgoing.chat_id, chat[0].not_before)
+                else:
+                    del self._pending[outgoing.chat_id]
+                    if not self._ready:
+                        self._cond.notify_all()
+
+    def _send(self, outgoing: Outgoing) -> float:
+        """ Send a message, returning the seconds to wait before retrying it or 0 """
+        text = outgoing.text if outgoing.render == None else outgoing.render(outgoing.items)
+        method = "sendMessage" if outgoing.photo == None else "sendPhoto"
+        start = time.perf_counter()
+        try:
+            if outgoing.photo != None:
+                sent = self.bot.send_photo(outgoing.chat_id, outgoing.photo, **outgoing.kwargs)
+            elif outgoing.reply_to == None:
+                sent = self.bot.send_message(outgoing.chat_id, text, **outgoing.kwargs)
+            else:
+                sent = self.bot.reply_to(outgoing.reply_to, text, **outgoing.kwargs)
+        except ApiTelegramException as e:
+            metrics.observe_telegram(method, time.perf_counter() - start, failed=True)
+            if e.error_code == 429 and outgoing.retries < SEND_MAX_RETRIES:
+                outgoing.retries += 1
+                with self._cond:
+                    self._counters["retry_after"] += 1
+                return float((e.result_json or {}).get("parameters", {}).get("retry_after", 1))
+            logger.exception("Failed to send message to chat %s", outgoing.chat_id)
+            outcome = "failed"
+        except Exception:
+            metrics.observe_telegram(method, time.perf_counter() - start, failed=True)
+            logger.exception("Failed to send message to chat %s", outgoing.chat_id)
+            outcome = "failed"
+        else:
+            metrics.observe_telegram(method, time.perf_counter() - start)
+            outcome = "sent"
+            if outgoing.on_sent != None:
+                try:
+                    outgoing.on_sent(sent)
+                except Exception:
+                    logger.exception("Callback failed after sending to chat %s", outgoing.chat_id)
+        with self._cond:
+            self._counters[outcome] += 1
+            self._latencies.append(time.monotonic() - outgoing.created)
+        return 0.0
+
+    def stop(self, timeout: float = None) -> None:
+        """ Send the messages already queued, then stop the sender threads, waiting timeout seconds at most for all of them """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = None if timeout == None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline == None else max(deadline - time.monotonic(), 0))
+
+    def stats(self) -> dict:
+        """ Counters, waiting messages and send latency percentiles in seconds """
+        with self._cond:
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+            waiting = sum(len(chat) for chat in self._pending.values())
+            buckets = len(self._chats)
+
+        return counters | {
+            "waiting": waiting,
+            "chat_buckets": buckets,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
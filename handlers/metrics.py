@@ -0,0 +1,280 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+from typing import Callable
+from decouple import config
+from pymongo import monitoring
+from utils.percentiles import percentile
+
+METRICS = config('METRICS', default=True, cast=bool)
+# Upper bounds in seconds of the handler duration histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Label of work done outside any handler, e.g. dedup, index builds and streak sweeps
+NO_HANDLER = "none"
+
+
+class HandlerStats:
+    __slots__ = ("calls", "errors", "seconds", "buckets", "recent", "db_calls", "db_seconds")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.recent = deque(maxlen=1000)  # seconds, most recent calls
+        self.db_calls = 0
+        self.db_seconds = 0.0
+
+
+class Metrics:
+    """
+    Class timing handlers, handler filters, database commands and Telegram requests.
+
+    Database commands are attributed to the handler running on the same thread,
+    so the time a handler spends waiting on MongoDB can be told apart from its
+    own. Everything is kept in memory and rendered in Prometheus' text format.
+
+    Attributes
+    ----------
+    enabled: bool
+        False to make the decorators return functions unchanged and record nothing
+    """
+
+    def __init__(self, enabled: bool = METRICS) -> None:
+        self.enabled = enabled
+        self._guard = threading.Lock()
+        self._local = threading.local()
+        self._handlers: dict[str, HandlerStats] = {}
+        self._filters: dict[str, list] = {}        # name: [calls, seconds]
+        self._commands: dict[tuple, list] = {}     # (handler, command): [calls, failures, seconds]
+        self._telegram: dict[str, list] = {}       # method: [calls, failures, seconds]
+        self._updates = [0, 0.0]                   # updates, seconds processing them
+        self._startup: dict[str, float] = {}      # phase: seconds, in the order the phases ended
+
+    def current_handler(self) -> str:
+        return getattr(self._local, "handler", NO_HANDLER)
+
+    # ------------------------------------------------------------------------DECORATORS
+
+    def handler(self, func: Callable) -> Callable:
+        """ Decorator timing a bot handler and attributing its database commands to it """
+        if not self.enabled:
+            return func
+        name = func.__name__
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            outer = self.current_handler()
+            self._local.handler = name
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._local.handler = outer
+                self._observe_handler(name, time.perf_counter() - start, failed)
+        return timed
+
+    def filter(self, name: str, func: Callable) -> Callable:
+        """ Wrap a handler filter, which telebot runs on every message, to count its calls and time """
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self._guard:
+                    totals = self._filters.setdefault(name, [0, 0.0])
+                    totals[0] += 1
+                    totals[1] += seconds
+        return timed
+
+    def updates(self, func: Callable) -> Callable:
+        """ Decorator timing a function processing a list of updates, filters and handlers included """
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        def timed(updates: list, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(updates, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self._guard:
+                    self._updates[0] += len(updates)
+                    self._updates[1] += seconds
+        return timed
+
+    # ------------------------------------------------------------------------OBSERVATIONS
+
+    def _observe_handler(self, name: str, seconds: float, failed: bool) -> None:
+        with self._guard:
+            stats = self._handlers.get(name)
+            if stats == None:
+                stats = self._handlers[name] = HandlerStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.seconds += seconds
+            stats.buckets[bisect_left(BUCKETS, seconds)] += 1
+            stats.recent.append(seconds)
+
+    def observe_command(self, command: str, seconds: float, failed: bool = False) -> None:
+        """ Record a database command run on the calling thread """
+        if not self.enabled:
+            return
+        handler = self.current_handler()
+        with self._guard:
+            totals = self._commands.setdefault((handler, command), [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += failed
+            totals[2] += seconds
+            if handler != NO_HANDLER:
+                # Before the handler's first call has finished
+                stats = self._handlers.get(handler)
+                if stats == None:
+                    stats = self._handlers[handler] = HandlerStats()
+                stats.db_calls += 1
+                stats.db_seconds += seconds
+
+    def observe_telegram(self, method: str, seconds: float, failed: bool = False) -> None:
+        if not self.enabled:
+            return
+        with self._guard:
+            totals = self._telegram.setdefault(method, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += failed
+            totals[2] += seconds
+
+    def phase(self, name: str, start: float) -> float:
+        """ Record a startup phase begun at start, a time.perf_counter() value, returning when it ended """
+        end = time.perf_counter()
+        with self._guard:
+            self._startup[name] = end - start
+        return end
+
+    def startup(self) -> dict[str, float]:
+        with self._guard:
+            return dict(self._startup)
+
+    def listen_to_mongo(self) -> None:
+        """ Record the commands of every MongoClient created from now on """
+        if self.enabled:
+            monitoring.register(CommandMetrics(self))
+
+    # ------------------------------------------------------------------------REPORTS
+
+    def render(self, gauges: dict[str, dict] = {}) -> str:
+        """ Metrics in Prometheus' text exposition format, plus gauges as {prefix: {name: value}} """
+        lines = []
+
+        def family(name: str, kind: str, help: str) -> None:
+            lines.append(f"# HELP wordle_{name} {help}")
+            lines.append(f"# TYPE wordle_{name} {kind}")
+
+        with self._guard:
+            family("handler_seconds", "histogram", "Time spent in bot handlers")
+            for name, stats in sorted(self._handlers.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), stats.buckets):
+                    cumulative += count
+                    lines.append(f'wordle_handler_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'wordle_handler_seconds_sum{{handler="{name}"}} {stats.seconds}')
+                lines.append(f'wordle_handler_seconds_count{{handler="{name}"}} {stats.calls}')
+            family("handler_errors_total", "counter", "Bot handler calls that raised")
+            for name, stats in sorted(self._handlers.items()):
+                lines.append(f'wordle_handler_errors_total{{handler="{name}"}} {stats.errors}')
+
+            family("filter_calls_total", "counter", "Handler filter calls")
+            for name, (calls, _) in sorted(self._filters.items()):
+                lines.append(f'wordle_filter_calls_total{{filter="{name}"}} {calls}')
+            family("filter_seconds_total", "counter", "Time spent in handler filters")
+            for name, (_, seconds) in sorted(self._filters.items()):
+                lines.append(f'wordle_filter_seconds_total{{filter="{name}"}} {seconds}')
+
+            family("updates_total", "counter", "Updates processed")
+            lines.append(f"wordle_updates_total {self._updates[0]}")
+            family("update_seconds_total", "counter", "Time spent processing updates, filters and handlers included")
+            lines.append(f"wordle_update_seconds_total {self._updates[1]}")
+
+            for name, index, help in (("db_commands_total", 0, "Database commands by handler"),
+                                      ("db_failures_total", 1, "Failed database commands by handler"),
+                                      ("db_seconds_total", 2, "Time spent in database commands by handler")):
+                family(name, "counter", help)
+                for (handler, command), totals in sorted(self._commands.items()):
+                    lines.append(f'wordle_{name}{{handler="{handler}",command="{command}"}} {totals[index]}')
+
+            for name, index, help in (("telegram_requests_total", 0, "Telegram API requests"),
+                                      ("telegram_failures_total", 1, "Failed Telegram API requests"),
+                                      ("telegram_seconds_total", 2, "Time spent in Telegram API requests")):
+                family(name, "counter", help)
+                for method, totals in sorted(self._telegram.items()):
+                    lines.append(f'wordle_{name}{{method="{method}"}} {totals[index]}')
+
+            family("startup_seconds", "gauge", "Time spent in each startup phase")
+            for name, seconds in self._startup.items():
+                lines.append(f'wordle_startup_seconds{{phase="{name}"}} {seconds}')
+
+        for prefix, values in gauges.items():
+            for name, value in values.items():
+                family(f"{prefix}_{name}", "gauge", f"{prefix} {name.replace('_', ' ')}")
+                lines.append(f"wordle_{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top: int = 5) -> str:
+        """ Handlers and database commands taking the most time in total """
+        with self._guard:
+            handlers = sorted(self._handlers.items(), key=lambda item: item[1].seconds, reverse=True)[:top]
+            rows = []
+            for name, stats in handlers:
+                if not stats.calls:
+                    continue
+                p95 = percentile(sorted(stats.recent), 0.95)
+                rows.append(f"{name}: {stats.calls} calls, {stats.seconds:.2f}s total, "
+                            f"avg {stats.seconds / stats.calls * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, "
+                            f"db {stats.db_calls / stats.calls:.1f} cmds {stats.db_seconds / stats.calls * 1000:.1f}ms per call"
+                            + (f", {stats.errors} errors" if stats.errors else ""))
+            commands = sorted(self._commands.items(), key=lambda item: item[1][2], reverse=True)[:top]
+            rows.append("")
+            for (handler, command), (calls, failures, seconds) in commands:
+                rows.append(f"{handler} {command}: {calls} cmds, {seconds:.2f}s total"
+                            + (f", {failures} failed" if failures else ""))
+            for name, (calls, seconds) in sorted(self._filters.items()):
+                rows.append(f"filter {name}: {calls} calls, {seconds * 1e6 / calls:.1f}us avg")
+            for method, (calls, failures, seconds) in sorted(self._telegram.items()):
+                rows.append(f"telegram {method}: {calls} requests, {seconds / calls * 1000:.1f}ms avg"
+                            + (f", {failures} failed" if failures else ""))
+            if self._updates[0]:
+                rows.append(f"updates: {self._updates[0]}, {self._updates[1] / self._updates[0] * 1000:.1f}ms avg")
+            if self._startup:
+                rows.append("startup: " + ", ".join(f"{name} {seconds * 1000:.0f}ms"
+                                                    for name, seconds in self._startup.items()))
+        return "\n".join(rows).strip() or "No metrics yet"
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """ pymongo listener recording every command's duration, on the thread that ran it """
+
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self.metrics.observe_command(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.metrics.observe_command(event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+# Shared by bot.py's handlers, the message sender and the MongoDB client
+metrics = Metrics()
@@ -0,0 +1,82 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decouple import config
+from utils.storage import Collection
+from pymongo.errors import DuplicateKeyError
+
+DEDUP_CACHE_SIZE = config('DEDUP_CACHE_SIZE', default=10000, cast=int)
+# Telegram gives up redelivering an update after 24 hours
+DEDUP_TTL = config('DEDUP_TTL_SECONDS', default=86400, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDedup:
+    """
+    Class recognising redelivered Telegram updates by update_id.
+
+    Recent ids are kept in a bounded in-memory LRU. Ids missing from it are
+    claimed in a MongoDB collection with a unique _id, so a redelivery to
+    another dyno is caught as well. A TTL index expires claims once Telegram
+    can no longer redeliver the update. When the claim itself fails the update
+    is processed anyway: it has usually been acknowledged already, so dropping
+    it would lose it, while processing it twice at worst repeats a reply.
+
+    Attributes
+    ----------
+    _id: int
+        Telegram update_id
+    received: datetime
+        When the update was first processed, used by the TTL index
+    """
+
+    def __init__(self, db: Collection, cache_size: int = DEDUP_CACHE_SIZE, ttl: int = DEDUP_TTL) -> None:
+        self.db = db
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._recent = OrderedDict()
+        self._guard = threading.Lock()
+        self._index_ready = False
+        self._counters = {
+            "checked": 0,
+            "local_duplicates": 0,
+            "shared_duplicates": 0,
+            "claim_errors": 0,
+        }
+
+    def _ensure_index(self) -> None:
+        if not self._index_ready:
+            self.db.create_index("received", expireAfterSeconds=self.ttl)
+            self._index_ready = True
+
+    def seen(self, update_id: int) -> bool:
+        """ Claim update_id, returning True if it has already been processed """
+        with self._guard:
+            self._counters["checked"] += 1
+            if update_id in self._recent:
+                self._recent.move_to_end(update_id)
+                self._counters["local_duplicates"] += 1
+                return True
+            self._recent[update_id] = None
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+        self._ensure_index()
+        try:
+            self.db.insert_one({"_id": update_id, "received": datetime.now(timezone.utc)})
+        except DuplicateKeyError:
+            with self._guard:
+                self._counters["shared_duplicates"] += 1
+            return True
+        except Exception:
+            # Not claimed, by MongoDB or SQLite alike: processed here and only caught again by this process's LRU
+            logger.exception("Failed to claim update %s, processing it without the shared check", update_id)
+            with self._guard:
+                self._counters["claim_errors"] += 1
+        return False
+
+    def stats(self) -> dict:
+        with self._guard:
+            return dict(self._counters, cached=len(self._recent))
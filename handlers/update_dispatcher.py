@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable
+from telebot import types
+from utils.percentiles import percentile
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update: types.Update) -> int:
+    """ User the update belongs to, so that one user's updates are processed in order """
+    for event in (update.message, update.edited_message, update.callback_query):
+        if event != None and event.from_user != None:
+            return event.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Class processing webhook updates on a bounded pool of worker threads.
+
+    Updates are routed to a worker by user id, so a user's updates are always
+    processed in the order they were received, while different users are
+    processed in parallel.
+
+    Attributes
+    ----------
+    process: Callable
+        Function processing a list of updates, e.g. bot.process_new_updates
+    workers: int
+        Number of worker threads
+    queue_size: int
+        Maximum number of updates waiting per worker
+    """
+
+    def __init__(self, process: Callable[[list[types.Update]], None], workers: int, queue_size: int) -> None:
+        self.process = process
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._guard = threading.Lock()
+        # Set by stop, after which nothing is queued behind the workers' stop markers
+        self._stopped = False
+        self._latencies = deque(maxlen=1000)  # seconds from receipt to processed, most recent updates
+        self._counters = {
+            "accepted": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+        }
+        self._threads = [threading.Thread(target=self._work, args=(q,), daemon=True)
+                         for q in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update: types.Update) -> bool:
+        """ Queue an update, returning False if its worker is full or the dispatcher is stopping """
+        worker = self._queues[update_key(update) % len(self._queues)]
+        # Queued under the guard, so stop cannot put a worker's stop marker in between the check and the put
+        with self._guard:
+            try:
+                if self._stopped:
+                    raise queue.Full
+                worker.put_nowait((time.monotonic(), update))
+            except queue.Full:
+                self._counters["rejected"] += 1
+                return False
+            self._counters["accepted"] += 1
+        return True
+
+    def _work(self, updates: queue.Queue) -> None:
+        while True:
+            item = updates.get()
+            if item == None:
+                updates.task_done()
+                return
+            received, update = item
+            try:
+                self.process([update])
+                outcome = "processed"
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+                outcome = "failed"
+            with self._guard:
+                self._counters[outcome] += 1
+                self._latencies.append(time.monotonic() - received)
+            updates.task_done()
+
+    def stop(self, timeout: float = None) -> None:
+        """ Process the updates already queued, then stop the workers, waiting timeout seconds at most for all of them """
+        with self._guard:
+            self._stopped = True
+        deadline = None if timeout == None else time.monotonic() + timeout
+        for updates in self._queues:
+            try:
+                # A full queue has room for the marker once its worker takes the next update
+                updates.put(None, timeout=None if deadline == None else max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                logger.warning("Stopping with %s updates still queued", updates.qsize())
+        for thread in self._threads:
+            thread.join(None if deadline == None else max(deadline - time.monotonic(), 0))
+
+    def stats(self) -> dict:
+        """ Queue depth, counters and processing latency percentiles in seconds """
+        with self._guard:
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+
+        return counters | {
+            "queue_depth": sum(updates.qsize() for updates in self._queues),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
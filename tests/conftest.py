@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Modules read their settings at import; placeholders are enough, nothing reaches Telegram or MongoDB
+os.environ.setdefault('API_KEY', '123456:tests')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('MONGODB_CONNECTION', 'mongodb://localhost')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
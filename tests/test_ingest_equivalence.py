@@ -0,0 +1,47 @@
+import mongomock
+import pytest
+from benchmarks.ingest_equivalence import old_update_stats, FIELDS
+from classes.WordleStats import WordleStats
+from classes.Leaderboard import Leaderboard
+from classes.ChatMembers import ChatMembers
+
+# (user_id, chat_id, edition, tries) shared in order, X/6 counted as 7 tries
+SEQUENCES = {
+    "first game": [(1, -1, 500, 4.0)],
+    "repeat edition": [(1, -1, 500, 4.0), (1, -1, 500, 2.0), (1, -2, 500, 3.0)],
+    "streak": [(1, -1, 500, 4.0), (1, -1, 501, 3.0), (1, -1, 502, 5.0)],
+    "streak break": [(1, -1, 500, 4.0), (1, -1, 501, 3.0), (1, -1, 504, 5.0)],
+    "x/6": [(1, -1, 500, 7.0), (1, -1, 501, 7.0), (1, -1, 502, 1.0)],
+    "older edition": [(1, -1, 500, 4.0), (1, -1, 498, 3.0)],
+}
+
+
+def apply(func, *args):
+    try:
+        return func(*args)
+    except WordleStats.RetroactiveOff:
+        return "RetroactiveOff"
+
+
+@pytest.mark.parametrize("shares", SEQUENCES.values(), ids=SEQUENCES.keys())
+def test_ingest_score_matches_update_stats(shares):
+    old_db, new_db = mongomock.MongoClient().old, mongomock.MongoClient().new
+    stats = WordleStats(new_db.user_data, Leaderboard(new_db.leaderboards), ChatMembers(new_db.chat_members))
+    for user_id, chat_id, edition, tries in shares:
+        old = apply(old_update_stats, old_db.user_data, user_id, chat_id, edition, tries, "u")
+        new = apply(stats.ingest_score, user_id, chat_id, edition, tries, "u")
+        assert new == old
+        old_user, new_user = old_db.user_data.find_one({"_id": user_id}), new_db.user_data.find_one({"_id": user_id})
+        assert {field: new_user[field] for field in FIELDS} == pytest.approx({field: old_user[field] for field in FIELDS})
+        chats = {pair["chat_id"] for pair in new_db.chat_members.find({"user_id": user_id})}
+        assert chats == set(old_user["member_of_chats"])
+
+
+def test_x_counts_as_seven_tries():
+    db = mongomock.MongoClient().db
+    stats = WordleStats(db.user_data, Leaderboard(db.leaderboards), ChatMembers(db.chat_members))
+    stats.ingest_score(1, -1, 500, 7.0, "u")
+    stats.ingest_score(1, -1, 501, 3.0, "u")
+    user = db.user_data.find_one({"_id": 1})
+    assert user["score_avg"] == 5.0 and user["streak"] == 2
+    assert user["dist"][7] == 1 and user["dist"][3] == 1
@@ -0,0 +1,42 @@
+import mongomock
+import pytest
+from classes.Leaderboard import Leaderboard
+
+
+@pytest.fixture
+def boards():
+    return Leaderboard(mongomock.MongoClient().db.leaderboards)
+
+
+def test_render_is_cached(boards):
+    generation = boards.generation()
+    boards.store(-1, 500, [1, 2], "board", generation)
+    assert boards.cached(-1, 500, 1) == "board"
+
+
+def test_member_change_during_render_is_not_hidden(boards):
+    generation = boards.generation()
+    # A share by member 2 lands between the view read and store
+    boards.invalidate(2, -7)
+    boards.store(-1, 500, [1, 2], "stale board", generation)
+    assert boards.cached(-1, 500, 1) == None
+
+
+def test_chat_change_during_render_is_not_hidden(boards):
+    generation = boards.generation()
+    boards.invalidate(3, -1)
+    boards.store(-1, 500, [1, 2], "stale board", generation)
+    assert boards.cached(-1, 500, 1) == None
+
+
+def test_unrelated_change_keeps_render(boards):
+    generation = boards.generation()
+    boards.invalidate(3, -2)
+    boards.store(-1, 500, [1, 2], "board", generation)
+    assert boards.cached(-1, 500, 2) == "board"
+
+
+def test_invalidate_drops_stored_render(boards):
+    boards.store(-1, 500, [1, 2], "board", boards.generation())
+    boards.invalidate(1)
+    assert boards.cached(-1, 500, 2) == None
@@ -0,0 +1,47 @@
+import threading
+import time
+from handlers.message_sender import MessageSender
+
+
+class Bot:
+    """ Records what would have been sent to Telegram """
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent.append(chat_id)
+
+
+def wait_sent(bot: Bot, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while len(bot.sent) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_private_chats_and_groups_have_own_rates():
+    bot = Bot()
+    sender = MessageSender(bot, workers=1, chat_per_minute=20, private_per_second=1, chat_burst=2, coalesce_seconds=0)
+    for _ in range(4):
+        sender.send_message(-1, "group")
+        sender.send_message(1, "private")
+    time.sleep(1.5)
+    # Both start with the burst, only the private chat has refilled a token since
+    assert bot.sent.count(-1) == 2
+    assert bot.sent.count(1) == 3
+    sender.stop(0)
+
+
+def test_idle_chat_buckets_are_forgotten():
+    bot = Bot()
+    sender = MessageSender(bot, workers=1, private_per_second=100, chat_burst=1, max_chats=2, coalesce_seconds=0)
+    for chat_id in (1, 2, 3):
+        sender.send_message(chat_id, "hi")
+    wait_sent(bot, 3)
+    time.sleep(0.05)  # Long enough for every bucket to refill
+    sender.send_message(4, "hi")
+    wait_sent(bot, 4)
+    assert sender.stats()["chat_buckets"] == 2
+    sender.stop(1)
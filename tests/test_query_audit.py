@@ -0,0 +1,21 @@
+import mongomock
+from benchmarks.query_audit import RecordingCollection, run_session, distinct, index_scans, shape
+from classes.ChatMembers import ChatMembers
+from classes.Leaderboard import Leaderboard
+from classes.WordleStats import WordleStats
+
+
+def test_audited_queries_use_an_index():
+    db = mongomock.MongoClient().db
+    queries = []
+    stats = WordleStats(RecordingCollection(db["user_data"], queries),
+                        Leaderboard(RecordingCollection(db["leaderboards"], queries)),
+                        ChatMembers(RecordingCollection(db["chat_members"], queries)))
+    stats.ensure_indexes()
+    run_session(stats)
+
+    audited = distinct(queries)
+    assert len(audited) > 10
+    scans = [f"{name}.{method} {shape(filter)}" for name, method, filter in audited
+             if index_scans(db, name, filter)]
+    assert scans == []
@@ -0,0 +1,30 @@
+import json
+import os
+import subprocess
+import sys
+
+# Imported on first use or not at all, so importing bot must leave them out
+DEFERRED = ["numpy", "PIL", "pandas", "tabulate", "jsonpickle"]
+
+CHILD = """
+import json, sys, threading
+from telebot import apihelper
+# The warm-up thread imports numpy once its first Telegram request returns, so that request waits
+checked = threading.Event()
+apihelper._make_request = lambda *args, **kwargs: checked.wait(10)
+# pyTelegramBotAPI imports Pillow itself when it is installed, only what bot adds on top is checked
+before = set(sys.modules)
+import bot
+print(json.dumps(sorted(name for name in set(sys.modules) - before if name.split(".")[0] in {deferred!r})))
+checked.set()
+"""
+
+
+def test_bot_import_leaves_deferred_modules_unloaded():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = os.environ | {"API_KEY": "0:startup", "ADMIN_ID": "0", "DEFER_STARTUP": "True",
+                        "STORAGE_BACKEND": "sqlite", "SQLITE_PATH": ":memory:", "LEADERBOARD_IMAGES": "False"}
+    child = subprocess.run([sys.executable, "-c", CHILD.format(deferred=set(DEFERRED))], env=env, cwd=root,
+                           capture_output=True, text=True, timeout=60)
+    assert child.returncode == 0, child.stderr
+    assert json.loads(child.stdout.strip().splitlines()[-1]) == []
@@ -0,0 +1,41 @@
+import mongomock
+import pytest
+from classes.WordleStats import WordleStats
+from classes.Leaderboard import Leaderboard
+from classes.ChatMembers import ChatMembers
+from utils.game_history import distribution_stats
+
+
+@pytest.fixture
+def stats():
+    db = mongomock.MongoClient().db
+    return WordleStats(db.user_data, Leaderboard(db.leaderboards), ChatMembers(db.chat_members))
+
+
+def test_distribution_skips_unused_index():
+    # Tries 3 and 5: the median and spread of [3, 5], whatever dist[0] holds
+    result = distribution_stats([4, 0, 0, 1, 0, 1, 0, 0], [3.0, 5.0])
+    assert result["median"] == 4.0
+    assert result["std"] == pytest.approx(1.0)
+
+
+def test_stats_without_tracked_games_has_no_distribution(stats):
+    stats.db.insert_one({"_id": 1, "username": "old", "num_games": 12, "streak": 0, "score_avg": 4.0,
+                         "last_game": 400, "last_active_chat": -1, "toggle_retroactive": False})
+    msg = stats.print_stats(1, -1, 400)
+    assert "Median" not in msg and "Distribution" not in msg
+
+
+def test_stats_of_tracked_games_only(stats):
+    stats.ingest_score(1, -1, 500, 3.0, "new")
+    stats.ingest_score(1, -1, 501, 4.0, "new")
+    msg = stats.print_stats(1, -1, 501)
+    assert "Median: 3\\.5" in msg
+    assert "since tracking began" not in msg
+
+
+def test_stats_after_manual_edit_note_tracked_games(stats):
+    stats.ingest_score(1, -1, 500, 3.0, "new")
+    stats.manual_update(1, -1, "adjust", 20, 4.0)
+    msg = stats.print_stats(1, -1, 500)
+    assert "Distribution of the 1 games since tracking began" in msg
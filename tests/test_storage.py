@@ -0,0 +1,123 @@
+import mongomock
+import pytest
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from utils import sqlite_store
+from utils.sqlite_store import SQLiteDatabase
+
+
+@pytest.fixture(params=["mongomock", "sqlite"])
+def db(request):
+    if request.param == "mongomock":
+        yield mongomock.MongoClient().db
+    else:
+        database = SQLiteDatabase(":memory:")
+        yield database
+        database.close()
+
+
+@pytest.fixture
+def sqlite_db():
+    database = SQLiteDatabase(":memory:")
+    yield database
+    database.close()
+
+
+def test_find_filters_projects_sorts_and_limits(db):
+    db["users"].insert_one({"_id": 1, "name": "a", "games": 3, "chats": [-1, -2]})
+    db["users"].insert_one({"_id": 2, "name": "b", "games": 7, "chats": [-2]})
+    db["users"].insert_one({"_id": 3, "name": "c", "games": 5, "chats": []})
+    found = db["users"].find({"games": {"$gte": 5}}, {"name": 1}).sort("games", -1).limit(1)
+    assert list(found) == [{"_id": 2, "name": "b"}]
+    assert [user["_id"] for user in db["users"].find({"chats": -2})] == [1, 2]
+    assert db["users"].count_documents({"$or": [{"_id": 1}, {"games": 5}]}) == 2
+
+
+def test_update_operators_and_upsert(db):
+    db["users"].update_one({"_id": 1}, {"$set": {"name": "a"}, "$inc": {"games": 1}}, upsert=True)
+    db["users"].update_one({"_id": 1}, {"$inc": {"games": 2}, "$addToSet": {"chats": -1}})
+    after = db["users"].find_one_and_update({"_id": 1}, {"$unset": {"name": ""}}, return_document=ReturnDocument.AFTER)
+    assert after == {"_id": 1, "games": 3, "chats": [-1]}
+
+
+def test_pipeline_update_reads_stage_input(db):
+    db["users"].insert_one({"_id": 1, "games": 2, "avg": 3.0})
+    db["users"].update_one({"_id": 1}, [{"$set": {
+        "avg": {"$divide": [{"$add": [{"$multiply": ["$avg", "$games"]}, 6]}, {"$add": ["$games", 1]}]},
+        "games": {"$add": ["$games", 1]},
+    }}])
+    assert db["users"].find_one({"_id": 1}) == {"_id": 1, "games": 3, "avg": 4.0}
+
+
+def test_unique_index_rejects_duplicates(db):
+    db["pairs"].create_index([("chat_id", 1), ("user_id", 1)], unique=True)
+    db["pairs"].insert_one({"chat_id": -1, "user_id": 1})
+    with pytest.raises(DuplicateKeyError):
+        db["pairs"].insert_one({"chat_id": -1, "user_id": 1})
+    db["pairs"].insert_one({"chat_id": -1, "user_id": 2})
+    assert db["pairs"].count_documents({}) == 2
+
+
+@pytest.mark.parametrize("ordered, inserted", [(True, [2, 1]), (False, [2, 1, 3])])
+def test_insert_many_reports_partial_result(db, ordered, inserted):
+    db["users"].insert_one({"_id": 2})
+    with pytest.raises(BulkWriteError) as error:
+        db["users"].insert_many([{"_id": 1}, {"_id": 2}, {"_id": 3}], ordered=ordered)
+    assert error.value.details["nInserted"] == len(inserted) - 1
+    assert [e["index"] for e in error.value.details["writeErrors"]] == [1]
+    assert [user["_id"] for user in db["users"].find()] == inserted
+
+
+# mongomock's bulk_write does not support pymongo 4, so the remaining cases only run on SQLite
+def test_bulk_write_reports_partial_result(sqlite_db):
+    pairs = sqlite_db["pairs"]
+    pairs.create_index("user_id", unique=True)
+    pairs.insert_one({"_id": "a", "user_id": 1})
+    requests = [UpdateOne({"_id": "b"}, {"$set": {"user_id": 2}}, upsert=True),
+                UpdateOne({"_id": "c"}, {"$set": {"user_id": 1}}, upsert=True),
+                UpdateOne({"_id": "a"}, {"$set": {"user_id": 3}})]
+    with pytest.raises(BulkWriteError) as error:
+        pairs.bulk_write(requests, ordered=False)
+    details = error.value.details
+    assert [e["index"] for e in details["writeErrors"]] == [1]
+    assert details["writeErrors"][0]["code"] == 11000
+    assert (details["nUpserted"], details["nMatched"], details["nModified"]) == (1, 1, 1)
+    assert sorted(pair["user_id"] for pair in pairs.find()) == [2, 3]
+    assert not sqlite_db.conn.in_transaction
+
+
+def test_bulk_write_rolls_back_on_unexpected_error(sqlite_db, monkeypatch):
+    users = sqlite_db["users"]
+    users.create_index("name")
+    users.insert_one({"_id": 1, "name": "a"})
+    calls = []
+
+    def failing(document, update, inserting=False):
+        calls.append(document)
+        if len(calls) == 2:
+            raise RuntimeError("disk went away")
+        return original(document, update, inserting)
+
+    original = sqlite_store.apply_update
+    monkeypatch.setattr(sqlite_store, "apply_update", failing)
+    with pytest.raises(RuntimeError):
+        users.bulk_write([UpdateOne({"_id": 1}, {"$set": {"name": "b"}}),
+                          UpdateOne({"_id": 2}, {"$set": {"name": "c"}}, upsert=True)])
+    monkeypatch.undo()
+    assert list(users.find()) == [{"_id": 1, "name": "a"}]
+    # The name index forgot the rolled back write too
+    assert [user["_id"] for user in users.find({"name": "a"})] == [1]
+    assert list(users.find({"name": "b"})) == []
+
+
+def test_scan_reads_a_page_at_a_time(sqlite_db, monkeypatch):
+    monkeypatch.setattr(sqlite_store, "SCAN_PAGE", 10)
+    users = sqlite_db["users"]
+    users.insert_many([{"_id": i, "games": i % 3} for i in range(35)])
+    cursor = iter(users.find({"games": 0}))
+    assert next(cursor)["_id"] == 0
+    # Writes made while the cursor is open are not blocked by it
+    users.insert_one({"_id": 100, "games": 0})
+    assert [user["_id"] for user in cursor][-1] == 100
+    assert users.find_one({"games": 2})["_id"] == 2
+    assert [user["_id"] for user in users.find().skip(30).limit(3)] == [30, 31, 32]
@@ -0,0 +1,33 @@
+import mongomock
+from pymongo.errors import ServerSelectionTimeoutError
+from handlers.update_dedup import UpdateDedup
+
+
+class FailingCollection:
+    """ Stands in for a collection whose server cannot be reached """
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def insert_one(self, document):
+        raise ServerSelectionTimeoutError("unreachable")
+
+
+def test_redelivery_is_seen():
+    dedup = UpdateDedup(mongomock.MongoClient().db.updates)
+    assert not dedup.seen(1)
+    assert dedup.seen(1)
+
+
+def test_redelivery_to_another_process_is_seen():
+    db = mongomock.MongoClient().db.updates
+    assert not UpdateDedup(db).seen(1)
+    assert UpdateDedup(db).seen(1)
+
+
+def test_failed_claim_still_processes_update():
+    dedup = UpdateDedup(FailingCollection())
+    assert not dedup.seen(1)
+    assert dedup.stats()["claim_errors"] == 1
+    # The local LRU still catches a redelivery to this process
+    assert dedup.seen(1)
@@ -0,0 +1,36 @@
+import threading
+import time
+from types import SimpleNamespace
+from handlers.update_dispatcher import UpdateDispatcher
+
+
+def update(update_id: int) -> SimpleNamespace:
+    return SimpleNamespace(update_id=update_id, message=None, edited_message=None, callback_query=None)
+
+
+def test_stop_processes_queued_updates():
+    processed = []
+    dispatcher = UpdateDispatcher(lambda updates: processed.extend(u.update_id for u in updates), 2, 10)
+    for update_id in range(6):
+        assert dispatcher.submit(update(update_id))
+    dispatcher.stop(5)
+    assert sorted(processed) == list(range(6))
+
+
+def test_submit_after_stop_is_refused():
+    dispatcher = UpdateDispatcher(lambda updates: None, 1, 10)
+    dispatcher.stop(5)
+    assert not dispatcher.submit(update(1))
+    assert dispatcher.stats()["rejected"] == 1
+
+
+def test_stop_with_full_queue_keeps_deadline():
+    release = threading.Event()
+    dispatcher = UpdateDispatcher(lambda updates: release.wait(10), 1, 1)
+    dispatcher.submit(update(1))
+    time.sleep(0.1)  # The worker is now blocked on update 1
+    assert dispatcher.submit(update(2))
+    start = time.monotonic()
+    dispatcher.stop(0.3)
+    assert time.monotonic() - start < 1
+    release.set()
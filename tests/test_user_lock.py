@@ -0,0 +1,65 @@
+import threading
+import time
+import mongomock
+import pytest
+from classes.UserLock import UserLock
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db.user_data
+    db.insert_one({"_id": 1, "lock": False})
+    return db
+
+
+def test_lease_must_outlast_timeout(db):
+    with pytest.raises(ValueError):
+        UserLock(db, lease=1.0, timeout=2.0)
+
+
+def test_hold_takes_and_releases_lease(db):
+    locks = UserLock(db, lease=2.0, timeout=1.0)
+    with locks.hold(1):
+        assert locks.is_locked(1, db.find_one({"_id": 1}))
+    assert db.find_one({"_id": 1})["lock"] == False
+
+
+def test_missing_user_holds_local_lock_only(db):
+    locks = UserLock(db, lease=2.0, timeout=1.0)
+    with locks.hold(2):
+        pass
+    assert db.find_one({"_id": 2}) == None
+
+
+def test_legacy_lock_waits_one_lease(db):
+    db.update_one({"_id": 1}, {"$set": {"lock": True}})
+    locks = UserLock(db, lease=0.3, timeout=0.2)
+    assert locks.is_locked(1, db.find_one({"_id": 1}))
+    # The first waiter stamps an expiry and gives up before it
+    with pytest.raises(UserLock.Timeout):
+        with locks.hold(1):
+            pass
+    assert "lock_expires" in db.find_one({"_id": 1})
+    time.sleep(0.2)
+    with locks.hold(1):
+        pass
+
+
+def test_other_holder_excludes_until_release(db):
+    # Two managers stand for two dynos sharing the database
+    first, second = UserLock(db, lease=2.0, timeout=1.0), UserLock(db, lease=2.0, timeout=1.0)
+    entered, release = threading.Event(), threading.Event()
+
+    def hold():
+        with first.hold(1):
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait(5)
+    threading.Timer(0.2, release.set).start()
+    start = time.monotonic()
+    with second.hold(1):
+        assert time.monotonic() - start >= 0.15
+    thread.join()
@@ -0,0 +1,35 @@
+import io
+import mongomock
+from classes.WordleStats import WordleStats
+from classes.Leaderboard import Leaderboard
+from classes.ChatMembers import ChatMembers
+from utils.sqlite_store import SQLiteDatabase
+from utils.user_transfer import format_rows, import_stats
+
+
+def stats(db=None) -> WordleStats:
+    db = db or mongomock.MongoClient().db
+    return WordleStats(db["user_data"], Leaderboard(db["leaderboards"]), ChatMembers(db["chat_members"]))
+
+
+def test_export_expires_missed_streaks():
+    source = stats()
+    source.ingest_score(1, -1, 500, 3.0, "played")
+    source.ingest_score(1, -1, 501, 4.0, "played")
+    source.ingest_score(2, -1, 498, 4.0, "missed")
+    source.ingest_score(2, -1, 499, 5.0, "missed")
+    exported = "".join(format_rows(source.export_users(501), "csv")).splitlines()
+    assert exported[1:] == ["1,played,2,3.5,2,501", "2,missed,2,4.5,0,499"]
+
+
+def test_reimporting_export_is_a_no_op():
+    source = stats()
+    source.ingest_score(1, -1, 500, 3.0, "a")
+    source.ingest_score(2, -1, 501, 7.0, "b")
+    export = "".join(format_rows(source.export_users(501), "ndjson"))
+    # Imports are bulk writes, which mongomock does not support with pymongo 4
+    target = stats(SQLiteDatabase(":memory:"))
+    first = import_stats(target, io.StringIO(export), "ndjson")
+    again = import_stats(target, io.StringIO(export), "ndjson")
+    assert first.created == 2 and again.modified == 0
+    assert "".join(format_rows(target.export_users(501), "ndjson")) == export
@@ -0,0 +1,81 @@
+from typing import Iterator
+
+# Each game is stored as 3 characters of this alphabet (18 bits): edition << 3 | tries
+HISTORY_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+HISTORY_INDEX = {char: value for value, char in enumerate(HISTORY_ALPHABET)}
+ENTRY_SIZE = 3
+MAX_EDITION = (1 << 15) - 1
+# dist counts games by tries (index 7 is X), recent keeps the tries of the last RECENT_GAMES games
+DIST_SIZE = 8
+RECENT_GAMES = 30
+
+
+def encode_game(edition: int, tries: float) -> str:
+    """ Pack a game into a history entry, or an empty string if the edition cannot be stored """
+    if not 0 <= edition <= MAX_EDITION:
+        return ""
+    value = edition << 3 | int(tries)
+    return (HISTORY_ALPHABET[value >> 12]
+            + HISTORY_ALPHABET[value >> 6 & 63]
+            + HISTORY_ALPHABET[value & 63])
+
+
+def decode_history(history: str) -> Iterator[tuple[int, int]]:
+    """ Yield (edition, tries) for every game in a packed history, in the order they were shared """
+    for i in range(0, len(history) - ENTRY_SIZE + 1, ENTRY_SIZE):
+        value = (HISTORY_INDEX[history[i]] << 12
+                 | HISTORY_INDEX[history[i + 1]] << 6
+                 | HISTORY_INDEX[history[i + 2]])
+        yield (value >> 3, value & 7)
+
+
+def rebuild_stats(history: str) -> dict:
+    """ Recompute num_games, score_avg, streak, last_game, dist and recent from a packed history in one pass """
+    num_games, total, last_game = 0, 0, -1
+    editions = set()
+    dist, recent = [0] * DIST_SIZE, []
+    for edition, tries in decode_history(history):
+        num_games += 1
+        total += tries
+        last_game = max(last_game, edition)
+        editions.add(edition)
+        dist[tries] += 1
+        recent.append(float(tries))
+
+    streak = 0
+    while last_game - streak in editions:
+        streak += 1
+    return {
+        "num_games": num_games,
+        "score_avg": total / num_games if num_games else 0.0,
+        "streak": streak,
+        "last_game": last_game,
+        "dist": dist,
+        "recent": recent[-RECENT_GAMES:],
+    }
+
+
+def distribution_stats(dist: list[int], recent: list[float]) -> dict:
+    """ Median, standard deviation and rolling averages from the incrementally kept dist and recent arrays """
+    # Only /stats needs numpy, so it is imported here rather than on bot startup
+    import numpy as np
+
+    # Games score 1 to 6 tries or X (7), dist[0] is never counted
+    counts = np.asarray(dist[1:], dtype=np.int64)
+    tries = np.arange(1, DIST_SIZE)
+    num_games = counts.sum()
+    if num_games == 0:
+        return {"median": 0.0, "std": 0.0, "avg_7": 0.0, "avg_30": 0.0}
+
+    mean = np.dot(tries, counts) / num_games
+    # Median of the expanded tries array, located with the running counts instead of expanding it
+    running = np.cumsum(counts)
+    lower = np.searchsorted(running, (num_games - 1) // 2, side='right')
+    upper = np.searchsorted(running, num_games // 2, side='right')
+    recent = np.asarray(recent, dtype=np.float64)
+    return {
+        "median": float(tries[lower] + tries[upper]) / 2,
+        "std": float(np.sqrt(np.dot(counts, (tries - mean) ** 2) / num_games)),
+        "avg_7": float(recent[-7:].mean()) if recent.size else 0.0,
+        "avg_30": float(recent.mean()) if recent.size else 0.0,
+    }
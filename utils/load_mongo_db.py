@@ -1,15 +1,78 @@
-from decouple import config
+import threading
+import time
+from importlib.util import find_spec
+from decouple import config, Csv
 
 DB_URL = config('MONGODB_CONNECTION')
-def get_database():
+DB_NAME = config('MONGODB_DATABASE', default='global_data')
+MONGO_MAX_POOL_SIZE = config('MONGO_MAX_POOL_SIZE', default=20, cast=int)
+MONGO_MIN_POOL_SIZE = config('MONGO_MIN_POOL_SIZE', default=0, cast=int)
+MONGO_SERVER_SELECTION_MS = config('MONGO_SERVER_SELECTION_MS', default=5000, cast=int)
+MONGO_CONNECT_TIMEOUT_MS = config('MONGO_CONNECT_TIMEOUT_MS', default=5000, cast=int)
+MONGO_SOCKET_TIMEOUT_MS = config('MONGO_SOCKET_TIMEOUT_MS', default=10000, cast=int)
+# In order of preference, compressors whose package is not installed are skipped
+MONGO_COMPRESSORS = config('MONGO_COMPRESSORS', default='zstd,snappy,zlib', cast=Csv())
+MONGO_RETRY_WRITES = config('MONGO_RETRY_WRITES', default=True, cast=bool)
+# Write concern, e.g. majority or 1, empty for the server's default
+MONGO_W = config('MONGO_W', default='')
+MONGO_HEALTH_TIMEOUT = config('MONGO_HEALTH_TIMEOUT', default=2.0, cast=float)
+
+# Package each compressor needs besides pymongo
+COMPRESSOR_PACKAGES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+_client = None
+_client_guard = threading.Lock()
+
+
+def available_compressors(compressors: list[str]) -> list[str]:
+    return [name for name in compressors
+            if name in COMPRESSOR_PACKAGES
+            and (COMPRESSOR_PACKAGES[name] == None or find_spec(COMPRESSOR_PACKAGES[name]) != None)]
+
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "retryWrites": MONGO_RETRY_WRITES,
+        # Nothing is sent until the first operation, so the dyno binds its port even if MongoDB is unreachable
+        "connect": False,
+    }
+    compressors = available_compressors(MONGO_COMPRESSORS)
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    if MONGO_W != '':
+        options["w"] = int(MONGO_W) if MONGO_W.isdigit() else MONGO_W
+    return options
+
+
+def get_client():
+    """ MongoClient shared by the process, created on first use """
+    global _client
     from pymongo import MongoClient
 
-    # Provide the mongodb atlas url to connect python to mongodb using pymongo
-    CONNECTION_STRING = DB_URL
+    with _client_guard:
+        if _client == None:
+            _client = MongoClient(DB_URL, **client_options())
+        return _client
+
+
+def get_database():
+    return get_client()[DB_NAME]
+
 
-    # Create a connection using MongoClient. You can import MongoClient or use pymongo.MongoClient
-    client = MongoClient(CONNECTION_STRING)
+def ping(timeout: float = MONGO_HEALTH_TIMEOUT) -> float | None:
+    """ Round trip time of a ping in seconds, or None if MongoDB cannot be reached within timeout """
+    import pymongo
+    from pymongo.errors import PyMongoError
 
-    # Create the database for our example (we will use the same database throughout the tutorial)
-    return client['global_data']
-    
\ No newline at end of file
+    start = time.perf_counter()
+    try:
+        with pymongo.timeout(timeout):
+            get_client().admin.command("ping")
+    except PyMongoError:
+        return None
+    return time.perf_counter() - start
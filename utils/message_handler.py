@@ -1,19 +1,56 @@
 import re
+from functools import lru_cache
 
-def extract_score(message: str) -> tuple[int, float]:
-    """ Use regex to extract Wordle edition and tries """
-    m = re.match(
-         r"Wordle\s(?P<edition>\d+)\s(?P<tries>[0-6X])/6\n{2}(?:(?:[🟨🟩⬛️⬜️]+)(?:\r?\n)){1,6}", message)
+SCORE_PREFIX = "Wordle"
+# Telegram strips the trailing newline, so the last row ends the message
+SCORE_PATTERN = re.compile(
+    r"Wordle\s(?P<edition>\d+)\s(?P<tries>[0-6X])/6\n{2}(?P<grid>(?:(?:[🟨🟩⬛️⬜️]+)(?:\r?\n|$)){1,6})")
+COMMAND_PATTERN = re.compile(r'\/(.*?)@*\w*')
+# 2 bits per tile, variation selectors are skipped
+TILE_CODES = {"⬛": 0, "⬜": 0, "🟨": 1, "🟩": 2}
+GRID_WIDTH = 5
+
+
+def decode_grid(rows: str) -> int:
+    """ Pack an emoji grid into an int, 2 bits per tile from the first tile of the first row up """
+    grid = 0
+    for row_index, row in enumerate(rows.split()):
+        tiles = [TILE_CODES[tile] for tile in row if tile in TILE_CODES]
+        for col, code in enumerate(tiles[:GRID_WIDTH]):
+            grid |= code << 2 * (row_index * GRID_WIDTH + col)
+    return grid
+
+
+@lru_cache(maxsize=256)
+def match_score(message: str) -> tuple[int, float, int] | None:
+    """ Run the Wordle Score share regex, cached so the handler filter and add_score share one match """
+    m = SCORE_PATTERN.match(message)
+    if m == None:
+        return None
     edition = int(m.group('edition'))
     tries = m.group('tries')
     if tries == "X":
         tries = 7.0
     else:
         tries = float(tries)
-        
-    return (edition, tries)
+
+    return (edition, tries, decode_grid(m.group('grid')))
+
+
+def extract_score(message: str) -> tuple[int, float, int] | None:
+    """ Use regex to extract Wordle edition, tries and packed grid, or None if message is not a Wordle Score share """
+    # Cheap check first, nearly all chat messages are not shares
+    if not message.startswith(SCORE_PREFIX):
+        return None
+    return match_score(message)
+
+
+def is_score(message: str) -> bool:
+    """ Handler filter matching Wordle Score shares """
+    return extract_score(message) != None
+
 
 def extract_command(command:str):
     """ Use regex to extract command """
-    cmd = re.search('\/(.*?)@*\w*', command)
-    return cmd.group(0)[1:]
\ No newline at end of file
+    cmd = COMMAND_PATTERN.search(command)
+    return cmd.group(0)[1:]
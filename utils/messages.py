@@ -1,3 +1,6 @@
+import heapq
+from operator import itemgetter
+
 START_TEXT = ("Welcome to the Wordle Leaderboard Bot! This bot was made to automatically keep track of your "
               "running score average for Wordle to compare between family and friends.\n"
               "\n"
@@ -15,6 +18,8 @@ HELP_TEXT = ("I keep track of your Wordle stats by automatically calculating you
              "*Show and compare*\n"
              "/stats \- show your aggregated stats\n"
              "/leaderboard \- show a chat leaderboard sorted by lowest average\n"
+             "/globalrank \- show your rank among all players\n"
+             "/globaltop \- show the best players across all chats\n"
              "\n"
              "*Change your data*\n"
              "/clear \- clear your user data\n"
@@ -31,6 +36,7 @@ HELP_TEXT = ("I keep track of your Wordle stats by automatically calculating you
              "*Settings*\n"
              "/toggleretroactive \- control whether sharing older Wordle results can update your stats \(toggled OFF by default\)\n"
              "/togglewarning \- control whether sharing older Wordle results with /toggleretroactive off will give you a warning \(toggled ON by default\)\n"
+             "/dailysummary \- control whether the chat gets each day's results once the next Wordle is out \(toggled OFF by default\)\n"
              "\n"
              "Created with love by @yyenching")
 
@@ -38,6 +44,10 @@ NO_DATA_MSG = "No data recorded yet! Share your Wordle results to add yourself t
 
 INVALID_AVG = "Wordle score average cannot be above a value of 7.0!"
 
+RANKS_NOT_READY = "Global ranks are still being computed, try again in a minute!"
+
+SUMMARY_UNAVAILABLE = "Daily summaries are not enabled on this bot."
+
 def user_stats(username: str, num_games: int, streak: int, score_avg: float) -> str:
     return (
         f"`Name: {username}\n"
@@ -47,6 +57,79 @@ def user_stats(username: str, num_games: int, streak: int, score_avg: float) ->
     ).replace(".", "\.")
 
 
+def user_distribution(dist: list[int], median: float, std: float, avg_7: float, avg_30: float, num_games: int | None = None) -> str:
+    """ Distribution of the tracked games, noted as partial when num_games counts games it does not cover """
+    tracked = sum(dist)
+    scope = f"Distribution of the {tracked} games since tracking began:\n\n" if num_games not in (None, tracked) else ""
+    most = max(max(dist[1:]), 1)
+    bars = "\n".join(
+        f"{label} {'█' * round(10 * count / most)} {count}"
+        for label, count in zip(["1", "2", "3", "4", "5", "6", "X"], dist[1:])
+    )
+    return (
+        f"{scope}"
+        f"`Median: {median:g}\n"
+        f"Std. Dev: {std:.3f}\n"
+        f"Last 7 Avg: {avg_7:.3f}\n"
+        f"Last 30 Avg: {avg_30:.3f}\n"
+        "\n"
+        f"{bars}`"
+    ).replace(".", "\\.")
+
+
+LEADERBOARD_HEADERS = ["", "Name", "Gms", "🔥", "Avg."]
+LEADERBOARD_LEFT_ALIGNED = [False, True, False, False, True]
+
+
+def rank_rows(chat_data: list[dict], limit: int = 0) -> list[dict]:
+    """ Rows sorted by lowest average, optionally keeping only the top limit rows """
+    key = itemgetter('score_avg')
+    return heapq.nsmallest(limit, chat_data, key=key) if limit else sorted(chat_data, key=key)
+
+
+def leaderboard_text(chat_data: list[dict], limit: int = 0) -> str:
+    """ Monospace leaderboard sorted by lowest average, optionally keeping only the top limit rows """
+    ranked = rank_rows(chat_data, limit)
+    columns = [
+        [str(rank) for rank in range(1, len(ranked) + 1)],
+        [str(user['username']).strip() for user in ranked],
+        [str(user['num_games']) for user in ranked],
+        [str(user['streak']) for user in ranked],
+        [("%.3f" % user['score_avg']).replace(".", "\\.") for user in ranked],
+    ]
+
+    # Same layout as tabulate's "simple" table: headers padded by at least two, columns separated by two spaces
+    widths = [max(len(header) + 2, max(map(len, column)))
+              for header, column in zip(LEADERBOARD_HEADERS, columns)]
+    row_format = "  ".join(f"%{'-' if left else ''}{width}s"
+                           for width, left in zip(widths, LEADERBOARD_LEFT_ALIGNED))
+
+    lines = [(row_format % tuple(LEADERBOARD_HEADERS)).rstrip(),
+             "  ".join("-" * width for width in widths)]
+    lines += [(row_format % row).rstrip() for row in zip(*columns)]
+    return "`" + "\n".join(lines) + "`"
+
+
+def global_rank_text(rank: int, total: int, worse: float, min_games: int) -> str:
+    return (f"You are #{rank} of {total} players with at least {min_games} games, "
+            f"ahead of {worse:.1%} of them!")
+
+
+def unranked_text(num_games: int, min_games: int) -> str:
+    return f"You need at least {min_games} games to be ranked globally, you have played {num_games}."
+
+
+def daily_summary_text(edition: int, players: list[tuple[str, float, int]]) -> str:
+    """ Results of an edition in a chat, players as (username, tries, streak) best first """
+    lines = [f"Today's results for Wordle {edition}:", ""]
+    for username, tries, streak in players:
+        score = "X" if tries >= 7 else f"{tries:g}"
+        lines.append(f"{str(username).strip()} {score}/6" + (f" 🔥{streak}" if streak > 1 else ""))
+    on_streak = sum(streak > 1 for _, _, streak in players)
+    lines += ["", f"{len(players)} played, {on_streak} on a streak"]
+    return "\n".join(lines)
+
+
 def added_text(username: str, init_score: float) -> str:
     return (
         f"New Wordle champion *{username}* added to the leaderboard with the stats:"
@@ -55,3 +138,17 @@ def added_text(username: str, init_score: float) -> str:
         "\n\n"
         "To manually update any of these values, use /name, /games, /streak, and /average\."
     )
+
+
+def added_batch_text(champions: list[tuple[str, float]]) -> str:
+    """ One confirmation for every (username, init_score) added to a chat's leaderboard in a burst """
+    if len(champions) == 1:
+        return added_text(*champions[0])
+    names = ", ".join(f"*{username}*" for username, _ in champions)
+    return (
+        f"New Wordle champions {names} added to the leaderboard with the stats:"
+        "\n\n"
+        + "\n\n".join(user_stats(username, 1, 1, init_score) for username, init_score in champions) +
+        "\n\n"
+        "To manually update any of these values, use /name, /games, /streak, and /average\."
+    )
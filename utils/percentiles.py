@@ -0,0 +1,3 @@
+def percentile(samples: list[float], p: float) -> float:
+    """ p-th quantile (0 to 1) of samples sorted in ascending order, 0.0 if there are none """
+    return samples[min(int(p * len(samples)), len(samples) - 1)] if samples else 0.0
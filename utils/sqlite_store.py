@@ -0,0 +1,957 @@
+""" Embedded storage engine for tests and small deployments
+
+SQLiteDatabase and SQLiteCollection implement the part of pymongo's Database and
+Collection interface the bot uses, query operators, update operators,
+aggregation pipeline updates and $group aggregations included, on top of a
+SQLite file in WAL mode. Documents are stored as JSON by _id. Writes are
+committed in batches of SQLITE_COMMIT_EVERY writes or every
+SQLITE_COMMIT_SECONDS, whichever comes first, and on exit; bulk_write and
+insert_many are each one transaction of their own. Reads go through the table a
+page of SCAN_PAGE documents at a time, so a cursor that is not sorted holds one
+page in memory however large the collection.
+
+Secondary indexes are kept in memory, so a database file must only be written
+by one process at a time. Unique indexes are enforced, with DuplicateKeyError.
+"""
+import atexit
+import itertools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+from decouple import config
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+SQLITE_PATH = config('SQLITE_PATH', default='wordle.db')
+SQLITE_COMMIT_EVERY = config('SQLITE_COMMIT_EVERY', default=100, cast=int)
+SQLITE_COMMIT_SECONDS = config('SQLITE_COMMIT_SECONDS', default=0.05, cast=float)
+TTL_SWEEP_SECONDS = 60
+# Documents read at a time by a collection scan
+SCAN_PAGE = 500
+
+UpdateResult = namedtuple('UpdateResult', ['matched_count', 'modified_count', 'upserted_id'])
+DeleteResult = namedtuple('DeleteResult', ['deleted_count'])
+InsertOneResult = namedtuple('InsertOneResult', ['inserted_id'])
+InsertManyResult = namedtuple('InsertManyResult', ['inserted_ids'])
+BulkWriteResult = namedtuple('BulkWriteResult', ['matched_count', 'modified_count', 'upserted_count'])
+
+
+class _Missing:
+    """ Value of a field a document does not have, distinct from null """
+
+    def __repr__(self) -> str:
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+# ----------------------------------------------------------------------VALUES
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+def dumps(document) -> str:
+    return json.dumps(document, default=_encode, separators=(',', ':'))
+
+
+def loads(text: str):
+    return json.loads(text, object_hook=_decode)
+
+
+def canon(value) -> tuple:
+    """ Key comparing values in MongoDB's order across types: null < numbers < strings < objects < arrays < booleans < dates """
+    kind = type(value)
+    if kind is int or kind is float:
+        return (2, value)
+    if kind is str:
+        return (3, value)
+    if value is None or value is MISSING:
+        return (0,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, tuple((key, canon(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(canon(item) for item in value))
+    if isinstance(value, datetime):
+        return (9, value.timestamp())
+    return (10, str(value))
+
+
+def equal(a, b) -> bool:
+    if type(a) is type(b) and type(a) in (int, str, float):
+        return a == b
+    return canon(a) == canon(b)
+
+
+def get_path(document, path: str):
+    for key in path.split("."):
+        if isinstance(document, dict) and key in document:
+            document = document[key]
+        else:
+            return MISSING
+    return document
+
+
+def set_path(document: dict, path: str, value) -> None:
+    *parents, last = path.split(".")
+    for key in parents:
+        document = document.setdefault(key, {})
+    if value is MISSING:
+        document.pop(last, None)
+    else:
+        document[last] = value
+
+
+def unset_path(document: dict, path: str) -> None:
+    *parents, last = path.split(".")
+    for key in parents:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+# ----------------------------------------------------------------------QUERIES
+def _is_operator_dict(condition) -> bool:
+    return isinstance(condition, dict) and len(condition) > 0 and all(key.startswith("$") for key in condition)
+
+
+def _values_of(value, operand) -> list:
+    """ A field matches a condition if it or, for arrays, one of its elements does """
+    if isinstance(value, list):
+        return value + [value] if isinstance(operand, list) else value
+    return [value]
+
+
+def _compare(value, operand, test) -> bool:
+    # Comparisons only match values of the operand's type, as in MongoDB
+    key = canon(operand)
+    return any(canon(item)[0] == key[0] and test(canon(item), key)
+               for item in _values_of(value, operand) if item is not MISSING)
+
+
+def _matches_condition(value, condition) -> bool:
+    if not _is_operator_dict(condition):
+        return any(equal(item, condition) for item in _values_of(value, condition))
+    for op, operand in condition.items():
+        if op == "$eq":
+            ok = _matches_condition(value, operand)
+        elif op == "$ne":
+            ok = not _matches_condition(value, operand)
+        elif op == "$gt":
+            ok = _compare(value, operand, lambda a, b: a > b)
+        elif op == "$gte":
+            ok = _compare(value, operand, lambda a, b: a >= b)
+        elif op == "$lt":
+            ok = _compare(value, operand, lambda a, b: a < b)
+        elif op == "$lte":
+            ok = _compare(value, operand, lambda a, b: a <= b)
+        elif op == "$in":
+            ok = any(_matches_condition(value, item) for item in operand)
+        elif op == "$nin":
+            ok = not any(_matches_condition(value, item) for item in operand)
+        elif op == "$exists":
+            ok = (value is not MISSING) == bool(operand)
+        elif op == "$not":
+            ok = not _matches_condition(value, operand)
+        elif op == "$size":
+            ok = isinstance(value, list) and len(value) == operand
+        else:
+            raise NotImplementedError(f"Query operator {op} is not supported")
+        if not ok:
+            return False
+    return True
+
+
+def matches(document: dict, filter: dict) -> bool:
+    for key, condition in filter.items():
+        if key == "$or":
+            ok = any(matches(document, branch) for branch in condition)
+        elif key == "$and":
+            ok = all(matches(document, branch) for branch in condition)
+        elif key == "$nor":
+            ok = not any(matches(document, branch) for branch in condition)
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key} is not supported")
+        else:
+            ok = _matches_condition(get_path(document, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def project(document: dict, projection: dict | None) -> dict:
+    if not projection:
+        return document
+    include_id = projection.get("_id", 1)
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    if (fields and all(fields.values())) or (not fields and include_id):
+        result = {}
+        if include_id and "_id" in document:
+            result["_id"] = document["_id"]
+        for path in fields:
+            value = get_path(document, path)
+            if value is not MISSING:
+                set_path(result, path, value)
+        return result
+    result = dict(document)
+    for path, keep in projection.items():
+        if not keep:
+            unset_path(result, path)
+    return result
+
+
+# ----------------------------------------------------------------------EXPRESSIONS
+def _truthy(value) -> bool:
+    return not (value is None or value is MISSING or value is False or (not isinstance(value, bool) and value == 0))
+
+
+def _null(value) -> bool:
+    return value is None or value is MISSING
+
+
+def evaluate(expr, document: dict, variables: dict = None):
+    """ Value of an aggregation expression for document """
+    if isinstance(expr, str):
+        if expr.startswith("$$"):
+            name, _, path = expr[2:].partition(".")
+            value = (variables or {}).get(name, MISSING)
+            return get_path(value, path) if path else value
+        if expr.startswith("$"):
+            return get_path(document, expr[1:])
+        return expr
+    if isinstance(expr, list):
+        return [evaluate(item, document, variables) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith("$"):
+        return {key: evaluate(value, document, variables) for key, value in expr.items()}
+
+    op, arg = next(iter(expr.items()))
+    if op == "$literal":
+        return arg
+    if op == "$cond":
+        if isinstance(arg, dict):
+            arg = [arg["if"], arg["then"], arg["else"]]
+        branch = arg[1] if _truthy(evaluate(arg[0], document, variables)) else arg[2]
+        return evaluate(branch, document, variables)
+    if op == "$ifNull":
+        for item in arg:
+            value = evaluate(item, document, variables)
+            if not _null(value):
+                return value
+        return value
+    if op == "$map":
+        items = evaluate(arg["input"], document, variables)
+        if _null(items):
+            return None
+        name = arg.get("as", "this")
+        return [evaluate(arg["in"], document, (variables or {}) | {name: item}) for item in items]
+    if op == "$and":
+        return all(_truthy(evaluate(item, document, variables)) for item in arg)
+    if op == "$or":
+        return any(_truthy(evaluate(item, document, variables)) for item in arg)
+
+    args = evaluate(arg if isinstance(arg, list) else [arg], document, variables)
+    if op == "$not":
+        return not _truthy(args[0])
+    if op in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        a, b = canon(args[0]), canon(args[1])
+        return {"$eq": a == b, "$ne": a != b, "$gt": a > b, "$gte": a >= b, "$lt": a < b, "$lte": a <= b}[op]
+    if op in ("$max", "$min"):
+        values = args[0] if len(args) == 1 and isinstance(args[0], list) else args
+        values = [value for value in values if not _null(value)]
+        if not values:
+            return None
+        return (max if op == "$max" else min)(values, key=canon)
+    if op in ("$add", "$multiply", "$subtract", "$divide", "$concat", "$concatArrays"):
+        if any(_null(value) for value in args):
+            return None
+        if op == "$add":
+            return sum(args)
+        if op == "$multiply":
+            result = 1
+            for value in args:
+                result *= value
+            return result
+        if op == "$subtract":
+            return args[0] - args[1]
+        if op == "$divide":
+            return args[0] / args[1]
+        if op == "$concat":
+            return "".join(args)
+        return [item for value in args for item in value]
+    if op == "$in":
+        return any(equal(args[0], item) for item in args[1])
+    if op == "$arrayElemAt":
+        items, index = args
+        if _null(items):
+            return None
+        return items[index] if -len(items) <= index < len(items) else MISSING
+    if op == "$slice":
+        items = args[0]
+        if _null(items):
+            return None
+        if len(args) == 2:
+            n = args[1]
+            return items[n:] if n < 0 else items[:n]
+        return items[args[1]:args[1] + args[2]]
+    if op == "$size":
+        return len(args[0])
+    raise NotImplementedError(f"Expression operator {op} is not supported")
+
+
+# ----------------------------------------------------------------------UPDATES
+def _run_pipeline(document: dict, pipeline: list[dict]) -> dict:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name in ("$set", "$addFields"):
+            # Every expression of a stage sees the stage's input document
+            result = dict(document)
+            for path, expr in spec.items():
+                set_path(result, path, evaluate(expr, document))
+            document = result
+        elif name == "$unset":
+            document = dict(document)
+            for path in [spec] if isinstance(spec, str) else spec:
+                unset_path(document, path)
+        elif name == "$project":
+            document = project(document, spec)
+        elif name in ("$replaceRoot", "$replaceWith"):
+            document = evaluate(spec["newRoot"] if name == "$replaceRoot" else spec, document)
+        else:
+            raise NotImplementedError(f"Pipeline stage {name} is not supported")
+    return document
+
+
+# ----------------------------------------------------------------------AGGREGATION
+def _accumulate(group: dict, field: str, op: str, value) -> None:
+    if op == "$sum":
+        number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        group[field] = group.get(field, 0) + (value if number else 0)
+    elif op == "$first":
+        group.setdefault(field, None if value is MISSING else value)
+    elif op == "$last":
+        group[field] = None if value is MISSING else value
+    elif op in ("$push", "$addToSet"):
+        items = group.setdefault(field, [])
+        if value is not MISSING and (op == "$push" or not any(equal(value, item) for item in items)):
+            items.append(value)
+    elif op in ("$max", "$min"):
+        current = group.get(field)
+        if not _null(value) and (_null(current) or (canon(value) > canon(current) if op == "$max"
+                                                     else canon(value) < canon(current))):
+            group[field] = value
+        group.setdefault(field, None)
+    else:
+        raise NotImplementedError(f"Accumulator {op} is not supported")
+
+
+def _group(documents: list[dict], spec: dict) -> list[dict]:
+    groups = {}  # canon(_id) -> group, in order of first appearance
+    for document in documents:
+        key = evaluate(spec["_id"], document)
+        key = None if key is MISSING else key
+        group = groups.get(canon(key))
+        if group == None:
+            group = groups[canon(key)] = {"_id": key}
+        for field, accumulator in spec.items():
+            if field != "_id":
+                (op, expr), = accumulator.items()
+                _accumulate(group, field, op, evaluate(expr, document))
+    return list(groups.values())
+
+
+def run_aggregation(documents: list[dict], pipeline: list[dict]) -> list[dict]:
+    """ Documents out of a pipeline of $match, $sort, $group, $limit and the pipeline update stages """
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$sort":
+            for path, order in reversed(list(spec.items())):
+                documents.sort(key=lambda document: canon(get_path(document, path)), reverse=order < 0)
+        elif name == "$limit":
+            documents = documents[:spec]
+        elif name == "$group":
+            documents = _group(documents, spec)
+        else:
+            documents = [_run_pipeline(document, [stage]) for document in documents]
+    return documents
+
+
+def _pull_matches(item, condition) -> bool:
+    # A plain document condition is a query on array elements that are documents
+    if isinstance(condition, dict) and not _is_operator_dict(condition):
+        return isinstance(item, dict) and matches(item, condition)
+    return _matches_condition(item, condition)
+
+
+def _apply_operators(document: dict, update: dict, inserting: bool) -> dict:
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            current = get_path(document, path)
+            if op in ("$set", "$setOnInsert"):
+                set_path(document, path, json_copy(value))
+            elif op == "$unset":
+                unset_path(document, path)
+            elif op == "$inc":
+                set_path(document, path, (0 if current is MISSING else current) + value)
+            elif op in ("$max", "$min"):
+                if current is MISSING or (canon(value) > canon(current) if op == "$max" else canon(value) < canon(current)):
+                    set_path(document, path, value)
+            elif op in ("$addToSet", "$push"):
+                items = [] if current is MISSING else list(current)
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in values:
+                    if op == "$push" or not any(equal(item, existing) for existing in items):
+                        items.append(json_copy(item))
+                set_path(document, path, items)
+            elif op == "$pull":
+                if isinstance(current, list):
+                    set_path(document, path, [item for item in current if not _pull_matches(item, value)])
+            else:
+                raise NotImplementedError(f"Update operator {op} is not supported")
+    return document
+
+
+def apply_update(document: dict, update, inserting: bool = False) -> dict:
+    """ Apply an operator document, a pipeline or a replacement to document, which may be modified """
+    if isinstance(update, list):
+        return _run_pipeline(document, update)
+    if update and all(key.startswith("$") for key in update):
+        return _apply_operators(document, update, inserting)
+    return {"_id": document["_id"]} | json_copy(update) if "_id" in document else json_copy(update)
+
+
+def json_copy(value):
+    if isinstance(value, dict):
+        return {key: json_copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_copy(item) for item in value]
+    return value
+
+
+def upsert_base(filter: dict) -> dict:
+    """ Document an upsert starts from: the filter's equality conditions """
+    document = {}
+    for key, condition in filter.items():
+        if key.startswith("$"):
+            continue
+        if _is_operator_dict(condition):
+            if "$eq" in condition:
+                set_path(document, key, condition["$eq"])
+        else:
+            set_path(document, key, json_copy(condition))
+    return document
+
+
+# ----------------------------------------------------------------------STORE
+def _index_keys(keys) -> list[tuple[str, int]]:
+    if isinstance(keys, str):
+        return [(keys, 1)]
+    return [(key, direction) for key, direction in keys]
+
+
+def _bulk_details(errors: list[dict], inserted: int = 0, matched: int = 0, modified: int = 0,
+                  upserted: list[dict] = ()) -> dict:
+    """ BulkWriteError details, in the shape pymongo gives them """
+    return {"writeErrors": errors, "writeConcernErrors": [], "nInserted": inserted, "nUpserted": len(upserted),
+            "nMatched": matched, "nModified": modified, "nRemoved": 0, "upserted": list(upserted)}
+
+
+def _write_error(index: int, error: OperationFailure, op) -> dict:
+    return {"index": index, "code": 11000 if isinstance(error, DuplicateKeyError) else error.code or 2,
+            "errmsg": str(error), "op": op}
+
+
+class SQLiteCursor:
+    """ Result of find, supporting the cursor methods the bot uses, read as it is iterated unless sorted """
+
+    def __init__(self, documents: Iterable[dict]) -> None:
+        self._documents = documents
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1) -> "SQLiteCursor":
+        keys = [(key, direction)] if isinstance(key, str) else key
+        # Sorted in memory, as MongoDB sorts without an index
+        documents = list(self._documents)
+        for path, order in reversed(keys):
+            documents.sort(key=lambda document: canon(get_path(document, path)), reverse=order < 0)
+        self._documents = documents
+        return self
+
+    def skip(self, count: int) -> "SQLiteCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "SQLiteCursor":
+        self._limit = count
+        return self
+
+    def __iter__(self) -> Iterator[dict]:
+        return itertools.islice(self._documents, self._skip, self._skip + self._limit if self._limit else None)
+
+
+class SQLiteCollection:
+    """
+    Class storing a collection's documents in a SQLite table.
+
+    Attributes
+    ----------
+    name: str
+        Collection name
+    """
+
+    def __init__(self, database: "SQLiteDatabase", name: str) -> None:
+        self.database = database
+        self.name = name
+        self._table = '"c_' + name.replace('"', '""') + '"'
+        self._indexes = {}  # index name -> (keys, options)
+        self._lookup = {}  # leading index field -> canon(value) -> set of row ids
+        with database.lock:
+            database.conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+            for index_name, keys, options in database.conn.execute(
+                    "SELECT name, keys, options FROM indexes WHERE collection = ?", (name,)).fetchall():
+                self._indexes[index_name] = (loads(keys), loads(options))
+            self._rebuild_lookup()
+
+    # --------------------------------------------------INDEXES
+    def _indexed_fields(self) -> set[str]:
+        return {keys[0][0] for keys, _ in self._indexes.values()} - {"_id"}
+
+    def _rebuild_lookup(self) -> None:
+        self._lookup = {field: {} for field in self._indexed_fields()}
+        if self._lookup:
+            for row_id, text in self.database.conn.execute(f"SELECT id, doc FROM {self._table}"):
+                self._reindex(row_id, None, loads(text))
+
+    def _index_entries(self, document: dict | None) -> set[tuple[str, tuple]]:
+        """ (field, value) lookup entries of a document, one per element for arrays """
+        entries = set()
+        if document != None:
+            for field in self._lookup:
+                value = get_path(document, field)
+                for item in value if isinstance(value, list) else [value]:
+                    entries.add((field, canon(item)))
+        return entries
+
+    def _reindex(self, row_id: str, old: dict | None, new: dict | None) -> None:
+        if not self._lookup:
+            return
+        old_entries, new_entries = self._index_entries(old), self._index_entries(new)
+        for field, key in old_entries - new_entries:
+            ids = self._lookup[field].get(key)
+            if ids != None:
+                ids.discard(row_id)
+                if not ids:
+                    del self._lookup[field][key]
+        for field, key in new_entries - old_entries:
+            self._lookup[field].setdefault(key, set()).add(row_id)
+
+    def create_index(self, keys, **kwargs) -> str:
+        keys = _index_keys(keys)
+        name = kwargs.pop("name", None) or "_".join(f"{key}_{direction}" for key, direction in keys)
+        with self.database.lock:
+            if name not in self._indexes:
+                self._indexes[name] = (keys, kwargs)
+                self.database.write("INSERT OR REPLACE INTO indexes (collection, name, keys, options) VALUES (?, ?, ?, ?)",
+                                    (self.name, name, dumps(keys), dumps(kwargs)))
+                self._rebuild_lookup()
+        return name
+
+    def drop_index(self, name: str) -> None:
+        with self.database.lock:
+            if name not in self._indexes:
+                raise OperationFailure(f"index not found with name [{name}]")
+            del self._indexes[name]
+            self.database.write("DELETE FROM indexes WHERE collection = ? AND name = ?", (self.name, name))
+            self._rebuild_lookup()
+
+    def _check_unique(self, row_id: str, document: dict) -> None:
+        """ Raise DuplicateKeyError if another document has document's keys of a unique index """
+        for name, (keys, options) in self._indexes.items():
+            if not options.get("unique") or keys[0][0] == "_id":
+                continue
+            values = [canon(get_path(document, key)) for key, _ in keys]
+            for other_id in self._lookup[keys[0][0]].get(values[0], ()):
+                if other_id == row_id:
+                    continue
+                text, = self.database.conn.execute(f"SELECT doc FROM {self._table} WHERE id = ?", (other_id,)).fetchone()
+                other = loads(text)
+                if all(canon(get_path(other, key)) == value for (key, _), value in zip(keys, values)):
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+
+    def index_information(self) -> dict:
+        information = {"_id_": {"key": [("_id", 1)]}}
+        for name, (keys, options) in self._indexes.items():
+            information[name] = {"key": [tuple(key) for key in keys]} | options
+        return information
+
+    def _candidates(self, filter: dict) -> set[str] | None:
+        """ Row ids that can match filter according to the indexes, or None if every row has to be scanned """
+        for field, condition in filter.items():
+            if field == "$or":
+                branches = [self._candidates(branch) for branch in condition]
+                if all(ids != None for ids in branches):
+                    return set().union(*branches)
+                continue
+            if field != "_id" and field not in self._lookup:
+                continue
+            if _is_operator_dict(condition):
+                if "$eq" in condition:
+                    values = [condition["$eq"]]
+                elif "$in" in condition:
+                    values = condition["$in"]
+                else:
+                    continue
+            else:
+                values = [condition]
+            if field != "_id" and any(isinstance(value, (list, dict)) for value in values):
+                # Only array elements are in the lookup, whole arrays and documents are matched by scanning
+                continue
+            if field == "_id":
+                return {dumps(value) for value in values}
+            return set().union(*(self._lookup[field].get(canon(value), ()) for value in values))
+        return None
+
+    # --------------------------------------------------READS
+    def _scan(self, filter: dict) -> Iterator[tuple[str, str, dict]]:
+        """ (row id, stored text, document) of the documents matching filter, in natural order """
+        filter = filter or {}
+        ids = self._candidates(filter)
+        conn = self.database.conn
+        if ids != None:
+            # Only the documents the indexes point to, few enough to be read at once
+            rows = []
+            ids = list(ids)
+            with self.database.lock:
+                for start in range(0, len(ids), SCAN_PAGE):
+                    chunk = ids[start:start + SCAN_PAGE]
+                    rows += conn.execute(f"SELECT rowid, id, doc FROM {self._table} WHERE id IN ({','.join('?' * len(chunk))})",
+                                         chunk).fetchall()
+            pages = [sorted(rows)]
+        else:
+            pages = self._pages()
+        for page in pages:
+            for _, row_id, text in page:
+                document = loads(text)
+                if matches(document, filter):
+                    yield (row_id, text, document)
+
+    def _pages(self) -> Iterator[list[tuple[int, str, str]]]:
+        """ (rowid, row id, stored text) of every row, a page at a time, the lock taken for each page only """
+        last = 0
+        while True:
+            with self.database.lock:
+                page = self.database.conn.execute(
+                    f"SELECT rowid, id, doc FROM {self._table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last, SCAN_PAGE)).fetchall()
+            if not page:
+                return
+            yield page
+            last = page[-1][0]
+
+    def _rows(self, filter: dict) -> list[tuple[str, str, dict]]:
+        """ Every row _scan yields, for writes that hold the lock throughout """
+        return list(self._scan(filter))
+
+    def find(self, filter: dict = None, projection: dict = None, sort=None, limit: int = 0) -> SQLiteCursor:
+        cursor = SQLiteCursor(project(document, projection) for _, _, document in self._scan(filter))
+        if sort != None:
+            cursor.sort(sort)
+        return cursor.limit(limit)
+
+    def find_one(self, filter: dict = None, projection: dict = None) -> dict | None:
+        row = next(self._scan(filter), None)
+        return project(row[2], projection) if row != None else None
+
+    def count_documents(self, filter: dict) -> int:
+        return sum(1 for _ in self._scan(filter))
+
+    def aggregate(self, pipeline: list[dict]) -> SQLiteCursor:
+        # A leading $match selects the documents through the indexes, like find
+        filter = pipeline[0]["$match"] if pipeline and "$match" in pipeline[0] else None
+        documents = [document for _, _, document in self._scan(filter)]
+        return SQLiteCursor(run_aggregation(documents, pipeline[1:] if filter != None else pipeline))
+
+    # --------------------------------------------------WRITES
+    def _store(self, row_id: str | None, old: dict | None, document: dict, text: str = None) -> None:
+        new_id = dumps(document["_id"])
+        self._check_unique(new_id, document)
+        if old != None and new_id != row_id:
+            self._reindex(row_id, old, None)
+            self.database.write(f"DELETE FROM {self._table} WHERE id = ?", (row_id,))
+            old = None
+        # Updated in place, so documents keep their natural (insertion) order as in MongoDB
+        self.database.write(f"INSERT INTO {self._table} (id, doc) VALUES (?, ?) "
+                            "ON CONFLICT (id) DO UPDATE SET doc = excluded.doc", (new_id, text or dumps(document)))
+        self._reindex(new_id, old, document)
+
+    def _insert(self, document: dict) -> None:
+        if "_id" not in document:
+            document["_id"] = uuid.uuid4().hex
+        row_id = dumps(document["_id"])
+        if self.database.conn.execute(f"SELECT 1 FROM {self._table} WHERE id = ?", (row_id,)).fetchone():
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} dup key: {{ _id: {row_id} }}")
+        self._store(None, None, document)
+
+    def insert_one(self, document: dict) -> InsertOneResult:
+        with self.database.lock:
+            self._insert(document)
+        return InsertOneResult(document["_id"])
+
+    @contextmanager
+    def _transaction(self):
+        with self.database.lock:
+            try:
+                with self.database.transaction():
+                    yield
+            except BaseException:
+                # The lookup still has the entries of the writes rolled back
+                self._rebuild_lookup()
+                raise
+
+    def insert_many(self, documents: list[dict], ordered: bool = True) -> InsertManyResult:
+        """ Insert documents in one transaction, raising BulkWriteError for those that could not be, like pymongo """
+        errors, inserted = [], 0
+        with self._transaction():
+            for index, document in enumerate(documents):
+                try:
+                    self._insert(document)
+                    inserted += 1
+                except OperationFailure as e:
+                    errors.append(_write_error(index, e, document))
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError(_bulk_details(errors, inserted=inserted))
+        return InsertManyResult([document["_id"] for document in documents])
+
+    def _update(self, filter: dict, update, upsert: bool, many: bool) -> tuple[UpdateResult, dict | None, dict | None]:
+        """ Apply update, returning the result with the first document before and after it """
+        rows = self._rows(filter)
+        if not many:
+            rows = rows[:1]
+        if not rows:
+            if not upsert:
+                return UpdateResult(0, 0, None), None, None
+            document = apply_update(upsert_base(filter), update, inserting=True)
+            self._insert(document)
+            return UpdateResult(0, 0, document["_id"]), None, document
+        modified, first = 0, None
+        for row_id, text, old in rows:
+            # Updated on a fresh copy of the stored document, old is returned as it was
+            document = apply_update(loads(text), update)
+            new_text = dumps(document)
+            if new_text != text:
+                self._store(row_id, old, document, new_text)
+                modified += 1
+            if first == None:
+                first = (old, document)
+        return UpdateResult(len(rows), modified, None), first[0], first[1]
+
+    def update_one(self, filter: dict, update, upsert: bool = False) -> UpdateResult:
+        with self.database.lock:
+            return self._update(filter, update, upsert, many=False)[0]
+
+    def update_many(self, filter: dict, update, upsert: bool = False) -> UpdateResult:
+        with self.database.lock:
+            return self._update(filter, update, upsert, many=True)[0]
+
+    def bulk_write(self, requests: list, ordered: bool = True) -> BulkWriteResult:
+        """ Apply pymongo UpdateOne and UpdateMany requests in order, in one transaction
+
+        Requests that fail are reported by a BulkWriteError with the counts of
+        those applied, like pymongo; ordered stops at the first of them.
+        """
+        for request in requests:
+            if not isinstance(request, (UpdateOne, UpdateMany)):
+                raise TypeError(f"{type(request).__name__} is not supported by bulk_write")
+        matched = modified = 0
+        errors, upserted = [], []
+        with self._transaction():
+            for index, request in enumerate(requests):
+                # pymongo keeps the request's arguments in private attributes only
+                try:
+                    result = self._update(request._filter, request._doc, bool(request._upsert),
+                                          many=isinstance(request, UpdateMany))[0]
+                except OperationFailure as e:
+                    errors.append(_write_error(index, e, {"q": request._filter, "u": request._doc}))
+                    if ordered:
+                        break
+                    continue
+                matched += result.matched_count
+                modified += result.modified_count
+                if result.upserted_id != None:
+                    upserted.append({"index": index, "_id": result.upserted_id})
+        if errors:
+            raise BulkWriteError(_bulk_details(errors, matched=matched, modified=modified, upserted=upserted))
+        return BulkWriteResult(matched, modified, len(upserted))
+
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False) -> UpdateResult:
+        return self.update_one(filter, replacement, upsert)
+
+    def find_one_and_update(self, filter: dict, update, projection: dict = None, upsert: bool = False,
+                            return_document: bool = False) -> dict | None:
+        with self.database.lock:
+            _, before, after = self._update(filter, update, upsert, many=False)
+        document = after if return_document else before
+        return None if document == None else project(document, projection)
+
+    def _delete(self, filter: dict, many: bool) -> DeleteResult:
+        with self.database.lock:
+            rows = self._rows(filter)
+            if not many:
+                rows = rows[:1]
+            for row_id, _, document in rows:
+                self._reindex(row_id, document, None)
+                self.database.write(f"DELETE FROM {self._table} WHERE id = ?", (row_id,))
+        return DeleteResult(len(rows))
+
+    def delete_one(self, filter: dict) -> DeleteResult:
+        return self._delete(filter, many=False)
+
+    def delete_many(self, filter: dict) -> DeleteResult:
+        return self._delete(filter, many=True)
+
+    def drop(self) -> None:
+        with self.database.lock:
+            self.database.write(f"DELETE FROM {self._table}")
+            self.database.write("DELETE FROM indexes WHERE collection = ?", (self.name,))
+            self._indexes = {}
+            self._lookup = {}
+
+    def expire(self, now: datetime) -> int:
+        """ Delete the documents past the expireAfterSeconds of a TTL index """
+        expired = 0
+        for keys, options in list(self._indexes.values()):
+            if "expireAfterSeconds" in options:
+                cutoff = now - timedelta(seconds=options["expireAfterSeconds"])
+                expired += self._delete({keys[0][0]: {"$lt": cutoff}}, many=True).deleted_count
+        return expired
+
+
+class SQLiteDatabase:
+    """
+    Class holding the SQLite connection shared by a database's collections.
+
+    Attributes
+    ----------
+    path: str
+        SQLite database file, ":memory:" for a database that is not persisted
+    commit_every: int
+        Number of writes committed together
+    commit_seconds: float
+        Longest time a write waits to be committed
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, commit_every: int = SQLITE_COMMIT_EVERY,
+                 commit_seconds: float = SQLITE_COMMIT_SECONDS) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.lock = threading.RLock()
+        # Transactions are begun and committed by write and flush
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS indexes "
+                          "(collection TEXT, name TEXT, keys TEXT, options TEXT, PRIMARY KEY (collection, name))")
+        self._collections = {}
+        self._pending = 0
+        self._batch = False
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def __getitem__(self, name: str) -> SQLiteCollection:
+        with self.lock:
+            collection = self._collections.get(name)
+            if collection == None:
+                collection = self._collections[name] = SQLiteCollection(self, name)
+            return collection
+
+    def write(self, sql: str, params: tuple = ()) -> None:
+        with self.lock:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            self.conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self.commit_every and not self._batch:
+                self.flush()
+
+    @contextmanager
+    def transaction(self):
+        """ Commit the writes of the with block together, rolling them back if it raises """
+        with self.lock:
+            # Earlier writes are committed first, so a rollback only undoes the block's
+            self.flush()
+            self._batch = True
+            try:
+                yield
+            except BaseException:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                self._pending = 0
+                raise
+            finally:
+                self._batch = False
+            self.flush()
+
+    def flush(self) -> None:
+        """ Commit the writes waiting for their batch """
+        with self.lock:
+            if self.conn.in_transaction:
+                self.conn.execute("COMMIT")
+            self._pending = 0
+
+    def _flush_periodically(self) -> None:
+        last_sweep = time.monotonic()
+        while not self._closed:
+            time.sleep(self.commit_seconds)
+            with self.lock:
+                if self._closed:
+                    return
+                self.flush()
+                if time.monotonic() - last_sweep >= TTL_SWEEP_SECONDS:
+                    last_sweep = time.monotonic()
+                    now = datetime.now(timezone.utc)
+                    for collection in self._collections.values():
+                        collection.expire(now)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._closed:
+                return
+            self.flush()
+            self._closed = True
+            self.conn.close()
+
+    def ping(self) -> None:
+        with self.lock:
+            self.conn.execute("SELECT 1")
@@ -0,0 +1,58 @@
+import time
+from typing import Any, Iterable, Protocol
+from decouple import config
+
+# mongo, or sqlite for the embedded engine in utils/sqlite_store.py
+STORAGE_BACKEND = config('STORAGE_BACKEND', default='mongo')
+
+_sqlite = None
+
+
+class Collection(Protocol):
+    """ Collection operations WordleStats, Leaderboard, GlobalDB and the update handlers rely on """
+    name: str
+
+    def find(self, filter: dict = None, projection: dict = None) -> Iterable[dict]: ...
+    def find_one(self, filter: dict = None, projection: dict = None) -> dict | None: ...
+    def find_one_and_update(self, filter: dict, update: dict | list[dict], projection: dict = None,
+                            upsert: bool = False, return_document: bool = False) -> dict | None: ...
+    def insert_one(self, document: dict) -> Any: ...
+    def insert_many(self, documents: list[dict]) -> Any: ...
+    def update_one(self, filter: dict, update: dict | list[dict], upsert: bool = False) -> Any: ...
+    def update_many(self, filter: dict, update: dict | list[dict], upsert: bool = False) -> Any: ...
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False) -> Any: ...
+    def bulk_write(self, requests: list, ordered: bool = True) -> Any: ...
+    def delete_one(self, filter: dict) -> Any: ...
+    def delete_many(self, filter: dict) -> Any: ...
+    def count_documents(self, filter: dict) -> int: ...
+    def aggregate(self, pipeline: list[dict]) -> Iterable[dict]: ...
+    def create_index(self, keys: str | list[tuple[str, int]], **kwargs) -> str: ...
+    def drop_index(self, name: str) -> None: ...
+    def index_information(self) -> dict: ...
+    def drop(self) -> None: ...
+
+
+class Database(Protocol):
+    def __getitem__(self, name: str) -> Collection: ...
+
+
+def get_database() -> Database:
+    """ Database of the configured backend, shared by the process """
+    global _sqlite
+    if STORAGE_BACKEND == 'sqlite':
+        from utils.sqlite_store import SQLiteDatabase
+        if _sqlite == None:
+            _sqlite = SQLiteDatabase()
+        return _sqlite
+    from utils.load_mongo_db import get_database as get_mongo_database
+    return get_mongo_database()
+
+
+def ping() -> float | None:
+    """ Round trip time of a ping in seconds, or None if the database cannot be reached """
+    if STORAGE_BACKEND == 'sqlite':
+        start = time.perf_counter()
+        get_database().ping()
+        return time.perf_counter() - start
+    from utils.load_mongo_db import ping as ping_mongo
+    return ping_mongo()
@@ -0,0 +1,185 @@
+""" Streaming import and export of user stats as CSV or NDJSON
+
+Every stage is a generator, so a file of any size goes through in constant
+memory: lines are parsed, validated into ImportedStats and grouped into
+batches of TRANSFER_BATCH, which WordleStats.bulk_import applies in one
+unordered bulk write per batch. Each user's stats are set to the values in the
+file, and users missing from the database are created, so importing a file
+twice changes nothing and importing an export restores the stats it holds.
+
+Run from the repository root with
+    python -m utils.user_transfer import <file> [--check]
+    python -m utils.user_transfer export <file>
+to import or export against the configured database; the format follows the
+file extension (.csv, or .ndjson / .jsonl).
+"""
+import csv
+import io
+import json
+from collections import namedtuple
+from itertools import islice
+from typing import Iterable, Iterator
+from decouple import config
+
+TRANSFER_BATCH = config('TRANSFER_BATCH', default=1000, cast=int)
+# Columns of an export and an import; username, streak and last_game may be left out of an import
+EXPORT_FIELDS = ["user_id", "username", "games", "average", "streak", "last_game"]
+DOCUMENT_FIELDS = {"user_id": "_id", "username": "username", "games": "num_games",
+                   "average": "score_avg", "streak": "streak", "last_game": "last_game"}
+# Invalid rows reported back, the rest are only counted
+MAX_ERRORS = 20
+
+ImportedStats = namedtuple('ImportedStats', ['user_id', 'games', 'average', 'username', 'streak', 'last_game'])
+
+
+class ImportReport:
+    """ Counts of an import, with the first MAX_ERRORS invalid rows """
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.invalid = 0
+        self.matched = 0
+        self.modified = 0
+        self.created = 0
+        self.applied = False  # False when the file was only checked
+        self.errors = []  # (line, reason)
+
+    def error(self, line: int, reason: str) -> None:
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    def __str__(self) -> str:
+        lines = [f"rows: {self.rows}", f"invalid: {self.invalid}"]
+        if self.applied:
+            lines += [f"matched: {self.matched}", f"modified: {self.modified}", f"created: {self.created}"]
+        lines += [f"line {line}: {reason}" for line, reason in self.errors]
+        return "\n".join(lines)
+
+
+def file_format(name: str) -> str:
+    return "csv" if name.lower().endswith(".csv") else "ndjson"
+
+
+def parse_rows(lines: Iterable[str], format: str, report: ImportReport) -> Iterator[tuple[int, dict]]:
+    """ Yield (line number, row) of a CSV with a header line, or of NDJSON """
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            report.rows += 1
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        report.rows += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            report.error(number, "not valid JSON")
+            continue
+        if not isinstance(row, dict):
+            report.error(number, "not a JSON object")
+            continue
+        yield number, row
+
+
+def optional(row: dict, field: str, cast):
+    """ Value of an optional column, None if it is missing or empty, as an export leaves unset fields """
+    value = row.get(field)
+    return None if value in (None, "") else cast(value)
+
+
+def validate_rows(rows: Iterable[tuple[int, dict]], report: ImportReport) -> Iterator[ImportedStats]:
+    """ Yield ImportedStats for every valid row, with the same limits as /adjust """
+    for number, row in rows:
+        try:
+            user_id = int(row["user_id"])
+            games = int(row["games"])
+            average = float(row["average"])
+            streak = optional(row, "streak", int)
+            last_game = optional(row, "last_game", int)
+        except KeyError as e:
+            report.error(number, f"missing {e.args[0]}")
+            continue
+        except (TypeError, ValueError):
+            report.error(number, "user_id, games, streak and last_game must be whole numbers, average a number")
+            continue
+        if games < 1:
+            report.error(number, "games must be at least 1")
+        elif not 1.0 <= average <= 7.0:
+            report.error(number, "average must be between 1 and 7")
+        elif (streak or 0) < 0 or (last_game or 0) < 0:
+            report.error(number, "streak and last_game cannot be negative")
+        else:
+            yield ImportedStats(user_id, games, average, optional(row, "username", str), streak, last_game)
+
+
+def batched(items: Iterable, size: int = TRANSFER_BATCH) -> Iterator[list]:
+    iterator = iter(items)
+    while (batch := list(islice(iterator, size))):
+        yield batch
+
+
+def read_stats(lines: Iterable[str], format: str, report: ImportReport) -> Iterator[ImportedStats]:
+    return validate_rows(parse_rows(lines, format, report), report)
+
+
+def import_stats(stats, lines: Iterable[str], format: str, check: bool = False) -> ImportReport:
+    """ Validate a CSV or NDJSON file of user stats, and apply it through stats, a WordleStats, unless check is set """
+    report = ImportReport()
+    rows = read_stats(lines, format, report)
+    if check:
+        for _ in rows:
+            pass
+    else:
+        stats.bulk_import(rows, report)
+    return report
+
+
+def format_rows(documents: Iterable[dict], format: str) -> Iterator[str]:
+    """ Yield the lines of an export of user documents """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if format == "csv":
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+    for document in documents:
+        values = [document.get(DOCUMENT_FIELDS[field]) for field in EXPORT_FIELDS]
+        if format == "csv":
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(dict(zip(EXPORT_FIELDS, values)), ensure_ascii=False) + "\n"
+
+
+def main() -> None:
+    import argparse
+    from classes.WordleStats import WordleStats
+    from classes.Leaderboard import Leaderboard
+    from classes.ChatMembers import ChatMembers
+    from utils.storage import get_database
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('file')
+    parser.add_argument('--check', action='store_true', help="Only validate the file")
+    args = parser.parse_args()
+
+    # Only the stats, without GlobalDB's background threads; a running bot's caches pick the changes up as they expire
+    db = get_database()
+    stats = WordleStats(db["user_data"], Leaderboard(db["leaderboards"]), ChatMembers(db["chat_members"]))
+    format = file_format(args.file)
+    if args.action == 'export':
+        with open(args.file, "w", encoding="utf-8", newline="") as file:
+            latest = db["latest_game"].find_one({"_id": 0})
+            file.writelines(format_rows(stats.export_users(latest['latest_game'] if latest != None else 0), format))
+    else:
+        with open(args.file, encoding="utf-8-sig", newline="") as file:
+            print(import_stats(stats, file, format, args.check))
+
+
+if __name__ == "__main__":
+    main()